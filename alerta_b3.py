@@ -1,35 +1,150 @@
+from __future__ import annotations
 from datetime import datetime
 import logging
 import logging.handlers
-import yfinance as yf
 import asyncio
 import time
 import datetime
 import threading
+import functools
+import random
+import socketserver
+import socket
+import zlib
+import argparse
+import signal
+import contextlib
+import http.server
+import importlib
+import secrets
+import atexit
+import queue
+import json
+from collections import deque
+import bisect
+import math
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from zoneinfo import ZoneInfo
-import pandas as pd
+from typing import TYPE_CHECKING
 import os
-from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean
+import re
+from sqlalchemy import create_engine, event, bindparam, literal, or_, Column, Integer, String, Float, DateTime, Boolean, Index
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-#Configs Globais
-load_dotenv()
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+
+#yfinance, pandas, numpy e telegram são pesados: só são importados no primeiro uso, para o
+#import do módulo (scripts, benchmarks, ferramentas) não pagar ~1s de inicialização
+class ImportacaoPreguicosa:
+    def __init__(self, nome: str):
+        self._nome = nome
+        self._modulo = None
 
-telegram_token = os.getenv("telegram_token")
-chat_id_admin = int(os.getenv("admin_chat_id"))
+    def __getattr__(self, atributo):
+        if self._modulo is None:
+            self._modulo = importlib.import_module(self._nome)
+        return getattr(self._modulo, atributo)
 
+yf = ImportacaoPreguicosa("yfinance")
+pd = ImportacaoPreguicosa("pandas")
+np = ImportacaoPreguicosa("numpy")
 
-intevalo_monitoramento = 1200 #20 minutos
+#Configs Globais
+#Os valores vindos do .env são lidos por carregar_configuracao() no main, não no import
+telegram_token = None
+chat_id_admin = None
+
+
+intevalo_monitoramento = 1200 #20 minutos (tickers com alvos distantes)
+#(distância relativa do preço até o alvo armado mais próximo, intervalo em segundos)
+faixas_monitoramento = [(0.01, 60), (0.03, 300)]
+intervalo_minimo_monitoramento = 60 #o monitor acorda pelo menos nesse intervalo para pegar alertas novos
+abertura_pregao = datetime.time(10, 0)
+fechamento_pregao = datetime.time(18, 0) #inclui o call de fechamento
+#Fechamentos extraordinários da B3 além dos feriados calculados, ex: feriados_b3=2026-07-09,2026-12-30
+#Origem das cotações do monitor: yahoo (polling), arquivo:<caminho> ou tcp://<host>:<porta> (replay local)
+fonte_cotacoes_config = "yahoo"
+feriados_extras = set()
+max_threads_cotacoes = 8 #limite de buscas individuais simultâneas no Yahoo
+#Saúde das buscas: tickers que falham seguidamente são suspensos (sem requisições) por um tempo que
+#dobra a cada nova falha; falhas da fonte inteira (fora do ar, limite de taxa) abrem o disjuntor
+falhas_para_suspender = 3 #falhas seguidas de um ticker até suspendê-lo
+suspensao_ticker = 15 * 60 #primeira suspensão (s)
+suspensao_max_ticker = 24 * 3600
+falhas_para_abrir_disjuntor = 3 #requisições seguidas com falha da fonte
+espera_disjuntor = 60 #primeira pausa (s) de todas as requisições à fonte
+espera_max_disjuntor = 30 * 60
+faltas_lote_para_unitario = 3 #vezes seguidas que um ticker falta no lote e sai na busca individual até ficar fora do lote
+revisao_unitario = 60 * 60 #depois disso (s) o ticker volta a ser tentado no lote
+#Validade (s) de cada tipo de dado no cache de cotações compartilhado
+ttl_cotacoes = {
+    "preco": 60, #último preço
+    "fechamento_anterior": 6 * 3600,
+    "metadados": 24 * 3600, #nome, moeda, bolsa... (usado na validação do /set)
+}
+validade_ticker_valido = datetime.timedelta(days=7) #tempo até revalidar um ticker conhecido
+validade_ticker_invalido = datetime.timedelta(hours=1) #tempo até tentar de novo um ticker não encontrado
+max_threads_bd = 4 #threads para as operações no SQLite vindas dos handlers
+max_threads_rede = 8 #threads para as consultas ao Yahoo vindas dos handlers
+envios_por_segundo = 25 #limite global do bot (o Telegram tolera ~30/s)
+envios_por_segundo_chat = 1 #limite por chat recomendado pelo Telegram
+rajada_envios_chat = 3 #mensagens seguidas permitidas para o mesmo chat antes de limitar
+workers_envio = 8 #envios simultâneos
+max_tentativas_envio = 5 #tentativas para erros transitórios (rede/timeout)
+limite_mensagem_telegram = 4096 #tamanho máximo de uma mensagem, em unidades UTF-16 (emojis contam 2)
+alertas_por_pagina = 10 #alertas por página do /list
+max_linhas_importacao = 1000 #linhas aceitas por /import
+max_bytes_importacao = 256 * 1024 #tamanho máximo do arquivo do /import
+max_listas_em_cache = 10000 #páginas renderizadas do /list guardadas (por usuário e filtro)
+#Endpoint local de métricas no formato do Prometheus (http://127.0.0.1:<porta>/metrics); 0 desliga
+porta_metricas = 9108
+host_metricas = "127.0.0.1"
+#local: o monitor roda numa thread do processo do bot; shards: os tickers são divididos entre o bot e
+#os processos `python alerta_b3.py worker` que compartilham o alertas.db, via leases no BD
+modo_monitor = "local"
+num_shards_monitor = 16 #partes em que os tickers são divididos entre os workers
+ttl_lease = 30 #segundos sem renovação até outro processo assumir um lease
+intervalo_sincronizacao_registro = 30 #no modo shards, intervalo mínimo entre recargas do registro alteradas por outros processos
+#Webhook: com webhook_url definido o Telegram entrega as atualizações num servidor HTTP do próprio bot
+#(atrás de um proxy com HTTPS) em vez do long polling
+webhook_url = None #URL pública base, ex: https://meu.dominio.com/bot
+webhook_host = "0.0.0.0"
+webhook_porta = 8443
+webhook_caminho = "telegram" #caminho local do listener; o webhook registrado é <webhook_url>/<webhook_caminho>
+webhook_segredo = None #enviado pelo Telegram no cabeçalho X-Telegram-Bot-Api-Secret-Token; gerado se vazio
+
+def carregar_configuracao(exigir_telegram: bool = True):
+    global telegram_token, chat_id_admin, fonte_cotacoes_config, feriados_extras, porta_metricas, modo_monitor
+    global webhook_url, webhook_host, webhook_porta, webhook_caminho, webhook_segredo, formato_logs
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    telegram_token = os.getenv("telegram_token")
+    if exigir_telegram and (not telegram_token or not os.getenv("admin_chat_id")):
+        raise SystemExit("Defina telegram_token e admin_chat_id no .env (veja o config_example.env).")
+    chat_id_admin = int(os.getenv("admin_chat_id")) if os.getenv("admin_chat_id") else None
+    modo_monitor = os.getenv("modo_monitor", modo_monitor)
+    fonte_cotacoes_config = os.getenv("fonte_cotacoes", fonte_cotacoes_config)
+    feriados_extras = {datetime.date.fromisoformat(d.strip()) for d in os.getenv("feriados_b3", "").split(",") if d.strip()}
+    feriados_b3.cache_clear()
+    #porta_metricas vazio ou 0 desliga o endpoint; ausente usa o padrão
+    porta_metricas = int(os.getenv("porta_metricas").strip() or 0) if os.getenv("porta_metricas") is not None else porta_metricas
+    webhook_url = os.getenv("webhook_url") or webhook_url
+    webhook_host = os.getenv("webhook_host", webhook_host)
+    webhook_porta = int(os.getenv("webhook_porta", webhook_porta))
+    webhook_caminho = os.getenv("webhook_caminho", webhook_caminho).strip("/")
+    webhook_segredo = os.getenv("webhook_segredo") or webhook_segredo
+    formato_logs = os.getenv("formato_logs", formato_logs).strip().lower()
 
 #Configuração de logs 
 LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'alerta_b3_bot.log') 
-
-#Garantindo se o diretório de logs existe
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+formato_logs = "texto" #texto ou json (uma linha JSON por registro, com os campos extras de cada evento)
+tamanho_fila_logs = 10000 #registros aguardando escrita; com a fila cheia o registro é descartado e contado
+max_repeticoes_log = 5 #avisos/erros da mesma linha de código gravados por janela; o resto é só contado
+janela_repeticoes_log = 60 #segundos
 
 #Logger principal
 logger = logging.getLogger(__name__)
@@ -42,21 +157,323 @@ logger.setLevel(logging.INFO) #Nível mínimo para gravação
 # %(funcName)s: A função onde a mensagem foi gerada
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(threadName)s - %(funcName)s - %(message)s')
 
-#gerenciamento
-file_handler = logging.handlers.RotatingFileHandler(
-    LOG_FILE,
-    maxBytes=5*1024*1024, #5mb
-    backupCount=5,
-    encoding='utf-8'
-)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+class FormatterJson(logging.Formatter):
+    #Um objeto por linha; os campos de extra={"dados": {...}} entram no nível de cima para agregação
+    def format(self, record: logging.LogRecord) -> str:
+        registro = {
+            "ts": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "thread": record.threadName,
+            "funcao": record.funcName,
+            "mensagem": record.getMessage(),
+        }
+        registro.update(getattr(record, "dados", None) or {})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            registro["excecao"] = record.exc_text
+        return json.dumps(registro, ensure_ascii=False, default=str)
+
+class FiltroRepeticoes(logging.Filter):
+    #Limita avisos e erros repetidos (ex: a mesma falha a cada ciclo) a max_repeticoes_log por janela e por
+    #linha de código; o primeiro da janela seguinte diz quantos sumiram. A chave é só a linha: um log por
+    #ticker feito na mesma linha divide o limite entre todos os tickers. CRITICAL nunca é suprimido.
+    def __init__(self, maximo: int, janela: float):
+        super().__init__()
+        self.maximo = maximo
+        self.janela = janela
+        self.suprimidos_total = 0
+        self._janelas = {} #(arquivo, linha) -> [início da janela, gravados, suprimidos]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or record.levelno >= logging.CRITICAL:
+            return True
+        agora = time.monotonic()
+        with self._lock:
+            estado = self._janelas.get((record.pathname, record.lineno))
+            if estado is None or agora - estado[0] >= self.janela:
+                suprimidos = estado[2] if estado else 0
+                self._janelas[(record.pathname, record.lineno)] = [agora, 1, 0]
+                if suprimidos:
+                    record.msg = f"(+{suprimidos} repetições suprimidas) {record.getMessage()}"
+                    record.args = None
+                return True
+            if estado[1] < self.maximo:
+                estado[1] += 1
+                return True
+            estado[2] += 1
+            self.suprimidos_total += 1
+            return False
+
+class HandlerFila(logging.handlers.QueueHandler):
+    #Quem loga (loop do bot, monitor, pool de cotações) só formata a mensagem e põe na fila;
+    #a escrita em disco e no terminal fica na thread do QueueListener
+    def __init__(self, fila: queue.Queue):
+        super().__init__(fila)
+        self.descartados_total = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        #Resolve a mensagem (os args podem mudar depois) e a exceção, que é mantida à parte para o JSON
+        copia = logging.makeLogRecord(record.__dict__)
+        copia.msg = copia.message = record.getMessage()
+        copia.args = None
+        if record.exc_info and not copia.exc_text:
+            copia.exc_text = formatter.formatException(record.exc_info)
+        copia.exc_info = None
+        return copia
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados_total += 1
+
+handler_fila = None
+filtro_repeticoes = FiltroRepeticoes(max_repeticoes_log, janela_repeticoes_log)
+_listener_logs = None
+
+#Handlers de arquivo e terminal (chamado no main: importar o módulo não cria o diretório de logs)
+def configurar_logs():
+    global handler_fila, _listener_logs
+    if _listener_logs is not None:
+        return
+    #Garantindo se o diretório de logs existe
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    formatador = FormatterJson() if formato_logs == "json" else formatter
+
+    #gerenciamento
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=5*1024*1024, #5mb
+        backupCount=5,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(formatador)
+
+    #para aparecer no terminal
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatador)
+
+    #Os dois handlers saem do caminho de quem loga: ficam atrás de uma fila esvaziada por uma thread própria
+    handler_fila = HandlerFila(queue.Queue(tamanho_fila_logs))
+    handler_fila.addFilter(filtro_repeticoes)
+    logger.addHandler(handler_fila)
+    _listener_logs = logging.handlers.QueueListener(handler_fila.queue, file_handler, console_handler, respect_handler_level=True)
+    _listener_logs.start()
+    #Grava o que ainda estiver na fila ao sair
+    atexit.register(_listener_logs.stop)
+
+#Métricas
+#Contadores e histogramas em memória, exportados no formato texto do Prometheus e resumidos no /stats.
+#Os medidores (fila, registro, cache) são lidos na hora da coleta.
+limites_histograma = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+descricoes_metricas = {
+    "cotacoes_total": ("counter", "Cotações buscadas por fonte, método e resultado"),
+    "cotacoes_busca_segundos": ("histogram", "Duração de cada requisição de cotações"),
+    "monitor_ciclo_segundos": ("histogram", "Duração do ciclo do monitor (busca + avaliação)"),
+    "processamento_precos_segundos": ("histogram", "Duração da avaliação de um lote de preços"),
+    "alertas_avaliados_total": ("counter", "Alertas dos tickers avaliados"),
+    "alertas_disparados_total": ("counter", "Alertas disparados"),
+    "alertas_rearmados_total": ("counter", "Alertas rearmados pelo monitor (preço voltou para o outro lado do alvo)"),
+    "cotacoes_evitadas_total": ("counter", "Buscas não feitas por ticker suspenso ou disjuntor aberto"),
+    "tickers_suspensos": ("gauge", "Tickers suspensos por falhas seguidas"),
+    "disjuntor_aberto": ("gauge", "1 se as requisições à fonte de cotações estão bloqueadas"),
+    "notificacoes_alerta_total": ("counter", "Mensagens de alertas disparados enfileiradas (uma por chat e ciclo, salvo divisão por tamanho)"),
+    "telegram_envios_total": ("counter", "Envios ao Telegram por resultado"),
+    "telegram_envio_segundos": ("histogram", "Latência das chamadas send_message"),
+    "bd_operacao_segundos": ("histogram", "Duração das operações no BD"),
+    "fila_envios_pendentes": ("gauge", "Mensagens aguardando envio"),
+    "alertas_registrados": ("gauge", "Alertas no registro em memória"),
+    "cache_cotacoes_total": ("counter", "Consultas ao cache de cotações por tipo e resultado"),
+    "uptime_segundos": ("gauge", "Tempo desde o início do processo"),
+    "logs_descartados_total": ("counter", "Registros de log não gravados, por motivo (fila cheia ou repetição)"),
+}
+
+class Histograma:
+    __slots__ = ('contagens', 'soma', 'total')
+
+    def __init__(self):
+        self.contagens = [0] * (len(limites_histograma) + 1) #último = +Inf
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor: float):
+        self.contagens[bisect.bisect_left(limites_histograma, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def somar(self, outro: 'Histograma'):
+        self.contagens = [a + b for a, b in zip(self.contagens, outro.contagens)]
+        self.soma += outro.soma
+        self.total += outro.total
+
+    def quantil(self, q: float) -> float:
+        #Limite superior do bucket onde cai o quantil (math.inf se passou do último)
+        alvo = q * self.total
+        acumulado = 0
+        for limite, contagem in zip(limites_histograma + (math.inf,), self.contagens):
+            acumulado += contagem
+            if acumulado >= alvo:
+                return limite
+        return math.inf
+
+    def media(self) -> float:
+        return self.soma / self.total if self.total else 0.0
+
+class Metricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contadores = {} #(nome, rótulos) -> valor
+        self._histogramas = {} #(nome, rótulos) -> Histograma
+        self._medidores = {} #nome -> função que retorna um valor ou [(rótulos, valor)]
+        self.inicio = time.monotonic()
+
+    def incrementar(self, nome: str, valor: float = 1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome: str, valor: float, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = Histograma()
+            histograma.observar(valor)
+
+    @contextlib.contextmanager
+    def cronometro(self, nome: str, **rotulos):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def medidor(self, nome: str, funcao):
+        self._medidores[nome] = funcao
+
+    def contador(self, nome: str, **rotulos) -> float:
+        #Soma de todas as séries do contador que têm esses rótulos
+        filtro = set(rotulos.items())
+        with self._lock:
+            return sum(v for (n, r), v in self._contadores.items() if n == nome and filtro <= set(r))
+
+    def histograma(self, nome: str, **rotulos) -> Histograma:
+        filtro = set(rotulos.items())
+        resultado = Histograma()
+        with self._lock:
+            for (n, r), histograma in self._histogramas.items():
+                if n == nome and filtro <= set(r):
+                    resultado.somar(histograma)
+        return resultado
+
+    def _series_medidores(self) -> dict:
+        series = {"uptime_segundos": [((), time.monotonic() - self.inicio)]}
+        for nome, funcao in self._medidores.items():
+            try:
+                valor = funcao()
+            except Exception as e:
+                logger.warning(f"Falha ao ler o medidor {nome}: {e}")
+                continue
+            if isinstance(valor, (int, float)):
+                valor = [({}, valor)]
+            series[nome] = [(tuple(sorted(r.items())), v) for r, v in valor]
+        return series
+
+    def exportar(self) -> str:
+        #Formato texto do Prometheus (version 0.0.4)
+        def rotulos_texto(rotulos) -> str:
+            if not rotulos:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in rotulos) + "}"
+
+        def cabecalho(nome: str):
+            tipo, descricao = descricoes_metricas.get(nome, ("untyped", nome))
+            linhas.append(f"# HELP alerta_b3_{nome} {descricao}")
+            linhas.append(f"# TYPE alerta_b3_{nome} {tipo}")
+
+        with self._lock:
+            contadores = sorted(self._contadores.items())
+            histogramas = sorted(((chave, list(h.contagens), h.soma, h.total) for chave, h in self._histogramas.items()), key=lambda x: x[0])
+
+        series = {}
+        for (nome, rotulos), valor in contadores:
+            series.setdefault(nome, []).append((rotulos, valor))
+        series.update(self._series_medidores())
+
+        linhas = []
+        for nome, valores in series.items():
+            cabecalho(nome)
+            for rotulos, valor in valores:
+                linhas.append(f"alerta_b3_{nome}{rotulos_texto(rotulos)} {valor}")
+
+        anterior = None
+        for (nome, rotulos), contagens, soma, total in histogramas:
+            if nome != anterior:
+                cabecalho(nome)
+                anterior = nome
+            acumulado = 0
+            for limite, contagem in zip(limites_histograma + (math.inf,), contagens):
+                acumulado += contagem
+                le = "+Inf" if limite == math.inf else limite
+                linhas.append(f"alerta_b3_{nome}_bucket{rotulos_texto(rotulos + (('le', le),))} {acumulado}")
+            linhas.append(f"alerta_b3_{nome}_sum{rotulos_texto(rotulos)} {soma}")
+            linhas.append(f"alerta_b3_{nome}_count{rotulos_texto(rotulos)} {total}")
+
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas()
+metricas.medidor("logs_descartados_total", lambda: [
+    ({"motivo": "fila_cheia"}, handler_fila.descartados_total if handler_fila else 0),
+    ({"motivo": "repeticao"}, filtro_repeticoes.suprimidos_total),
+])
+
+#Mede a duração de uma função de acesso ao BD (rótulo operacao = nome da função)
+def medir_bd(funcao):
+    @functools.wraps(funcao)
+    def medida(*args, **kwargs):
+        with metricas.cronometro("bd_operacao_segundos", operacao=funcao.__qualname__):
+            return funcao(*args, **kwargs)
+    return medida
+
+class HandlerMetricas(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        corpo = metricas.exportar().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
 
-#para aparecer no terminal
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+    def log_message(self, formato, *args):
+        pass #o scrape a cada poucos segundos só poluiria o log
 
+servidor_metricas = None
+
+def iniciar_servidor_metricas():
+    global servidor_metricas
+    if not porta_metricas:
+        return
+    try:
+        servidor_metricas = http.server.ThreadingHTTPServer((host_metricas, porta_metricas), HandlerMetricas)
+    except OSError as e:
+        logger.error(f"Não foi possível abrir o endpoint de métricas em {host_metricas}:{porta_metricas}: {e}")
+        return
+    servidor_metricas.daemon_threads = True
+    threading.Thread(target=servidor_metricas.serve_forever, name="metricas", daemon=True).start()
+    logger.info(f"Métricas disponíveis em http://{host_metricas}:{porta_metricas}/metrics")
+
+def parar_servidor_metricas():
+    global servidor_metricas
+    if servidor_metricas is not None:
+        servidor_metricas.shutdown()
+        servidor_metricas.server_close()
+        servidor_metricas = None
 
 tipos_alerta = ["compra", "venda"]
 
@@ -77,6 +494,12 @@ class Alerta(Base):
     tkt_edt = Column(Boolean, default=False)  # Indica se o alerta foi editado
     recorrencia = Column(Boolean, default=False) # Indica se o usuário deseja que o alerta seja resetado diáriamente caso disparado.
 
+    #Mesmos nomes da migração 1, para BDs novos e migrados ficarem iguais
+    __table_args__ = (
+        Index('ux_alertas_chat_ticker_tipo', 'chat_id', 'ticker', 'tipo', unique=True), #também atende buscas por chat_id
+        Index('ix_alertas_ticker', 'ticker'),
+    )
+
     def __repr__(self):
         return f"<Alerta(ticker='{self.ticker}', tipo='{self.tipo}', valor={self.valor})>"
 
@@ -93,35 +516,1594 @@ class UsuarioPermitido(Base):
     def __repr__(self):
         return f"<UsuarioPermitido(chat_id={self.chat_id}, nome='{self.nome}')>"
 
-#Iniciar BD
-engine = create_engine('sqlite:///alertas.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+#Log append-only das mudanças de estado feitas pelo monitor e pelo reset diário (auditoria)
+class TransicaoAlerta(Base):
+    __tablename__ = 'transicoes_alertas'
 
+    id = Column(Integer, primary_key=True)
+    alerta_id = Column(Integer, nullable=False)
+    chat_id = Column(Integer, nullable=False)
+    ticker = Column(String, nullable=False)
+    tipo = Column(String, nullable=False)
+    valor = Column(Float, nullable=False)
+    preco = Column(Float) #preço que causou a transição (vazio no reset diário)
+    estado_anterior = Column(String, nullable=False)
+    estado_novo = Column(String, nullable=False)
+    origem = Column(String, nullable=False) # 'monitor' ou 'reset'
+    ocorrido_em = Column(DateTime, nullable=False)
 
-#Funções do bot
-#Verifica a existência do ativo
-def ticker_existe(ticker: str) -> bool:
-    try: 
-        info = yf.Ticker(ticker).info
-        if info and len(info) > 5:
+    def __repr__(self):
+        return f"<TransicaoAlerta(alerta_id={self.alerta_id}, {self.estado_anterior}->{self.estado_novo})>"
+
+#Leases do modo shards: cada recurso ("shard:<n>", "worker:<id>" ou "telegram") pertence a um
+#processo até expira_em, e quem para de renovar perde o recurso para outro processo
+class Lease(Base):
+    __tablename__ = 'leases'
+
+    recurso = Column(String, primary_key=True)
+    dono = Column(String)
+    expira_em = Column(DateTime)
+
+    def __repr__(self):
+        return f"<Lease(recurso='{self.recurso}', dono='{self.dono}')>"
+
+#Mensagens geradas pelos workers sem Telegram, enviadas pelo processo do bot
+class MensagemSaida(Base):
+    __tablename__ = 'caixa_saida'
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    texto = Column(String, nullable=False)
+    parse_mode = Column(String)
+    descricao = Column(String)
+    criado_em = Column(DateTime, nullable=False)
+
+#Catálogo dos tickers já consultados no Yahoo (válidos e inválidos)
+class TickerCatalogo(Base):
+    __tablename__ = 'tickers_catalogo'
+
+    ticker = Column(String, primary_key=True)
+    valido = Column(Boolean, nullable=False)
+    verificado_em = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<TickerCatalogo(ticker='{self.ticker}', valido={self.valido})>"
+
+#Pragmas aplicados em cada conexão: WAL deixa o monitor gravar sem bloquear as leituras dos handlers
+def configurar_conexao_sqlite(conexao_dbapi, registro_conexao):
+    cursor = conexao_dbapi.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL") #seguro com WAL e bem mais rápido que FULL
+    cursor.execute("PRAGMA busy_timeout=5000") #espera o lock em vez de falhar com 'database is locked'
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+#Migrações do schema, aplicadas em ordem; a versão atual fica no PRAGMA user_version do próprio arquivo
+def migracao_indices_alertas(conexao):
+    #O índice único exige remover duplicados antigos de (chat_id, ticker, tipo), mantendo o editado por
+    #último: o /set antigo alterava o primeiro da consulta (menor id), então vale o timestamp, não o id
+    duplicados = [linha[0] for linha in conexao.exec_driver_sql(
+        "SELECT id FROM (SELECT id, ROW_NUMBER() OVER ("
+        "PARTITION BY chat_id, ticker, tipo ORDER BY timestamp DESC, id DESC) AS ordem FROM alertas) "
+        "WHERE ordem > 1"
+    )]
+    if duplicados:
+        conexao.exec_driver_sql("DELETE FROM alertas WHERE id = ?", [(alerta_id,) for alerta_id in duplicados])
+        logger.warning(f"Migração: {len(duplicados)} alertas duplicados removidos (ids {', '.join(map(str, duplicados))}).")
+    conexao.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ux_alertas_chat_ticker_tipo ON alertas (chat_id, ticker, tipo)")
+    conexao.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_alertas_ticker ON alertas (ticker)")
+
+def migracao_versao_alertas(conexao):
+    #Contador incrementado por gatilho a cada mudança em alertas: no modo shards cada processo
+    #recarrega o registro quando outro processo (bot, worker, reset diário) altera a tabela
+    conexao.exec_driver_sql("CREATE TABLE IF NOT EXISTS versao_alertas (id INTEGER PRIMARY KEY CHECK (id = 1), versao INTEGER NOT NULL)")
+    conexao.exec_driver_sql("INSERT OR IGNORE INTO versao_alertas (id, versao) VALUES (1, 0)")
+    for operacao in ("INSERT", "UPDATE", "DELETE"):
+        conexao.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS tr_alertas_{operacao.lower()} AFTER {operacao} ON alertas "
+            "BEGIN UPDATE versao_alertas SET versao = versao + 1 WHERE id = 1; END"
+        )
+
+migracoes = [
+    migracao_indices_alertas, #versão 1
+    migracao_versao_alertas, #versão 2
+]
+
+def migrar_bd(engine):
+    with engine.connect() as conexao:
+        versao = conexao.exec_driver_sql("PRAGMA user_version").scalar()
+
+    for numero, migracao in enumerate(migracoes[versao:], start=versao + 1):
+        with engine.begin() as conexao:
+            migracao(conexao)
+            conexao.exec_driver_sql(f"PRAGMA user_version = {numero}")
+        logger.info(f"Migração do BD para a versão {numero} aplicada ({migracao.__name__}).")
+
+#Iniciar BD (no main; a Session só é ligada ao engine aqui)
+engine = None
+Session = sessionmaker()
+
+def iniciar_bd(url: str = 'sqlite:///alertas.db'):
+    global engine
+    engine = create_engine(url)
+    event.listen(engine, "connect", configurar_conexao_sqlite)
+    Base.metadata.create_all(engine)
+    migrar_bd(engine)
+    Session.configure(bind=engine)
+    return engine
+
+#Calendário da B3
+fuso_b3 = ZoneInfo("America/Sao_Paulo")
+
+def pascoa(ano: int) -> datetime.date:
+    #Algoritmo de Meeus/Jones/Butcher (calendário gregoriano)
+    a = ano % 19
+    b, c = divmod(ano, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    mes, dia = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(ano, mes, dia + 1)
+
+@functools.lru_cache(maxsize=None)
+def feriados_b3(ano: int) -> frozenset:
+    #Feriados nacionais, carnaval, sexta-feira santa, Corpus Christi, véspera de Natal e último dia do ano
+    fixos = [(1, 1), (4, 21), (5, 1), (9, 7), (10, 12), (11, 2), (11, 15), (11, 20), (12, 24), (12, 25), (12, 31)]
+    p = pascoa(ano)
+    moveis = [p - datetime.timedelta(days=48), p - datetime.timedelta(days=47), p - datetime.timedelta(days=2), p + datetime.timedelta(days=60)]
+    extras = [d for d in feriados_extras if d.year == ano]
+    return frozenset([datetime.date(ano, mes, dia) for mes, dia in fixos] + moveis + extras)
+
+def dia_de_pregao(data: datetime.date) -> bool:
+    return data.weekday() < 5 and data not in feriados_b3(data.year)
+
+def pregao_aberto(agora: datetime.datetime | None = None) -> bool:
+    agora = agora or datetime.datetime.now(fuso_b3)
+    return dia_de_pregao(agora.date()) and abertura_pregao <= agora.time() < fechamento_pregao
+
+def segundos_ate_abertura(agora: datetime.datetime | None = None) -> float:
+    #0 se o pregão está aberto
+    agora = agora or datetime.datetime.now(fuso_b3)
+    if pregao_aberto(agora):
+        return 0
+
+    data = agora.date()
+    if agora.time() >= abertura_pregao:
+        data += datetime.timedelta(days=1)
+    while not dia_de_pregao(data):
+        data += datetime.timedelta(days=1)
+
+    abertura = datetime.datetime.combine(data, abertura_pregao, tzinfo=fuso_b3)
+    return (abertura - agora).total_seconds()
+
+#Camada de cotações
+def preco_valido(preco) -> bool:
+    return preco is not None and not pd.isna(preco) and preco > 0
+
+def formatar_duracao(segundos: float) -> str:
+    minutos = math.ceil(segundos / 60)
+    return f"{minutos // 60}h{minutos % 60:02d}" if minutos >= 60 else f"{minutos}min"
+
+def agrupar_falhas(falhas: dict) -> dict:
+    #{ticker: motivo} -> {motivo: [tickers]}, do motivo mais comum para o menos comum
+    por_motivo = {}
+    for ticker, motivo in falhas.items():
+        por_motivo.setdefault(str(motivo), []).append(ticker)
+    return dict(sorted(por_motivo.items(), key=lambda item: -len(item[1])))
+
+def resumir_falhas(falhas: dict, max_tickers: int = 5) -> str:
+    #Uma linha para o ciclo inteiro em vez de uma por ticker: "sem dados (12): PETR4.SA, VALE3.SA, ... +7"
+    partes = []
+    for motivo, tickers in agrupar_falhas(falhas).items():
+        exemplos = ", ".join(tickers[:max_tickers])
+        resto = f" +{len(tickers) - max_tickers}" if len(tickers) > max_tickers else ""
+        partes.append(f"{motivo} ({len(tickers)}): {exemplos}{resto}")
+    return "; ".join(partes)
+
+#Cache de cotações único do processo, compartilhado por monitor, fechamento e /set.
+#Buscas simultâneas do mesmo (tipo, ticker) esperam a mesma ida ao Yahoo (single-flight).
+class CacheCotacoes:
+    def __init__(self, ttls: dict):
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._dados = {} #(tipo, ticker) -> (valor, expira_em)
+        self._em_andamento = {} #(tipo, ticker) -> Future[(valor, motivo da falha)]
+        self.acertos = dict.fromkeys(ttls, 0)
+        self.perdas = dict.fromkeys(ttls, 0)
+
+    def guardar(self, tipo: str, valores: dict):
+        expira_em = time.monotonic() + self.ttls[tipo]
+        with self._lock:
+            for ticker, valor in valores.items():
+                self._dados[(tipo, ticker)] = (valor, expira_em)
+
+            if len(self._dados) > 50000:
+                agora = time.monotonic()
+                self._dados = {k: v for k, v in self._dados.items() if v[1] > agora}
+
+    def consultar(self, tipo: str, tickers) -> dict:
+        #Só o que já está em cache, sem ir à rede
+        agora = time.monotonic()
+        valores = {}
+        with self._lock:
+            for ticker in tickers:
+                entrada = self._dados.get((tipo, ticker))
+                if entrada is not None and entrada[1] > agora:
+                    valores[ticker] = entrada[0]
+                    self.acertos[tipo] += 1
+                else:
+                    self.perdas[tipo] += 1
+        return valores
+
+    def obter(self, tipo: str, tickers, buscar) -> tuple[dict, dict]:
+        #buscar(lista de tickers) -> ({ticker: valor}, {ticker: motivo}) só é chamado para o que faltar
+        agora = time.monotonic()
+        valores, falhas = {}, {}
+        proprios, aguardando = [], {}
+
+        with self._lock:
+            for ticker in dict.fromkeys(tickers):
+                chave = (tipo, ticker)
+                entrada = self._dados.get(chave)
+                if entrada is not None and entrada[1] > agora:
+                    valores[ticker] = entrada[0]
+                    self.acertos[tipo] += 1
+                    continue
+
+                self.perdas[tipo] += 1
+                futuro = self._em_andamento.get(chave)
+                if futuro is None:
+                    self._em_andamento[chave] = Future()
+                    proprios.append(ticker)
+                else:
+                    aguardando[ticker] = futuro
+
+        if proprios:
+            encontrados, erros = {}, {}
+            try:
+                encontrados, erros = buscar(proprios)
+            except Exception as e:
+                erros = {ticker: str(e) or type(e).__name__ for ticker in proprios}
+            finally:
+                self.guardar(tipo, encontrados)
+                with self._lock:
+                    for ticker in proprios:
+                        motivo = erros.get(ticker, "sem dados disponíveis")
+                        self._em_andamento.pop((tipo, ticker)).set_result((encontrados.get(ticker), motivo))
+
+            for ticker in proprios:
+                if ticker in encontrados:
+                    valores[ticker] = encontrados[ticker]
+                else:
+                    falhas[ticker] = erros.get(ticker, "sem dados disponíveis")
+
+        for ticker, futuro in aguardando.items():
+            valor, motivo = futuro.result()
+            if valor is not None:
+                valores[ticker] = valor
+            else:
+                falhas[ticker] = motivo
+
+        return valores, falhas
+
+    def estatisticas(self) -> dict:
+        with self._lock:
+            return {tipo: {"acertos": self.acertos[tipo], "perdas": self.perdas[tipo]} for tipo in self.ttls}
+
+cache_cotacoes = CacheCotacoes(ttl_cotacoes)
+
+#.info do Yahoo (requisição pesada): aproveita a resposta para alimentar o cache de metadados e fechamento anterior
+campos_metadados = ("shortName", "longName", "currency", "exchange", "quoteType")
+
+def info_yahoo(ticker: str) -> dict:
+    info = yf.Ticker(ticker).info or {}
+    if len(info) > 5:
+        cache_cotacoes.guardar("metadados", {ticker: {campo: info.get(campo) for campo in campos_metadados}})
+    if preco_valido(info.get("previousClose")):
+        cache_cotacoes.guardar("fechamento_anterior", {ticker: float(info["previousClose"])})
+    return info
+
+#Extrai o fechamento de cada ticker de um DataFrame do yf.download(group_by='ticker')
+#posicao=-1 é o último (preço corrente durante o pregão), -2 o fechamento anterior
+def ultimos_fechamentos(data, tickers: list, posicao: int = -1) -> dict:
+    precos = {}
+    if data is None or data.empty:
+        return precos
+
+    for ticker in tickers:
+        if isinstance(data.columns, pd.MultiIndex):
+            if (ticker, 'Close') not in data.columns:
+                continue
+            serie = data[ticker]['Close']
+        elif len(tickers) == 1 and 'Close' in data.columns:
+            serie = data['Close']
+        else:
+            continue
+
+        serie = serie.dropna()
+        if len(serie) >= -posicao:
+            precos[ticker] = float(serie.iloc[posicao])
+
+    return precos
+
+#Barras de 1 minuto de um ticker, em ordem cronológica
+class Barras:
+    __slots__ = ('horarios', 'minimas', 'maximas', 'fechamento')
+
+    def __init__(self, horarios, minimas, maximas, fechamento: float):
+        self.horarios = horarios #DatetimeIndex
+        self.minimas = minimas #np.ndarray
+        self.maximas = maximas #np.ndarray
+        self.fechamento = fechamento
+
+    def __len__(self):
+        return len(self.horarios)
+
+    def instantes(self):
+        #Início de cada barra em segundos desde a época (horários sem fuso são do pregão)
+        horarios = self.horarios if self.horarios.tz is not None else self.horarios.tz_localize(fuso_b3)
+        return ((horarios - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+
+    def desde(self, horario):
+        #Só as barras posteriores a `horario` (None = todas)
+        if horario is None:
+            return self
+        inicio = self.horarios.searchsorted(horario, side='right')
+        return Barras(self.horarios[inicio:], self.minimas[inicio:], self.maximas[inicio:], self.fechamento)
+
+#Separa por ticker as barras de um yf.download(interval="1m", group_by='ticker')
+def barras_por_ticker(data, tickers: list) -> dict:
+    resultado = {}
+    if data is None or data.empty:
+        return resultado
+
+    for ticker in tickers:
+        if isinstance(data.columns, pd.MultiIndex):
+            if (ticker, 'Low') not in data.columns:
+                continue
+            tabela = data[ticker]
+        elif len(tickers) == 1 and 'Low' in data.columns:
+            tabela = data
+        else:
+            continue
+
+        tabela = tabela[['Low', 'High', 'Close']].dropna()
+        if not tabela.empty:
+            resultado[ticker] = Barras(
+                tabela.index,
+                tabela['Low'].to_numpy(dtype=float),
+                tabela['High'].to_numpy(dtype=float),
+                float(tabela['Close'].iloc[-1])
+            )
+
+    return resultado
+
+#Saúde das buscas
+class FonteIndisponivel(Exception):
+    pass
+
+def falha_da_fonte(erro: Exception) -> bool:
+    #Limite de taxa, timeout e conexão são problemas da fonte, não do ticker
+    texto = f"{type(erro).__name__} {erro}"
+    return any(marca in texto for marca in ("RateLimit", "Too Many Requests", "429", "Timeout", "Connection"))
+
+class Disjuntor:
+    #Fechado: as requisições passam. Após `limite` falhas seguidas da fonte abre e bloqueia todas por
+    #`espera` segundos (dobrando a cada reabertura, até `espera_max`). Vencido o prazo, libera uma
+    #requisição de teste: sucesso fecha, falha reabre.
+    def __init__(self, nome: str, limite: int = falhas_para_abrir_disjuntor, espera: float = espera_disjuntor, espera_max: float = espera_max_disjuntor):
+        self.nome = nome
+        self.limite = limite
+        self.espera = espera
+        self.espera_max = espera_max
+        self._lock = threading.Lock()
+        self._falhas = 0
+        self._aberturas = 0
+        self._aberto_ate = None #time.monotonic(); None = fechado
+
+    @property
+    def aberto(self) -> bool:
+        return self._aberto_ate is not None
+
+    def restante(self) -> float:
+        aberto_ate = self._aberto_ate
+        return max(0.0, aberto_ate - time.monotonic()) if aberto_ate is not None else 0.0
+
+    def permite(self) -> bool:
+        with self._lock:
+            if self._aberto_ate is None:
+                return True
+            agora = time.monotonic()
+            if agora < self._aberto_ate:
+                return False
+            #Requisição de teste; as outras esperam o resultado dela (ou o fim da janela, se ele não vier)
+            self._aberto_ate = agora + min(self.espera, 30)
+            return True
+
+    def sucesso(self):
+        with self._lock:
+            if self._aberto_ate is not None:
+                logger.info(f"Disjuntor de {self.nome} fechado, requisições liberadas.")
+            self._falhas = self._aberturas = 0
+            self._aberto_ate = None
+
+    def falha(self, motivo):
+        with self._lock:
+            self._falhas += 1
+            if self._aberto_ate is None and self._falhas < self.limite:
+                return
+            duracao = min(self.espera * 2 ** self._aberturas, self.espera_max)
+            self._aberturas += 1
+            self._aberto_ate = time.monotonic() + duracao
+        logger.warning(f"Disjuntor de {self.nome} aberto por {duracao:.0f}s após {self._falhas} falhas seguidas: {motivo}")
+
+    def chamar(self, funcao, *args, resposta_valida=None):
+        #Uma requisição à fonte: bloqueada com o disjuntor aberto; falhas da fonte contam para abri-lo
+        if not self.permite():
+            metricas.incrementar("cotacoes_evitadas_total", fonte=self.nome, motivo="disjuntor")
+            raise FonteIndisponivel(f"{self.nome} indisponível, nova tentativa em {formatar_duracao(self.restante())}")
+        try:
+            resultado = funcao(*args)
+        except Exception as e:
+            if falha_da_fonte(e):
+                self.falha(e)
+                raise FonteIndisponivel(str(e)) from e
+            self.sucesso() #a fonte respondeu; o erro é do pedido (ex: ticker inexistente)
+            raise
+        if resposta_valida is None or resposta_valida(resultado):
+            self.sucesso()
+        else:
+            self.falha("resposta vazia")
+        return resultado
+
+class SaudeTickers:
+    #Por ticker: o método de busca que funcionou por último e as falhas seguidas. Com
+    #`falhas_para_suspender` falhas o ticker é suspenso; cada falha depois disso dobra a suspensão.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metodos = {} #ticker -> "lote" | "unitario" | "barras"
+        self._faltas_lote = {} #ticker -> vezes seguidas que faltou no lote e veio na busca individual
+        self._unitario_ate = {} #ticker -> time.monotonic() até quando fica fora do lote
+        self._falhas = {} #ticker -> (falhas seguidas, último motivo)
+        self._suspenso_ate = {} #ticker -> time.monotonic()
+        self._novos_suspensos = [] #(ticker, falhas, segundos, motivo) ainda não avisados
+
+    def metodo(self, ticker: str) -> str | None:
+        return self._metodos.get(ticker)
+
+    def algum_funcionou(self, tickers: list) -> bool:
+        return any(t in self._metodos for t in tickers)
+
+    def prefere_unitario(self, ticker: str) -> bool:
+        #Fora do lote só depois de `faltas_lote_para_unitario` faltas seguidas e por `revisao_unitario` segundos;
+        #passado o prazo volta ao lote, e uma nova falta já o devolve à busca individual
+        ate = self._unitario_ate.get(ticker)
+        if ate is None:
+            return False
+        if ate > time.monotonic():
             return True
+        with self._lock:
+            self._unitario_ate.pop(ticker, None)
+            self._faltas_lote[ticker] = faltas_lote_para_unitario - 1
         return False
-    except Exception:
+
+    def sucesso(self, ticker: str, metodo: str):
+        with self._lock:
+            if metodo == "unitario":
+                faltas = self._faltas_lote.get(ticker, 0) + 1
+                self._faltas_lote[ticker] = faltas
+                if faltas >= faltas_lote_para_unitario and ticker not in self._unitario_ate:
+                    self._unitario_ate[ticker] = time.monotonic() + revisao_unitario
+            elif metodo == "lote":
+                self._faltas_lote.pop(ticker, None)
+                self._unitario_ate.pop(ticker, None)
+            #Barras não dizem nada sobre o preço em lote: só registram o ticker como válido
+            if metodo != "barras" or ticker not in self._metodos:
+                self._metodos[ticker] = metodo
+            self._falhas.pop(ticker, None)
+            self._suspenso_ate.pop(ticker, None)
+
+    def falha(self, ticker: str, motivo: str):
+        with self._lock:
+            falhas = self._falhas.get(ticker, (0, ""))[0] + 1
+            self._falhas[ticker] = (falhas, motivo)
+            if falhas < falhas_para_suspender:
+                return
+            segundos = min(suspensao_ticker * 2 ** (falhas - falhas_para_suspender), suspensao_max_ticker)
+            self._suspenso_ate[ticker] = time.monotonic() + segundos
+            self._novos_suspensos.append((ticker, falhas, segundos, motivo))
+
+    def separar(self, tickers: list) -> tuple[list, dict]:
+        #(liberados, {suspenso: segundos restantes}); quem cumpriu a suspensão ganha uma nova tentativa
+        agora = time.monotonic()
+        liberados, suspensos = [], {}
+        with self._lock:
+            for ticker in tickers:
+                ate = self._suspenso_ate.get(ticker, 0)
+                if ate > agora:
+                    suspensos[ticker] = ate - agora
+                else:
+                    liberados.append(ticker)
+        return liberados, suspensos
+
+    def suspensos(self) -> dict:
+        agora = time.monotonic()
+        with self._lock:
+            return {t: ate - agora for t, ate in self._suspenso_ate.items() if ate > agora}
+
+    def retirar_novos_suspensos(self) -> list:
+        with self._lock:
+            novos, self._novos_suspensos = self._novos_suspensos, []
+        return novos
+
+class ProvedorCotacoes:
+    #Base dos provedores: tenta tudo em uma requisição em lote e o que faltar
+    #é buscado ticker a ticker em um pool de threads limitado
+    nome = "base"
+    fornece_barras = False
+
+    def __init__(self, max_threads: int = max_threads_cotacoes, disjuntor: Disjuntor | None = None, saude: SaudeTickers | None = None):
+        self.max_threads = max_threads
+        self.disjuntor = disjuntor or Disjuntor(self.nome)
+        self.saude = saude or SaudeTickers()
+
+    def buscar_lote(self, tickers: list) -> dict:
+        #Provedores sem busca em lote retornam vazio e tudo cai no pool
+        return {}
+
+    def buscar_unitario(self, ticker: str) -> float | None:
+        raise NotImplementedError
+
+    def buscar_barras(self, tickers: list) -> dict:
+        #{ticker: Barras} de 1 minuto do dia; provedores sem barras retornam vazio e o monitor usa só o preço
+        return {}
+
+    def buscar_precos(self, tickers) -> tuple[dict, dict]:
+        #Retorna ({ticker: preço}, {ticker: motivo da falha})
+        tickers = list(dict.fromkeys(tickers))
+        precos, falhas = {}, {}
+
+        #Tickers suspensos não geram nenhuma requisição
+        tickers, suspensos = self.saude.separar(tickers)
+        for ticker, restante in suspensos.items():
+            falhas[ticker] = f"suspenso por falhas seguidas, nova tentativa em {formatar_duracao(restante)}"
+        if suspensos:
+            metricas.incrementar("cotacoes_evitadas_total", len(suspensos), fonte=self.nome, motivo="suspenso")
+
+        if not tickers:
+            return precos, falhas
+
+        #Disjuntor aberto: falha tudo na hora, sem ir à fonte
+        if self.disjuntor.restante() > 0:
+            for ticker in tickers:
+                falhas[ticker] = f"{self.nome} indisponível, nova tentativa em {formatar_duracao(self.disjuntor.restante())}"
+            metricas.incrementar("cotacoes_evitadas_total", len(tickers), fonte=self.nome, motivo="disjuntor")
+            return precos, falhas
+
+        #Tickers que faltaram seguidamente no lote vão direto para a busca individual (por um tempo, ver SaudeTickers).
+        #Lote vazio com ticker que já funcionou conta como falha da fonte (o yfinance devolve vazio em vez de erro).
+        para_lote = [t for t in tickers if not self.saude.prefere_unitario(t)]
+        if para_lote:
+            try:
+                with metricas.cronometro("cotacoes_busca_segundos", fonte=self.nome, metodo="lote"):
+                    lote = self.disjuntor.chamar(self.buscar_lote, para_lote, resposta_valida=lambda r: bool(r) or not self.saude.algum_funcionou(para_lote))
+                for ticker, preco in lote.items():
+                    if preco_valido(preco):
+                        precos[ticker] = float(preco)
+                        self.saude.sucesso(ticker, "lote")
+            except Exception as e:
+                logger.warning(f"Falha na busca em lote ({self.nome}), usando busca individual: {e}")
+                metricas.incrementar("cotacoes_total", len(para_lote), fonte=self.nome, metodo="lote", resultado="erro")
+            metricas.incrementar("cotacoes_total", len(precos), fonte=self.nome, metodo="lote", resultado="ok")
+
+        pendentes = [t for t in tickers if t not in precos]
+        if not pendentes:
+            return precos, falhas
+
+        with ThreadPoolExecutor(max_workers=min(self.max_threads, len(pendentes)), thread_name_prefix="cotacoes") as executor:
+            futuros = {executor.submit(self._buscar_unitario_medido, ticker): ticker for ticker in pendentes}
+            for futuro in as_completed(futuros):
+                ticker = futuros[futuro]
+                try:
+                    preco = futuro.result()
+                except FonteIndisponivel as e:
+                    falhas[ticker] = f"fonte indisponível: {e}" #não é culpa do ticker
+                    continue
+                except Exception as e:
+                    falhas[ticker] = str(e) or type(e).__name__
+                    self.saude.falha(ticker, falhas[ticker])
+                    continue
+
+                if preco_valido(preco):
+                    precos[ticker] = float(preco)
+                    self.saude.sucesso(ticker, "unitario")
+                else:
+                    falhas[ticker] = "sem preço disponível"
+                    self.saude.falha(ticker, falhas[ticker])
+
+        erros = len(falhas) - len(suspensos)
+        metricas.incrementar("cotacoes_total", len(pendentes) - erros, fonte=self.nome, metodo="unitario", resultado="ok")
+        metricas.incrementar("cotacoes_total", erros, fonte=self.nome, metodo="unitario", resultado="erro")
+        return precos, falhas
+
+    def _buscar_unitario_medido(self, ticker: str) -> float | None:
+        with metricas.cronometro("cotacoes_busca_segundos", fonte=self.nome, metodo="unitario"):
+            return self.disjuntor.chamar(self.buscar_unitario, ticker)
+
+    def obter_barras(self, tickers: list) -> dict:
+        #buscar_barras protegido pelo disjuntor, sem os tickers suspensos
+        tickers, _ = self.saude.separar(tickers)
+        if not self.fornece_barras or not tickers:
+            return {}
+        barras = self.disjuntor.chamar(self.buscar_barras, tickers, resposta_valida=lambda r: bool(r) or not self.saude.algum_funcionou(tickers))
+        for ticker in barras:
+            self.saude.sucesso(ticker, "barras")
+        return barras
+
+class ProvedorYahoo(ProvedorCotacoes):
+    nome = "yahoo"
+    fornece_barras = True
+
+    def __init__(self, max_threads: int = max_threads_cotacoes):
+        #Disjuntor e saúde compartilhados por todas as buscas no Yahoo do processo (monitor, fechamento e /set)
+        super().__init__(max_threads, disjuntor_yahoo, saude_yahoo)
+
+    def buscar_lote(self, tickers: list) -> dict:
+        #Barras diárias: o último Close é o preço corrente durante o pregão
+        data = yf.download(
+            tickers,
+            period="5d",
+            interval="1d",
+            group_by='ticker',
+            threads=True,
+            progress=False,
+            auto_adjust=False
+        )
+        cache_cotacoes.guardar("fechamento_anterior", ultimos_fechamentos(data, tickers, posicao=-2))
+        return ultimos_fechamentos(data, tickers)
+
+    def buscar_unitario(self, ticker: str) -> float | None:
+        return info_yahoo(ticker).get("regularMarketPrice")
+
+    def buscar_barras(self, tickers: list) -> dict:
+        #Uma única requisição com as barras de 1 minuto do dia de todos os tickers
+        data = yf.download(
+            tickers,
+            period="1d",
+            interval="1m",
+            group_by='ticker',
+            threads=True,
+            progress=False,
+            auto_adjust=False
+        )
+        return barras_por_ticker(data, tickers)
+
+disjuntor_yahoo = Disjuntor("yahoo")
+saude_yahoo = SaudeTickers()
+provedor_cotacoes = ProvedorYahoo()
+metricas.medidor("tickers_suspensos", lambda: len(saude_yahoo.suspensos()))
+metricas.medidor("disjuntor_aberto", lambda: [({"fonte": "yahoo"}, int(disjuntor_yahoo.aberto))])
+
+#Registro residente dos alertas
+#Representação compacta de um alerta em memória (o SQLite continua sendo o armazenamento durável)
+class RegistroAlerta:
+    __slots__ = ('id', 'ticker', 'tipo', 'valor', 'chat_id', 'disparado', 'recorrencia', 'armado_em')
+
+    def __init__(self, id: int, ticker: str, tipo: str, valor: float, chat_id: int, disparado: str = 'N', recorrencia: bool = False, armado_em: float = 0.0):
+        self.id = id
+        self.ticker = ticker
+        self.tipo = tipo
+        self.valor = valor
+        self.chat_id = chat_id
+        self.disparado = disparado
+        self.recorrencia = bool(recorrencia)
+        #Criação/edição (segundos desde a época): barras anteriores não disparam o alerta
+        self.armado_em = armado_em
+
+    def __repr__(self):
+        return f"<RegistroAlerta(ticker='{self.ticker}', tipo='{self.tipo}', valor={self.valor})>"
+
+#Carregado uma vez na inicialização e atualizado pelos handlers logo após o commit (write-through).
+#Para cada ticker, tipo e estado (armado 'N' / disparado 'S') guarda os alvos ordenados,
+#assim um novo preço só toca nos alertas que cruzaram o alvo ou rearmaram: O(log n + acertos)
+class RegistroAlertas:
+    def __init__(self):
+        self._lock = threading.RLock() #handlers (loop do bot) e monitor (thread) acessam juntos
+        self._por_ticker = {} #ticker -> {(tipo, disparado): [(valor, id), ...] ordenada}
+        self._por_chat = {} #chat_id -> {ids}
+        self._alertas = {} #id -> RegistroAlerta
+        self._versoes_chat = {} #chat_id -> contador de mudanças nos alertas do chat (cache do /list)
+        self._diario = None #durante uma recarga: mudanças a reaplicar sobre o índice novo
+        self._lock_recarga = threading.Lock() #uma recarga por vez
+        self.invalido = True #força recarga do BD (na inicialização ou após erro no monitor)
+
+    def __len__(self):
+        return len(self._alertas)
+
+    def invalidar(self):
+        self.invalido = True
+
+    @medir_bd
+    def recarregar(self, filtro=None):
+        #Consulta e indexação fora do lock (com 100k alertas levam segundos e travariam os handlers do loop);
+        #o que handlers e monitor mudarem nesse meio tempo vai para o diário e é reaplicado na troca.
+        #filtro(ticker): carrega só parte dos tickers (workers do modo shards)
+        with self._lock_recarga:
+            with self._lock:
+                self._diario = []
+            try:
+                session = Session()
+                try:
+                    alertas = [
+                        RegistroAlerta(*linha[:-1], linha[-1].timestamp() if linha[-1] else 0.0)
+                        for linha in session.query(
+                            Alerta.id, Alerta.ticker, Alerta.tipo, Alerta.valor, Alerta.chat_id, Alerta.disparado, Alerta.recorrencia, Alerta.timestamp
+                        )
+                        if filtro is None or filtro(linha[1])
+                    ]
+                finally:
+                    session.close()
+                self.carregar(alertas)
+            finally:
+                with self._lock:
+                    self._diario = None
+            self.invalido = False
+            logger.info(f"Registro de alertas carregado do BD: {len(alertas)} alertas.")
+
+    def carregar(self, alertas):
+        #Monta o índice novo fora do lock e troca de uma vez; só os chats cujos alertas mudaram têm a
+        #versão incrementada (as páginas do /list dos demais continuam válidas)
+        with self._lock:
+            if self._diario is None:
+                self._diario = []
+            antigos = dict(self._alertas)
+
+        novos = {alerta.id: alerta for alerta in alertas}
+        por_ticker, por_chat = {}, {}
+        for alerta in novos.values():
+            por_chat.setdefault(alerta.chat_id, set()).add(alerta.id)
+            listas = por_ticker.get(alerta.ticker)
+            if listas is None:
+                listas = por_ticker[alerta.ticker] = self._novas_listas()
+            listas[(alerta.tipo, alerta.disparado)].append((alerta.valor, alerta.id))
+        for listas in por_ticker.values():
+            for lista in listas.values():
+                lista.sort()
+
+        #Mudanças concorrentes nos objetos antigos não escapam: estão no diário e tocam o chat ao reaplicar
+        mudados = {alerta.chat_id for alerta_id, alerta in antigos.items() if alerta_id not in novos}
+        for alerta in novos.values():
+            antigo = antigos.get(alerta.id)
+            if antigo is None or self._chave(antigo) != self._chave(alerta):
+                mudados.add(alerta.chat_id)
+                if antigo is not None:
+                    mudados.add(antigo.chat_id)
+
+        with self._lock:
+            self._alertas, self._por_ticker, self._por_chat = novos, por_ticker, por_chat
+            for chat_id in mudados:
+                self._tocar(chat_id)
+            diario, self._diario = self._diario, None
+            for operacao, dado in diario:
+                if operacao == "salvar":
+                    self.salvar(dado)
+                elif operacao == "remover":
+                    self.remover(dado)
+                else:
+                    self._reaplicar_estado(dado)
+
+    @staticmethod
+    def _chave(alerta: RegistroAlerta) -> tuple:
+        #O que aparece no /list
+        return alerta.chat_id, alerta.ticker, alerta.tipo, alerta.valor, alerta.disparado, alerta.recorrencia
+
+    @staticmethod
+    def _novas_listas() -> dict:
+        return {(tipo, estado): [] for tipo in tipos_alerta for estado in ('N', 'S')}
+
+    def _anotar(self, operacao: str, dado):
+        if self._diario is not None:
+            self._diario.append((operacao, dado))
+
+    def _reaplicar_estado(self, antigo: RegistroAlerta):
+        #Disparo/rearme feito no índice antigo durante a recarga
+        alerta = self._alertas.get(antigo.id)
+        if alerta is None:
+            return
+        alerta.armado_em = max(alerta.armado_em, antigo.armado_em)
+        if alerta.disparado != antigo.disparado:
+            listas = self._por_ticker[alerta.ticker]
+            self._retirar(listas[(alerta.tipo, alerta.disparado)], alerta)
+            self._mover(listas[(alerta.tipo, antigo.disparado)], [(alerta.valor, alerta.id)], antigo.disparado)
+
+    @staticmethod
+    def _retirar(lista: list, alerta: RegistroAlerta):
+        i = bisect.bisect_left(lista, (alerta.valor, alerta.id))
+        if i < len(lista) and lista[i] == (alerta.valor, alerta.id):
+            del lista[i]
+
+    def _tocar(self, chat_id: int):
+        self._versoes_chat[chat_id] = self._versoes_chat.get(chat_id, 0) + 1
+
+    def versao_chat(self, chat_id: int) -> int:
+        #Muda sempre que um alerta do chat é criado, editado, removido, disparado ou rearmado
+        with self._lock:
+            return self._versoes_chat.get(chat_id, 0)
+
+    def _listas(self, ticker: str) -> dict:
+        listas = self._por_ticker.get(ticker)
+        if listas is None:
+            listas = self._novas_listas()
+            self._por_ticker[ticker] = listas
+        return listas
+
+    def salvar(self, alerta: RegistroAlerta):
+        #Insere ou substitui (edição via /set)
+        with self._lock:
+            self.remover(alerta.id)
+            self._anotar("salvar", alerta)
+            self._alertas[alerta.id] = alerta
+            self._por_chat.setdefault(alerta.chat_id, set()).add(alerta.id)
+            self._tocar(alerta.chat_id)
+            bisect.insort(self._listas(alerta.ticker)[(alerta.tipo, alerta.disparado)], (alerta.valor, alerta.id))
+
+    def remover(self, alerta_id: int):
+        with self._lock:
+            self._anotar("remover", alerta_id)
+            alerta = self._alertas.pop(alerta_id, None)
+            if alerta is None:
+                return
+            self._tocar(alerta.chat_id)
+
+            ids_chat = self._por_chat.get(alerta.chat_id)
+            if ids_chat is not None:
+                ids_chat.discard(alerta_id)
+                if not ids_chat:
+                    del self._por_chat[alerta.chat_id]
+
+            listas = self._por_ticker[alerta.ticker]
+            self._retirar(listas[(alerta.tipo, alerta.disparado)], alerta)
+
+            if not any(listas.values()):
+                del self._por_ticker[alerta.ticker]
+
+    def remover_do_chat(self, chat_id: int) -> int:
+        with self._lock:
+            ids = list(self._por_chat.get(chat_id, ()))
+            for alerta_id in ids:
+                self.remover(alerta_id)
+            return len(ids)
+
+    def rearmar_recorrentes(self) -> int:
+        with self._lock:
+            rearmados = 0
+            for listas in self._por_ticker.values():
+                for tipo in tipos_alerta:
+                    disparados = listas[(tipo, 'S')]
+                    recorrentes = [e for e in disparados if self._alertas[e[1]].recorrencia]
+                    if not recorrentes:
+                        continue
+                    disparados[:] = [e for e in disparados if not self._alertas[e[1]].recorrencia]
+                    self._mover(listas[(tipo, 'N')], recorrentes, 'N')
+                    agora = time.time()
+                    for _, alerta_id in recorrentes:
+                        self._alertas[alerta_id].armado_em = agora
+                    rearmados += len(recorrentes)
+            return rearmados
+
+    def distancia_alvo(self, ticker: str, preco: float) -> float:
+        #Distância relativa do preço até o alvo armado mais próximo (math.inf se não houver)
+        with self._lock:
+            listas = self._por_ticker.get(ticker)
+            if listas is None or preco <= 0:
+                return math.inf
+
+            distancia = math.inf
+            for tipo in tipos_alerta:
+                armados = listas[(tipo, 'N')]
+                if armados:
+                    #listas ordenadas: o alvo mais próximo está em uma das pontas
+                    distancia = min(distancia, abs(armados[0][0] - preco), abs(armados[-1][0] - preco))
+            return distancia / preco
+
+    def get(self, alerta_id: int) -> RegistroAlerta | None:
+        return self._alertas.get(alerta_id)
+
+    def quantidade(self, ticker: str | None = None) -> int:
+        #Alertas do ticker (ou de todos)
+        with self._lock:
+            if ticker is None:
+                return len(self._alertas)
+            listas = self._por_ticker.get(ticker)
+            return sum(len(lista) for lista in listas.values()) if listas else 0
+
+    def tickers(self) -> list:
+        with self._lock:
+            return list(self._por_ticker)
+
+    def alertas_do_chat(self, chat_id: int) -> list:
+        #Na ordem de criação, como a listagem direto do BD
+        with self._lock:
+            return [self._alertas[i] for i in sorted(self._por_chat.get(chat_id, ()))]
+
+    def alertas_por_chat(self) -> dict:
+        #Retrato {chat_id: [RegistroAlerta]} para relatórios
+        with self._lock:
+            return {chat_id: [self._alertas[i] for i in ids] for chat_id, ids in self._por_chat.items()}
+
+    def avaliar(self, ticker: str, preco: float) -> tuple[list, list]:
+        #Retorna (disparados, rearmados) e já move os alertas para o novo estado
+        with self._lock:
+            listas = self._por_ticker.get(ticker)
+            if listas is None:
+                return [], []
+
+            compra_disparados, venda_disparados, rearmados = self._transicionar(listas, preco, preco, preco)
+            disparados = [self._alertas[alerta_id] for _, alerta_id in compra_disparados + venda_disparados]
+            return disparados, rearmados
+
+    def avaliar_barras(self, ticker: str, barras) -> tuple[list, list]:
+        #Avalia as barras de 1 minuto desde a última avaliação: compra contra as mínimas e venda contra as máximas.
+        #Retorna ([(alerta, índice da barra do cruzamento)], rearmados); o rearme usa o último fechamento.
+        with self._lock:
+            listas = self._por_ticker.get(ticker)
+            if listas is None:
+                return [], []
+
+            #Mínima acumulada (não crescente) e máxima acumulada (não decrescente) até cada barra
+            minima_acumulada = np.minimum.accumulate(barras.minimas)
+            maxima_acumulada = np.maximum.accumulate(barras.maximas)
+
+            compra_disparados, venda_disparados, rearmados = self._transicionar(
+                listas, float(minima_acumulada[-1]), float(maxima_acumulada[-1]), barras.fechamento
+            )
+
+            #Primeira barra em que cada alvo foi tocado, para todos os alvos de uma vez
+            alvos_compra = np.fromiter((valor for valor, _ in compra_disparados), float, len(compra_disparados))
+            alvos_venda = np.fromiter((valor for valor, _ in venda_disparados), float, len(venda_disparados))
+            barras_compra = np.searchsorted(-minima_acumulada, -alvos_compra, side='left')
+            barras_venda = np.searchsorted(maxima_acumulada, alvos_venda, side='left')
+
+            disparados = [
+                (self._alertas[alerta_id], int(indice))
+                for entradas, indices in ((compra_disparados, barras_compra), (venda_disparados, barras_venda))
+                for (_, alerta_id), indice in zip(entradas, indices)
+            ]
+            if not disparados:
+                return disparados, rearmados
+
+            #A janela vai até a última barra avaliada do ticker (até 20 min para alvos distantes): um alerta
+            #criado ou editado no meio dela só conta as barras que terminam depois do seu armado_em
+            fim_barras = barras.instantes() + 60 #barras de 1 minuto
+            validos = []
+            for alerta, indice in disparados:
+                if fim_barras[indice] > alerta.armado_em:
+                    validos.append((alerta, indice))
+                    continue
+                inicio = int(np.searchsorted(fim_barras, alerta.armado_em, side='right'))
+                if alerta.tipo == 'compra':
+                    toques = barras.minimas[inicio:] <= alerta.valor
+                else:
+                    toques = barras.maximas[inicio:] >= alerta.valor
+                if toques.any():
+                    validos.append((alerta, inicio + int(toques.argmax())))
+                else:
+                    self._desfazer_disparo(alerta)
+            return validos, rearmados
+
+    def _desfazer_disparo(self, alerta: RegistroAlerta):
+        #Volta para armado um alerta que só cruzou o alvo antes de existir
+        listas = self._por_ticker[alerta.ticker]
+        self._retirar(listas[(alerta.tipo, 'S')], alerta)
+        self._mover(listas[(alerta.tipo, 'N')], [(alerta.valor, alerta.id)], 'N')
+
+    def _transicionar(self, listas: dict, limite_compra: float, limite_venda: float, fechamento: float) -> tuple[list, list, list]:
+        #compra dispara com mínima <= alvo e venda com máxima >= alvo; os disparados rearmam quando o
+        #fechamento volta para o outro lado do alvo. Retorna (entradas compra, entradas venda, rearmados).
+        compra_n, compra_s = listas[('compra', 'N')], listas[('compra', 'S')]
+        i = bisect.bisect_left(compra_n, (limite_compra,))
+        compra_disparados = compra_n[i:]
+        del compra_n[i:]
+        i = bisect.bisect_left(compra_s, (fechamento,))
+        compra_rearmados = compra_s[:i]
+        del compra_s[:i]
+
+        venda_n, venda_s = listas[('venda', 'N')], listas[('venda', 'S')]
+        i = bisect.bisect_right(venda_n, (limite_venda, math.inf))
+        venda_disparados = venda_n[:i]
+        del venda_n[:i]
+        i = bisect.bisect_left(venda_s, (fechamento, math.inf))
+        venda_rearmados = venda_s[i:]
+        del venda_s[i:]
+
+        self._mover(compra_s, compra_disparados, 'S')
+        self._mover(compra_n, compra_rearmados, 'N')
+        self._mover(venda_s, venda_disparados, 'S')
+        self._mover(venda_n, venda_rearmados, 'N')
+
+        rearmados = [self._alertas[alerta_id] for _, alerta_id in compra_rearmados + venda_rearmados]
+        return compra_disparados, venda_disparados, rearmados
+
+    def _mover(self, destino: list, entradas: list, disparado: str):
+        if not entradas:
+            return
+
+        for _, alerta_id in entradas:
+            alerta = self._alertas[alerta_id]
+            alerta.disparado = disparado
+            self._tocar(alerta.chat_id)
+            self._anotar("estado", alerta)
+
+        #Poucos acertos: insort; muitos: junta as duas sequências ordenadas (timsort faz em O(n))
+        if len(entradas) < 16:
+            for entrada in entradas:
+                bisect.insort(destino, entrada)
+        else:
+            destino.extend(entradas)
+            destino.sort()
+
+registro_alertas = RegistroAlertas()
+
+
+#Execução fora do loop do bot
+#Chamadas bloqueantes (SQLAlchemy e yfinance) vão para executores separados, assim uma consulta
+#lenta ao Yahoo no /set não trava os comandos dos outros usuários nem ocupa as threads do BD
+executor_bd = ThreadPoolExecutor(max_workers=max_threads_bd, thread_name_prefix="bd")
+executor_rede = ThreadPoolExecutor(max_workers=max_threads_rede, thread_name_prefix="rede")
+#Ciclos do monitor (busca no Yahoo + avaliação + gravação das transições), um por vez
+executor_monitor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="monitor")
+
+async def em_executor(executor: ThreadPoolExecutor, funcao, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(funcao, *args, **kwargs))
+
+#Fila de envios
+#Balde de fichas: libera `taxa` envios por segundo com rajadas de até `capacidade`
+class TokenBucket:
+    def __init__(self, taxa: float, capacidade: float):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.fichas = capacidade
+        self.atualizado = time.monotonic()
+
+    def tempo_de_espera(self) -> float:
+        #Consome uma ficha se houver; senão retorna quanto falta para a próxima
+        agora = time.monotonic()
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+        if self.fichas >= 1:
+            self.fichas -= 1
+            return 0
+        return (1 - self.fichas) / self.taxa
+
+    async def adquirir(self):
+        while (espera := self.tempo_de_espera()) > 0:
+            await asyncio.sleep(espera)
+
+#Fila de saída única para alertas, fechamento e avisos, rodando no loop do bot.
+#Cada chat tem sua própria fila (mantém a ordem das mensagens) e os chats prontos são
+#atendidos em rodízio pelos workers, respeitando o limite global e o de cada chat.
+class FilaEnvios:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._bot = None
+        self._workers = []
+        self._prontos = None #asyncio.Queue de chat_ids com mensagens e liberados para envio
+        self._por_chat = {} #chat_id -> deque[[texto, parse_mode, descricao, tentativas]]
+        self._limites_chat = {} #chat_id -> TokenBucket
+        self._limite_global = TokenBucket(envios_por_segundo, envios_por_segundo)
+        self._pausa_ate = 0 #RetryAfter do Telegram pausa todos os envios
+        self._antes_de_iniciar = [] #mensagens enfileiradas antes do loop existir
+        self.pendentes = 0
+
+    async def iniciar(self, bot):
+        self._loop = asyncio.get_running_loop()
+        self._bot = bot
+        self._prontos = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker(), name=f"envio-{i}") for i in range(workers_envio)]
+
+        with self._lock:
+            pendentes, self._antes_de_iniciar = self._antes_de_iniciar, []
+        for item in pendentes:
+            self._adicionar(*item)
+
+    async def parar(self, timeout: float = 10):
+        #Dá um tempo para esvaziar a fila antes de cancelar os workers
+        limite = time.monotonic() + timeout
+        while self.pendentes and time.monotonic() < limite:
+            await asyncio.sleep(0.1)
+        if self.pendentes:
+            logger.warning(f"Encerrando com {self.pendentes} mensagens não enviadas.")
+
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
+
+    def enfileirar(self, chat_id: int, texto: str, parse_mode: str | None = 'Markdown', descricao: str = ""):
+        #Pode ser chamado de qualquer thread
+        item = (chat_id, texto, parse_mode, descricao)
+        with self._lock:
+            loop = self._loop
+            if loop is None:
+                self._antes_de_iniciar.append(item)
+                return
+        loop.call_soon_threadsafe(self._adicionar, *item)
+
+    def _adicionar(self, chat_id: int, texto: str, parse_mode: str | None, descricao: str):
+        self.pendentes += 1
+        fila_chat = self._por_chat.get(chat_id)
+        if fila_chat is None:
+            #Chat novo na fila: entra no rodízio; se já existe, o worker que o atende segue a fila dele
+            self._por_chat[chat_id] = deque([[texto, parse_mode, descricao, 0]])
+            self._prontos.put_nowait(chat_id)
+        else:
+            fila_chat.append([texto, parse_mode, descricao, 0])
+
+    def _reagendar(self, chat_id: int, espera: float):
+        if espera > 0:
+            self._loop.call_later(espera, self._prontos.put_nowait, chat_id)
+        else:
+            self._prontos.put_nowait(chat_id)
+
+    def _concluir(self, chat_id: int):
+        #Tira a mensagem da frente e devolve o chat ao rodízio se ainda houver mensagens
+        fila_chat = self._por_chat[chat_id]
+        fila_chat.popleft()
+        self.pendentes -= 1
+        if fila_chat:
+            self._prontos.put_nowait(chat_id)
+        else:
+            del self._por_chat[chat_id]
+
+    def _limite_do_chat(self, chat_id: int) -> TokenBucket:
+        limite = self._limites_chat.get(chat_id)
+        if limite is None:
+            if len(self._limites_chat) > 10000:
+                #Descarta baldes parados há mais de um minuto (já estariam cheios de novo)
+                corte = time.monotonic() - 60
+                self._limites_chat = {c: b for c, b in self._limites_chat.items() if b.atualizado > corte}
+            limite = self._limites_chat[chat_id] = TokenBucket(envios_por_segundo_chat, rajada_envios_chat)
+        return limite
+
+    async def _worker(self):
+        from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+        while True:
+            chat_id = await self._prontos.get()
+
+            espera = self._limite_do_chat(chat_id).tempo_de_espera()
+            if espera > 0:
+                self._reagendar(chat_id, espera)
+                continue
+
+            pausa = self._pausa_ate - time.monotonic()
+            if pausa > 0:
+                await asyncio.sleep(pausa)
+            await self._limite_global.adquirir()
+
+            item = self._por_chat[chat_id][0]
+            texto, parse_mode, descricao, tentativas = item
+            inicio = time.perf_counter()
+            resultado = "ok"
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=texto, parse_mode=parse_mode)
+                logger.debug(f"Mensagem enviada para {chat_id}{f': {descricao}' if descricao else ''}")
+                self._concluir(chat_id)
+
+            except RetryAfter as e:
+                resultado = "retry_after"
+                espera = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+                self._pausa_ate = max(self._pausa_ate, time.monotonic() + espera)
+                logger.warning(f"Limite do Telegram atingido, pausando envios por {espera:.0f}s.")
+                self._reagendar(chat_id, espera)
+
+            except (BadRequest, Forbidden) as e:
+                resultado = "permanente"
+                #Erro permanente (chat bloqueou o bot, markdown inválido...): não adianta repetir
+                logger.error(f"Falha ao enviar para {chat_id}{f' ({descricao})' if descricao else ''}: {e}")
+                self._concluir(chat_id)
+
+            except (NetworkError, asyncio.TimeoutError) as e:
+                resultado = "transitorio"
+                item[3] = tentativas = tentativas + 1
+                if tentativas >= max_tentativas_envio:
+                    logger.error(f"Falha ao enviar para {chat_id} após {tentativas} tentativas: {e}")
+                    self._concluir(chat_id)
+                else:
+                    espera = min(60, 2 ** tentativas) * random.uniform(0.5, 1.5)
+                    logger.warning(f"Erro transitório ao enviar para {chat_id}, nova tentativa em {espera:.1f}s: {e}")
+                    self._reagendar(chat_id, espera)
+
+            except Exception as e:
+                resultado = "inesperado"
+                logger.error(f"Erro inesperado ao enviar para {chat_id}: {e}")
+                self._concluir(chat_id)
+
+            metricas.observar("telegram_envio_segundos", time.perf_counter() - inicio, resultado=resultado)
+            metricas.incrementar("telegram_envios_total", resultado=resultado)
+
+fila_envios = FilaEnvios()
+metricas.medidor("fila_envios_pendentes", lambda: fila_envios.pendentes)
+metricas.medidor("alertas_registrados", lambda: registro_alertas.quantidade())
+metricas.medidor("cache_cotacoes_total", lambda: [
+    ({"tipo": tipo, "resultado": resultado}, contagens[resultado])
+    for tipo, contagens in cache_cotacoes.estatisticas().items()
+    for resultado in ("acertos", "perdas")
+])
+
+#Catálogo de tickers
+#Formato dos ativos da B3 já sanitizados, ex: PETR4.SA, B3SA3.SA, BOVA11.SA, PETR4F.SA
+padrao_ticker_b3 = re.compile(r"^[A-Z0-9]{4}\d{1,2}F?\.SA$")
+
+#Busca de metadados para o cache compartilhado (só guarda os tickers que existem)
+def buscar_metadados(tickers: list) -> tuple[dict, dict]:
+    metadados, falhas = {}, {}
+    for ticker in tickers:
+        info = disjuntor_yahoo.chamar(info_yahoo, ticker)
+        if len(info) > 5:
+            metadados[ticker] = {campo: info.get(campo) for campo in campos_metadados}
+        else:
+            falhas[ticker] = "ticker não encontrado"
+    return metadados, falhas
+
+#Consulta de rede (lenta): só é feita quando o catálogo não conhece o ticker ou a entrada expirou
+def consultar_ticker_yahoo(ticker: str) -> bool:
+    metadados, falhas = cache_cotacoes.obter("metadados", [ticker], buscar_metadados)
+    if ticker in metadados:
+        return True
+    if falhas.get(ticker) == "ticker não encontrado":
         return False
+    #Erro de rede: o catálogo não guarda e tenta de novo na próxima
+    raise RuntimeError(falhas.get(ticker))
+
+#Validação em lote (/import): uma busca de barras diárias para todos; quem voltou com preço existe e só
+#o resto é conferido um a um pelo .info. Erro de rede em um ticker fica None (não verificado).
+def consultar_tickers_yahoo(tickers: list) -> dict:
+    precos = disjuntor_yahoo.chamar(provedor_cotacoes.buscar_lote, tickers)
+    resultado = {ticker: True for ticker in tickers if preco_valido(precos.get(ticker))}
+    for ticker in tickers:
+        if ticker not in resultado:
+            try:
+                resultado[ticker] = consultar_ticker_yahoo(ticker)
+            except Exception as e:
+                logger.warning(f"Falha ao validar {ticker} no Yahoo: {e}")
+                resultado[ticker] = None
+    return resultado
+
+class CatalogoTickers:
+    #Cache positivo e negativo persistido na tabela tickers_catalogo.
+    #Consultas simultâneas ao mesmo ticker desconhecido compartilham uma única ida à rede.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = None #ticker -> (valido, verificado_em)
+        self._em_andamento = {} #ticker -> Future da consulta em curso
+
+    @medir_bd
+    def _carregar(self):
+        session = Session()
+        try:
+            self._cache = {c.ticker: (c.valido, c.verificado_em) for c in session.query(TickerCatalogo)}
+        finally:
+            session.close()
 
-#Verifica se o usuário está autorizado
-def usuario_autorizado(chat_id: int) -> bool:
+    @medir_bd
+    def _gravar(self, validos: dict, verificado_em: datetime.datetime):
+        #validos: {ticker: bool}, numa única transação
+        session = Session()
+        try:
+            for ticker, valido in validos.items():
+                session.merge(TickerCatalogo(ticker=ticker, valido=valido, verificado_em=verificado_em))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Erro ao gravar {', '.join(validos)} no catálogo de tickers: {e}")
+        finally:
+            session.close()
+
+    def _consultar_cache(self, ticker: str) -> bool | None:
+        #Chamado com o lock; None se o catálogo não conhece o ticker ou a entrada expirou
+        entrada = self._cache.get(ticker)
+        if entrada is not None:
+            valido, verificado_em = entrada
+            validade = validade_ticker_valido if valido else validade_ticker_invalido
+            if datetime.datetime.now() - verificado_em < validade:
+                return valido
+        return None
+
+    def existe(self, ticker: str) -> bool:
+        #Erros de digitação óbvios nem chegam à rede
+        if not padrao_ticker_b3.match(ticker):
+            return False
+
+        with self._lock:
+            if self._cache is None:
+                self._carregar()
+
+            valido = self._consultar_cache(ticker)
+            if valido is not None:
+                return valido
+
+            futuro = self._em_andamento.get(ticker)
+            responsavel = futuro is None
+            if responsavel:
+                futuro = Future()
+                self._em_andamento[ticker] = futuro
+
+        if not responsavel:
+            return futuro.result()
+
+        try:
+            valido = consultar_ticker_yahoo(ticker)
+        except Exception as e:
+            #Falha de rede não é cacheada, a próxima consulta tenta de novo
+            logger.warning(f"Falha ao validar {ticker} no Yahoo: {e}")
+            valido = None
+
+        verificado_em = datetime.datetime.now()
+        with self._lock:
+            if valido is not None:
+                self._cache[ticker] = (valido, verificado_em)
+            del self._em_andamento[ticker]
+        futuro.set_result(bool(valido))
+
+        if valido is not None:
+            self._gravar({ticker: valido}, verificado_em)
+        return bool(valido)
+
+    def existem(self, tickers: list) -> dict:
+        #{ticker: True/False/None}; o que o catálogo não sabe vai numa única consulta em lote (None = não verificado)
+        resultado, desconhecidos = {}, []
+        with self._lock:
+            if self._cache is None:
+                self._carregar()
+            for ticker in dict.fromkeys(tickers):
+                if not padrao_ticker_b3.match(ticker):
+                    resultado[ticker] = False
+                    continue
+                valido = self._consultar_cache(ticker)
+                if valido is None:
+                    desconhecidos.append(ticker)
+                else:
+                    resultado[ticker] = valido
+
+        if not desconhecidos:
+            return resultado
+
+        try:
+            consultados = consultar_tickers_yahoo(desconhecidos)
+        except Exception as e:
+            logger.warning(f"Falha ao validar {len(desconhecidos)} tickers no Yahoo: {e}")
+            consultados = {}
+
+        verificados = {ticker: valido for ticker, valido in consultados.items() if valido is not None}
+        verificado_em = datetime.datetime.now()
+        with self._lock:
+            for ticker, valido in verificados.items():
+                self._cache[ticker] = (valido, verificado_em)
+        if verificados:
+            self._gravar(verificados, verificado_em)
+
+        for ticker in desconhecidos:
+            resultado[ticker] = consultados.get(ticker)
+        return resultado
+
+catalogo_tickers = CatalogoTickers()
+
+#Funções do bot
+#Verifica a existência do ativo
+def ticker_existe(ticker: str) -> bool:
+    return catalogo_tickers.existe(ticker)
+
+#Cache dos chat_ids ativos: carregado na primeira checagem e recarregado por add_user/toggle_user
+usuarios_autorizados = None
+
+@medir_bd
+def recarregar_usuarios_autorizados() -> frozenset:
+    global usuarios_autorizados
     session = Session()
-    existe_e_ativo = session.query(UsuarioPermitido).filter_by(chat_id=chat_id, ativo=True).first() is not None
-    session.close()
-    return existe_e_ativo
+    try:
+        usuarios_autorizados = frozenset(
+            chat_id for (chat_id,) in session.query(UsuarioPermitido.chat_id).filter_by(ativo=True)
+        )
+    finally:
+        session.close()
+    return usuarios_autorizados
+
+#Verifica se o usuário está autorizado (sem I/O depois da primeira carga)
+def usuario_autorizado(chat_id: int) -> bool:
+    autorizados = usuarios_autorizados
+    if autorizados is None:
+        autorizados = recarregar_usuarios_autorizados()
+    return chat_id in autorizados
 
 #Converter o ticker para o formato correto
 def sanitizar_ticker(ticker: str) -> str:
     ticker = ticker.upper().strip().replace(".SA", "")
     return ticker + ".SA"
 
+#Acesso ao BD usado pelos handlers (síncrono, sempre chamado via em_executor)
+@medir_bd
+def gravar_alerta(user_id: int, ticker: str, tipo_alerta: str, valor: float, is_recorrente: bool) -> bool:
+    #Cria ou edita o alerta e atualiza o registro; retorna True se foi edição
+    session = Session()
+    try:
+        #Verifica se já existe um alerta para o mesmo ticket e tipo
+        alerta = session.query(Alerta).filter_by(ticker=ticker, tipo=tipo_alerta, chat_id=user_id).first()
+        editado = alerta is not None
+        agora = datetime.datetime.now()
+
+        if editado:
+            #Edita o alerta caso já exista
+            alerta.valor = valor
+            alerta.disparado = 'N' #Rearmar o alerta
+            alerta.timestamp = agora
+            alerta.tkt_edt = True
+            alerta.recorrencia = is_recorrente
+        else:
+            #Cria novo alerta
+            alerta = Alerta(
+                ticker=ticker, 
+                tipo=tipo_alerta, 
+                valor=valor, 
+                chat_id=user_id, 
+                timestamp=agora,
+                recorrencia=is_recorrente
+            )
+            session.add(alerta)
+
+        session.flush() #gera o id antes do commit
+        alerta_id = alerta.id
+        session.commit()
+    finally:
+        session.close()
+
+    registro_alertas.salvar(RegistroAlerta(alerta_id, ticker, tipo_alerta, valor, user_id, 'N', is_recorrente, agora.timestamp()))
+    return editado
+
+@medir_bd
+def gravar_alertas_lote(user_id: int, linhas: list) -> dict:
+    #Cria ou edita todos os alertas numa única transação; linhas: [(número, ticker, tipo, valor, recorrente)]
+    #sem (ticker, tipo) repetido. Retorna {(ticker, tipo): True se foi edição}
+    agora = datetime.datetime.now()
+    session = Session()
+    try:
+        existentes = {(a.ticker, a.tipo): a for a in session.query(Alerta).filter_by(chat_id=user_id)}
+        gravados = {}
+        for _, ticker, tipo_alerta, valor, is_recorrente in linhas:
+            alerta = existentes.get((ticker, tipo_alerta))
+            editado = alerta is not None
+            if editado:
+                alerta.valor = valor
+                alerta.disparado = 'N' #Rearmar o alerta
+                alerta.timestamp = agora
+                alerta.tkt_edt = True
+                alerta.recorrencia = is_recorrente
+            else:
+                alerta = Alerta(ticker=ticker, tipo=tipo_alerta, valor=valor, chat_id=user_id, timestamp=agora, recorrencia=is_recorrente)
+                session.add(alerta)
+            gravados[(ticker, tipo_alerta)] = (alerta, editado)
+
+        session.flush() #gera os ids antes do commit
+        registros = [
+            RegistroAlerta(alerta.id, ticker, tipo_alerta, alerta.valor, user_id, 'N', alerta.recorrencia, agora.timestamp())
+            for (ticker, tipo_alerta), (alerta, _) in gravados.items()
+        ]
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    for registro in registros:
+        registro_alertas.salvar(registro)
+    return {chave: editado for chave, (_, editado) in gravados.items()}
+
+@medir_bd
+def remover_alerta_bd(user_id: int, ticker: str, tipo_alerta: str) -> bool:
+    session = Session()
+    try:
+        alerta = session.query(Alerta).filter_by(ticker=ticker, tipo=tipo_alerta, chat_id=user_id).first()
+        if alerta is None:
+            return False
+
+        alerta_id = alerta.id
+        session.delete(alerta)
+        session.commit()
+    finally:
+        session.close()
+
+    registro_alertas.remover(alerta_id)
+    return True
+
+@medir_bd
+def remover_alertas_do_chat_bd(user_id: int) -> int:
+    session = Session()
+    try:
+        count = session.query(Alerta).filter_by(chat_id=user_id).delete(synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    registro_alertas.remover_do_chat(user_id)
+    return count
+
+@medir_bd
+def rearmar_recorrentes_bd() -> int:
+    session = Session()
+    try:
+        #registra no log as transições antes de aplicá-las, na mesma transação
+        session.execute(
+            TransicaoAlerta.__table__.insert().from_select(
+                ['alerta_id', 'chat_id', 'ticker', 'tipo', 'valor', 'estado_anterior', 'estado_novo', 'origem', 'ocorrido_em'],
+                session.query(
+                    Alerta.id, Alerta.chat_id, Alerta.ticker, Alerta.tipo, Alerta.valor,
+                    literal('S'), literal('N'), literal('reset'), literal(datetime.datetime.now())
+                ).filter(Alerta.recorrencia == True, Alerta.disparado == 'S').statement
+            )
+        )
+
+        #busca todos alertas setados como recorrentes
+        alertas_resetados = session.query(Alerta).filter(
+            Alerta.recorrencia == True,
+            Alerta.disparado == 'S'
+        ).update({Alerta.disparado:'N'}, synchronize_session=False)
+
+        session.commit()
+    except Exception:
+        session.rollback() # Garante que nada fique pendente
+        raise
+    finally:
+        session.close()
+
+    registro_alertas.rearmar_recorrentes()
+    return alertas_resetados
+
+@medir_bd
+def adicionar_usuario_bd(chat_id: int, nome: str):
+    session = Session()
+    try:
+        session.add(UsuarioPermitido(chat_id=chat_id, nome=nome, timestamp=datetime.datetime.now()))
+        session.commit()
+    finally:
+        session.close()
+
+    recarregar_usuarios_autorizados()
+
+@medir_bd
+def alterar_status_usuario_bd(chat_id: int, ativo: bool) -> bool:
+    session = Session()
+    try:
+        usuario = session.query(UsuarioPermitido).filter_by(chat_id=chat_id).first()
+        if usuario is None:
+            return False
+
+        usuario.ativo = ativo
+        session.commit()
+    finally:
+        session.close()
+
+    recarregar_usuarios_autorizados()
+    return True
+
+@medir_bd
+def listar_usuarios_bd() -> list:
+    session = Session()
+    try:
+        return session.query(UsuarioPermitido).all()
+    finally:
+        session.close()
+
 #Irá responder ao /start e mostrar o ID do usuário
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -162,48 +2144,22 @@ async def set_alerta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         #define se o argumento foi recorrente
         is_recorrente = True if recorrencia_arg == 'recorrente' else False
 
-        if not ticker_existe(ticker):
-            await update.message.reply_text(f"Opa meu/minha lídeeeer, não encontrei esse ticker não, tem certeza que {ticker} está digitado corretamente?")
-            return
-
         if tipo_alerta not in tipos_alerta:
             await update.message.reply_text("Tipo de alerta inválido. Use 'compra' ou 'venda'.")
             return
-        
-        session = Session()
 
-        #Verifica se já existe um alerta para o mesmo ticket e tipo
-        alerta_existente = session.query(Alerta).filter_by(ticker=ticker, tipo=tipo_alerta, chat_id=user_id).first()
+        if not await em_executor(executor_rede, ticker_existe, ticker):
+            await update.message.reply_text(f"Opa meu/minha lídeeeer, não encontrei esse ticker não, tem certeza que {ticker} está digitado corretamente?")
+            return
 
-        if alerta_existente:
-            #Edita o alerta caso já exista
-            alerta_existente.valor = valor
-            alerta_existente.disparado = 'N' #Rearmar o alerta
-            alerta_existente.timestamp = datetime.datetime.now()
-            alerta_existente.tkt_edt = True
-            alerta_existente.recorrencia = is_recorrente
+        editado = await em_executor(executor_bd, gravar_alerta, user_id, ticker, tipo_alerta, valor, is_recorrente)
 
-            recorrencia_msg = " [RECORRENTE - Reseta Diariamente]" if is_recorrente else ""
+        recorrencia_msg = " [RECORRENTE - Reseta Diariamente]" if is_recorrente else ""
+        if editado:
             mensagem = f"Alerta **editado** para: {ticker} \nTipo: {tipo_alerta} \nNovo Valor: **R$ {valor:.2f}**{recorrencia_msg}"
-
         else:
-            #Cria novo alerta
-            novo_alerta = Alerta(
-                ticker=ticker, 
-                tipo=tipo_alerta, 
-                valor=valor, 
-                chat_id=user_id, 
-                timestamp=datetime.datetime.now(),
-                recorrencia=is_recorrente
-            )
-            session.add(novo_alerta)
-
-            recorrencia_msg = " [RECORRENTE - Reseta Diariamente]" if is_recorrente else ""
             mensagem = f"Alerta **criado** para: {ticker} \nTipo: {tipo_alerta} \nValor: R$ {valor:.2f}{recorrencia_msg}"
 
-        session.commit()
-        session.close()
-
         await update.message.reply_text(mensagem, parse_mode='Markdown')
     
     except (ValueError, IndexError):
@@ -215,47 +2171,273 @@ async def set_alerta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         )
         logger.warning(f"Comando /set inválido de user_id: {user_id}. Args: {context.args}")
         
-async def listar_alertas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    #Lista todos os alertas criados pelo usuário
+#/import e /export
+#Uma linha por alerta, no formato do /set: "PETR4 compra 30.50 [recorrente]" (também aceita vírgula,
+#ponto e vírgula ou tab como separador, que é o CSV do /export)
+def ler_linhas_importacao(texto: str) -> tuple[list, list]:
+    #Retorna ([(número, ticker, tipo, valor, recorrente)], [(número, linha, erro)])
+    validas, erros = [], []
+    for numero, linha in enumerate(texto.splitlines(), 1):
+        linha = linha.strip()
+        if not linha or linha.startswith('#'):
+            continue
+        campos = [c for c in re.split(r"[,;\s]+", linha) if c]
+        if campos[0].lower() == "ticker": #cabeçalho do /export
+            continue
+        if len(campos) not in (3, 4):
+            erros.append((numero, linha, "esperado: ticker tipo valor [recorrente]"))
+            continue
+
+        ticker, tipo_alerta = sanitizar_ticker(campos[0]), campos[1].lower()
+        try:
+            valor = float(campos[2])
+        except ValueError:
+            valor = math.nan
+        if tipo_alerta not in tipos_alerta:
+            erros.append((numero, linha, "tipo deve ser compra ou venda"))
+        elif not (math.isfinite(valor) and valor > 0):
+            erros.append((numero, linha, "valor inválido (use ponto como separador decimal)"))
+        elif len(campos) == 4 and campos[3].lower() != 'recorrente':
+            erros.append((numero, linha, "o 4º campo só pode ser 'recorrente'"))
+        else:
+            validas.append((numero, ticker, tipo_alerta, valor, len(campos) == 4))
+    return validas, erros
+
+async def importar_alertas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #Arquivo com a legenda /import, /import respondendo a um arquivo ou as linhas na própria mensagem
     user_id = update.effective_user.id
 
     if not usuario_autorizado(user_id):
         await update.message.reply_text("Oxe oxe, tu não está autorizado(a) a usar esse bot não, fale com o administrador.")
+        logger.warning(f"Tentativa de acesso não autorizada de user_id: {user_id}")
         return
 
-    session = Session()
-    alertas = session.query(Alerta).filter_by(chat_id=user_id).all()
-    session.close()
+    mensagem = update.message
+    documento = mensagem.document or (mensagem.reply_to_message.document if mensagem.reply_to_message else None)
+    if documento is not None:
+        if documento.file_size and documento.file_size > max_bytes_importacao:
+            await mensagem.reply_text(f"Arquivo grande demais, o limite é {max_bytes_importacao // 1024} KB.")
+            return
+        arquivo = await documento.get_file()
+        texto = bytes(await arquivo.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+    else:
+        partes = (mensagem.text or "").split(maxsplit=1)
+        texto = partes[1] if len(partes) > 1 else ""
+
+    validas, erros = ler_linhas_importacao(texto)
+    if not validas and not erros:
+        await mensagem.reply_text(
+            "Envie um arquivo .csv/.txt com a legenda /import (ou as linhas depois do comando), um alerta por linha:\n\n"
+            "PETR4 compra 30.50\nVALE3 venda 70 recorrente"
+        )
+        return
+    if len(validas) + len(erros) > max_linhas_importacao:
+        await mensagem.reply_text(f"São no máximo {max_linhas_importacao} alertas por importação.")
+        return
+
+    #Mesmo ticker e tipo repetidos: vale a última linha
+    ultimas = {}
+    for linha in validas:
+        ultimas[(linha[1], linha[2])] = linha
+    for linha in validas:
+        if ultimas[(linha[1], linha[2])] is not linha:
+            erros.append((linha[0], f"{linha[1]} {linha[2]}", f"repetido, vale a linha {ultimas[(linha[1], linha[2])][0]}"))
+    validas = list(ultimas.values())
+
+    #Todos os tickers distintos validados de uma vez e todos os alertas gravados numa transação
+    existencia = await em_executor(executor_rede, catalogo_tickers.existem, [linha[1] for linha in validas])
+    aceitas = []
+    for linha in validas:
+        valido = existencia.get(linha[1])
+        if valido:
+            aceitas.append(linha)
+        elif valido is None:
+            erros.append((linha[0], f"{linha[1]} {linha[2]}", "não consegui validar o ticker agora, tente de novo"))
+        else:
+            erros.append((linha[0], f"{linha[1]} {linha[2]}", f"ticker {linha[1]} não encontrado"))
+
+    try:
+        editados = await em_executor(executor_bd, gravar_alertas_lote, user_id, aceitas) if aceitas else {}
+    except Exception as e:
+        logger.error(f"Erro ao importar alertas de user_id {user_id}: {e}")
+        await mensagem.reply_text(f"Vish, deu ruim ao gravar os alertas, nada foi importado. Erro: {e}")
+        return
 
+    resultados = [
+        (numero, "editado" if editados[(ticker, tipo_alerta)] else "criado", f"{ticker} {tipo_alerta} {valor:.2f}{' recorrente' if recorrente else ''}")
+        for numero, ticker, tipo_alerta, valor, recorrente in aceitas
+    ] + [(numero, "erro", f"{linha}: {erro}") for numero, linha, erro in erros]
+    resultados.sort()
+
+    num_editados = sum(editados.values())
+    resumo = f"📥 Importação concluída: {len(aceitas) - num_editados} criados, {num_editados} editados, {len(erros)} com erro."
+    linhas_erro = [f"Linha {numero}: {detalhe[:150]}\n" for numero, situacao, detalhe in resultados if situacao == "erro"]
+    if linhas_erro:
+        resumo += "\n\n" + "".join(linhas_erro[:20]) + (f"... e mais {len(linhas_erro) - 20}\n" if len(linhas_erro) > 20 else "")
+    logger.info(f"/import de user_id {user_id}: {len(aceitas)} gravados ({num_editados} edições), {len(erros)} erros.")
+
+    #Sem parse_mode: as linhas do usuário podem ter caracteres de Markdown
+    await mensagem.reply_text(resumo)
+    if len(resultados) > 20:
+        relatorio = "linha,resultado,detalhe\n" + "".join(
+            f"{numero},{situacao}," + '"' + detalhe.replace('"', '""') + '"\n' for numero, situacao, detalhe in resultados
+        )
+        await mensagem.reply_document(document=relatorio.encode('utf-8'), filename="resultado_importacao.csv")
+
+async def exportar_alertas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #CSV com os alertas do usuário, no formato aceito pelo /import
+    user_id = update.effective_user.id
+
+    if not usuario_autorizado(user_id):
+        await update.message.reply_text("Oxe oxe, tu não está autorizado(a) a usar esse bot não, fale com o administrador.")
+        return
+
+    alertas = registro_alertas.alertas_do_chat(user_id)
     if not alertas:
         await update.message.reply_text("Nenhum alerta criado até então.")
         return
-    
-    mensagem = "**📋 Segue seus alertas criados consagrado(a):**\n\n"
-    mensagem += "```\n" # Inicia bloco monospace para alinhamento
-    for a in alertas:
-        # Emojis e Formatação
-        status_emoji = "✅" if a.disparado == 'N' else "🔔"
-        status_texto = "Ativo" if a.disparado == 'N' else "Disparado"
-        
-        acao_emoji = "📈" if a.tipo == "compra" else "💰"
-        acao_texto = "COMPRA" if a.tipo == "compra" else "VENDA"
-        
-        recorrencia_emoji = "🔁" if a.recorrencia == True else "👤"
-        recorrencia_texto = "Recorrente" if a.recorrencia == True else "Manual"
-        
-        # Constrói o bloco de exibição elegante
-        ticker_limpo = a.ticker.replace('.SA', '')
-        
-        mensagem += f"{recorrencia_emoji} {ticker_limpo:<7} {acao_emoji} {acao_texto:<6}\n"
-        
-        mensagem += f"  Alvo: R$ {a.valor:6.2f}\n"
-        mensagem += f"  {status_emoji} Status: {status_texto} ({recorrencia_texto})\n"
-        mensagem += "--------------------------------\n"
 
-    mensagem += "```" # Fecha bloco monospace
-    
-    await update.message.reply_text(mensagem, parse_mode='Markdown')
+    csv = "ticker,tipo,valor,recorrencia\n" + "".join(
+        f"{a.ticker.replace('.SA', '')},{a.tipo},{a.valor},{'recorrente' if a.recorrencia else ''}\n" for a in alertas
+    )
+    await update.message.reply_document(
+        document=csv.encode('utf-8'),
+        filename="alertas_b3.csv",
+        caption=f"{len(alertas)} alertas. Para restaurar ou copiar para outra conta, envie o arquivo com a legenda /import.",
+    )
+
+#/list paginado
+#Filtros opcionais: /list PETR4, /list ativos, /list PETR4 disparados
+filtros_status_lista = {"ativos": 'N', "ativo": 'N', "disparados": 'S', "disparado": 'S'}
+
+def ler_filtros_lista(args: list) -> tuple[str, str]:
+    ticker, status = "", ""
+    for arg in args:
+        if arg.lower() in filtros_status_lista:
+            status = filtros_status_lista[arg.lower()]
+        else:
+            ticker = sanitizar_ticker(arg)
+    return ticker, status
+
+def renderizar_alerta_lista(a: RegistroAlerta) -> str:
+    # Emojis e Formatação
+    status_emoji = "✅" if a.disparado == 'N' else "🔔"
+    status_texto = "Ativo" if a.disparado == 'N' else "Disparado"
+
+    acao_emoji = "📈" if a.tipo == "compra" else "💰"
+    acao_texto = "COMPRA" if a.tipo == "compra" else "VENDA"
+
+    recorrencia_emoji = "🔁" if a.recorrencia == True else "👤"
+    recorrencia_texto = "Recorrente" if a.recorrencia == True else "Manual"
+
+    # Constrói o bloco de exibição elegante
+    ticker_limpo = a.ticker.replace('.SA', '')
+
+    return (
+        f"{recorrencia_emoji} {ticker_limpo:<7} {acao_emoji} {acao_texto:<6}\n"
+        f"  Alvo: R$ {a.valor:6.2f}\n"
+        f"  {status_emoji} Status: {status_texto} ({recorrencia_texto})\n"
+        "--------------------------------\n"
+    )
+
+def renderizar_paginas_lista(alertas: list, ticker: str, status: str) -> list:
+    filtros = [t for t in (ticker.replace('.SA', ''), {'N': "ativos", 'S': "disparados"}.get(status, "")) if t]
+    cabecalho = "**📋 Segue seus alertas criados consagrado(a):**"
+    if filtros:
+        cabecalho += f" ({', '.join(filtros)})"
+
+    paginas = []
+    for inicio in range(0, len(alertas), alertas_por_pagina):
+        itens = [renderizar_alerta_lista(a) for a in alertas[inicio:inicio + alertas_por_pagina]]
+        # Bloco monospace para alinhamento
+        paginas.append(f"{cabecalho}\n\n```\n{''.join(itens)}```")
+    return paginas
+
+class CacheListas:
+    #Páginas renderizadas por (chat, filtros), válidas enquanto a versão do chat no registro não mudar.
+    #Só é usado no loop do bot (handlers), então não precisa de lock.
+    def __init__(self, max_entradas: int = max_listas_em_cache):
+        self.max_entradas = max_entradas
+        self._paginas = {} #(chat_id, ticker, status) -> (versão do chat, [páginas]); ordem = uso (LRU)
+
+    def paginas(self, chat_id: int, ticker: str = "", status: str = "") -> list:
+        chave = (chat_id, ticker, status)
+        versao = registro_alertas.versao_chat(chat_id) #lida antes dos alertas: se mudar no meio, a próxima re-renderiza
+        entrada = self._paginas.pop(chave, None)
+        if entrada is None or entrada[0] != versao:
+            alertas = [
+                a for a in registro_alertas.alertas_do_chat(chat_id)
+                if (not ticker or a.ticker == ticker) and (not status or a.disparado == status)
+            ]
+            entrada = (versao, renderizar_paginas_lista(alertas, ticker, status))
+
+        self._paginas[chave] = entrada
+        if len(self._paginas) > self.max_entradas:
+            del self._paginas[next(iter(self._paginas))]
+        return entrada[1]
+
+cache_listas = CacheListas()
+
+def teclado_lista(pagina: int, total: int, ticker: str, status: str):
+    if total <= 1:
+        return None
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    def dados(p: int) -> str:
+        return f"LS:{p}:{status}:{ticker}" #callback_data tem no máximo 64 bytes
+
+    botoes = []
+    if pagina > 0:
+        botoes.append(InlineKeyboardButton("⬅️", callback_data=dados(pagina - 1)))
+    botoes.append(InlineKeyboardButton(f"{pagina + 1}/{total}", callback_data=dados(pagina)))
+    if pagina < total - 1:
+        botoes.append(InlineKeyboardButton("➡️", callback_data=dados(pagina + 1)))
+    return InlineKeyboardMarkup([botoes])
+
+async def listar_alertas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #Lista os alertas criados pelo usuário, em páginas
+    user_id = update.effective_user.id
+
+    if not usuario_autorizado(user_id):
+        await update.message.reply_text("Oxe oxe, tu não está autorizado(a) a usar esse bot não, fale com o administrador.")
+        return
+
+    #Lido do registro em memória, sem ir ao BD
+    ticker, status = ler_filtros_lista(context.args or [])
+    paginas = cache_listas.paginas(user_id, ticker, status)
+
+    if not paginas:
+        if ticker or status:
+            await update.message.reply_text("Nenhum alerta encontrado com esse filtro.")
+        else:
+            await update.message.reply_text("Nenhum alerta criado até então.")
+        return
+
+    await update.message.reply_text(paginas[0], parse_mode='Markdown', reply_markup=teclado_lista(0, len(paginas), ticker, status))
+
+async def navegar_lista(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #Botões ⬅️/➡️ do /list: edita a mesma mensagem com a página pedida
+    from telegram.error import BadRequest
+
+    query = update.callback_query
+    await query.answer()
+
+    user_id = query.from_user.id
+    if not usuario_autorizado(user_id):
+        return
+
+    _, pagina, status, ticker = query.data.split(":", 3)
+    paginas = cache_listas.paginas(user_id, ticker, status)
+    if not paginas:
+        await query.edit_message_text("Nenhum alerta encontrado com esse filtro.")
+        return
+
+    pagina = max(0, min(int(pagina), len(paginas) - 1)) #a lista pode ter encolhido desde o envio
+    try:
+        await query.edit_message_text(paginas[pagina], parse_mode='Markdown', reply_markup=teclado_lista(pagina, len(paginas), ticker, status))
+    except BadRequest as e:
+        if "not modified" not in str(e): #botão da página atual sem mudanças
+            raise
 
 async def remover_alerta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     #Remover alerta para um ticket e tipo
@@ -265,6 +2447,7 @@ async def remover_alerta(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Oxe oxe, tu não está autorizado(a) a usar esse bot não, fale com o administrador.")
         return
     if context.args and context.args[0].lower() == 'all':
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
         query = "Maaa Rapaz, tu quer remover todos os alertas? Certeza disso? \n\n Se sim, clica no botão abaixo."
 
@@ -282,18 +2465,10 @@ async def remover_alerta(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         ticker = sanitizar_ticker(ticker)
         tipos_alerta = tipos_alerta.lower()
 
-        session = Session()
-
-        alerta_a_remover = session.query(Alerta).filter_by(ticker=ticker, tipo=tipos_alerta, chat_id=user_id).first()
-
-        if alerta_a_remover:
-            session.delete(alerta_a_remover)
-            session.commit()
+        if await em_executor(executor_bd, remover_alerta_bd, user_id, ticker, tipos_alerta):
             await update.message.reply_text(f"Pronto minha Autarquia. Alerta removido para {ticker} ({tipos_alerta}).")
         else:
             await update.message.reply_text(f"Vish, Patrão(oa). Não achei nenhum alerta para {ticker} ({tipos_alerta}).")
-        
-        session.close()
 
     except (ValueError, IndexError):
         await update.message.reply_text("Opa Chefe, provavelmente tem algum parametro errado. \n\nTente assim: /rm OIBR3 venda para remover um alerta único ou /rm all para remover todos os alertas.",                                         parse_mode='Markdown')
@@ -317,19 +2492,12 @@ async def confirmar_remocao_todos(update: Update, context: ContextTypes.DEFAULT_
             await query.edit_message_text("Eita, esse botão não é pra você não, só quem pediu a remoção geral pode confirmar.")
             return
     
-    session = Session()
-
     try:
-        count = session.query(Alerta).filter_by(chat_id=user_id).delete(synchronize_session=False)
-        session.commit()
+        count = await em_executor(executor_bd, remover_alertas_do_chat_bd, user_id)
         mensagem = f"Opa guerreiro(a), todos os seus ({count}) alertas foram removidos com sucesso."
     
     except Exception as e:
-        session.rollback()
         mensagem = f"Vish, deu ruim ao tentar remover todos os alertas. Erro: {e}"
-    
-    finally:
-        session.close()
 
     await query.edit_message_text(text=mensagem, parse_mode='Markdown')
 
@@ -349,8 +2517,14 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "**🎯 /set <TICKER> <TIPO> <VALOR> recorrente**\n" \
         "  - Cria um alerta recorrente(É resetado diáriamente às 9h30).\n"
         "  - *Exemplo:* `/set PETR4 compra 30.50 recorrente`\n\n"
-        "**📄 /list**\n"
-        "  - Lista todos os seus alertas ativos e disparados.\n\n"
+        "**📄 /list [TICKER] [ativos|disparados]**\n"
+        "  - Lista seus alertas ativos e disparados, em páginas.\n"
+        "  - *Exemplo:* `/list PETR4` ou `/list disparados`\n\n"
+        "**📥 /import**\n"
+        "  - Cria ou edita vários alertas de uma vez: envie um arquivo .csv/.txt com a legenda /import, uma linha por alerta.\n"
+        "  - *Exemplo de linha:* `PETR4 compra 30.50 recorrente`\n\n"
+        "**📤 /export**\n"
+        "  - Envia seus alertas em um arquivo CSV, no formato aceito pelo /import.\n\n"
         "**🗑️ /rm <TICKER> <TIPO>**\n"
         "  - Remove um alerta específico.\n"
         "  - *Exemplo:* `/rm PETR4 compra`\n\n"
@@ -365,144 +2539,82 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 #Envia alerta diariamente 
 
 async def enviar_cotacoes_fechamento(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not dia_de_pregao(datetime.datetime.now(fuso_b3).date()):
+        logger.info("Hoje não tem pregão na B3, pulando cotações de fechamento.")
+        return
+
     logger.info("Iniciando rotina de cotações de fechamento B3.")
 
-    session = Session()
-    all_alertas = session.query(Alerta).all()
-    session.close()
+    if registro_alertas.invalido:
+        await em_executor(executor_bd, registro_alertas.recarregar)
+
+    alertas_por_usuario = registro_alertas.alertas_por_chat()
 
-    if not all_alertas:
+    if not alertas_por_usuario:
         logger.info("Nenhum alerta cadastrado, pulando verificação.")
         return
 
-    alertas_por_usuario = {}
-    tickers_para_buscar = set()
-    for alerta in all_alertas:
-        alertas_por_usuario.setdefault(alerta.chat_id, []).append(alerta)
-        tickers_para_buscar.add(alerta.ticker)
+    #Uma única busca em lote de barras diárias para todos os tickers (o pool só cobre o que faltar)
+    tickers_list = registro_alertas.tickers()
+    logger.info(f"Buscando cotações para {len(tickers_list)} tickers...")
+    precos_atuais, falhas = await em_executor(executor_rede, cache_cotacoes.obter, "preco", tickers_list, provedor_cotacoes.buscar_precos)
+    #O fechamento anterior vem de graça na mesma busca em lote
+    fechamentos_anteriores = cache_cotacoes.consultar("fechamento_anterior", precos_atuais)
 
-    precos_atuais = {}
+    if falhas:
+        logger.error(f"❌ {len(falhas)} tickers sem cotação de fechamento: {resumir_falhas(falhas)}", extra={"dados": {"evento": "fechamento_falhas", "falhas": agrupar_falhas(falhas)}})
 
-    if tickers_para_buscar:
-        tickers_list = list(tickers_para_buscar)
-        logger.info(f"Buscando cotações para {len(tickers_list)} tickers...")
-        
-        # PRIMEIRO: Tentar método individual mais confiável
-        logger.info("Tentando método individual para cada ticker...")
-        for ticker in tickers_list:
-            try:
-                acao = yf.Ticker(ticker)
-                # Tentar várias fontes de preço
-                info = acao.info
-                preco_atual = (
-                    info.get("regularMarketPrice") or 
-                    info.get("currentPrice") or
-                    info.get("previousClose") or 
-                    info.get("lastPrice")
-                )
-                
-                if preco_atual is not None and preco_atual > 0:
-                    precos_atuais[ticker] = float(preco_atual)
-                    logger.info(f"✅ {ticker}: R$ {preco_atual:.2f} (método individual)")
-                else:
-                    # Tentar histórico diário como fallback
-                    hist = acao.history(period="2d")
-                    if not hist.empty and len(hist) > 0:
-                        preco_atual = float(hist['Close'].iloc[-1])
-                        if preco_atual > 0:
-                            precos_atuais[ticker] = preco_atual
-                            logger.info(f"✅ {ticker}: R$ {preco_atual:.2f} (histórico diário)")
-                        else:
-                            logger.error(f"❌ {ticker}: Preço inválido no histórico")
-                    else:
-                        logger.error(f"❌ {ticker}: Sem dados disponíveis")
-                        
-            except Exception as e:
-                logger.error(f"❌ {ticker}: Erro no método individual - {e}")
-
-        # SEGUNDO: Se poucos preços foram encontrados, tentar download em lote como fallback
-        if len(precos_atuais) < len(tickers_list) * 0.5:  # Se menos de 50% foram encontrados
-            logger.warning("Poucos preços encontrados, tentando download em lote...")
-            try:
-                data = yf.download(
-                    tickers_list, 
-                    period="1d", 
-                    interval="1m", 
-                    group_by='ticker', 
-                    threads=True, 
-                    progress=False,
-                    auto_adjust=False
-                )
+    logger.info(
+        f"📊 RESUMO: {len(precos_atuais)} de {len(tickers_list)} preços obtidos. Cache: {cache_cotacoes.estatisticas()}",
+        extra={"dados": {"evento": "fechamento", "tickers": len(tickers_list), "precos": len(precos_atuais), "falhas": len(falhas)}},
+    )
 
-                # Processar dados do download em lote
-                if isinstance(data.columns, pd.MultiIndex):
-                    for ticker in tickers_list:
-                        if ticker not in precos_atuais:  # Só processar se não foi encontrado antes
-                            try:
-                                if (ticker, 'Close') in data.columns:
-                                    close_series = data[ticker]['Close']
-                                    if not close_series.empty:
-                                        preco = float(close_series.iloc[-1])
-                                        if preco and preco > 0 and not pd.isna(preco):
-                                            precos_atuais[ticker] = preco
-                                            logger.info(f"✅ {ticker}: R$ {preco:.2f} (download lote)")
-                            except Exception as e:
-                                logger.error(f"❌ {ticker}: Erro no download lote - {e}")
-                
-            except Exception as e:
-                logger.error(f"Erro no download em lote: {e}")
+    #Cabeçalho e linha de cada ticker são renderizados uma vez e compartilhados entre os usuários
+    cabecalho = (
+        "**Cotações de Fechamento B3** 📊\n"
+        f"Referência: {datetime.datetime.now(ZoneInfo('America/Sao_Paulo')).strftime('%d/%m/%Y %H:%M')}\n\n"
+    )
+    #Emoji baseado no tipo do alerta: 💰 se o usuário tem alerta de venda no ticker, senão 📈
+    linhas = {}
+    for ticker, preco in precos_atuais.items():
+        anterior = fechamentos_anteriores.get(ticker)
+        variacao = f" ({(preco / anterior - 1) * 100:+.2f}%)" if anterior else ""
+        for emoji in ("📈", "💰"):
+            linhas[(ticker, emoji)] = f"{emoji} **{ticker.replace('.SA', '')}**: R$ {preco:.2f}{variacao}\n"
 
-    logger.info(f"📊 RESUMO: {len(precos_atuais)} de {len(tickers_list)} preços obtidos")
 
     # Envia as cotações para cada usuário
+    sem_preco = 0
     for chat_id, alertas in alertas_por_usuario.items():
         # Agrupar tickers únicos do usuário
-        ativos_detalhes = {}
+        tipos_por_ticker = {}
         for alerta in alertas:
-            ativos_detalhes.setdefault(alerta.ticker, []).append((alerta.tipo, alerta.valor))
-
-        # Construir mensagem
-        mensagem = "**Cotações de Fechamento B3** 📊\n"
-        mensagem += f"Referência: {datetime.datetime.now(ZoneInfo('America/Sao_Paulo')).strftime('%d/%m/%Y %H:%M')}\n\n"
-
-        ativos_com_preco = []
-        for ticker, detalhes in ativos_detalhes.items():
-            preco = precos_atuais.get(ticker)
-            if preco is not None and preco > 0 and not pd.isna(preco):
-                ticker_exibicao = ticker.replace('.SA', '')
-                # Adicionar emoji baseado no tipo do alerta
-                emoji = "📈" if any(tipo == 'compra' for tipo, valor in detalhes) else "📉"
-                if any(tipo == 'venda' for tipo, valor in detalhes):
-                    emoji = "💰"
-                
-                mensagem += f"{emoji} **{ticker_exibicao}**: R$ {preco:.2f}\n"
-                ativos_com_preco.append(ticker)
+            tipos_por_ticker.setdefault(alerta.ticker, set()).add(alerta.tipo)
 
+        partes = [cabecalho]
+        for ticker, tipos in tipos_por_ticker.items():
+            linha = linhas.get((ticker, "💰" if 'venda' in tipos else "📈"))
+            if linha is not None:
+                partes.append(linha)
+
+        ativos_com_preco = len(partes) - 1
         if ativos_com_preco:
-            mensagem += f"\n_Total de {len(ativos_com_preco)} ativos com cotações disponíveis_"
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=mensagem,
-                    parse_mode='Markdown'
-                )
-                logger.info(f"[SUCESSO DE FECHAMENTO] Mensagem com {len(ativos_com_preco)} ativos enviada para {chat_id}.")
-            except Exception as e:
-                logger.error(f"[ERRO DE TELEGRAM] falha ao enviar mensagem de fechamento para {chat_id}: {e}")
+            partes.append(f"\n_Total de {ativos_com_preco} ativos com cotações disponíveis_")
+            fila_envios.enfileirar(chat_id, "".join(partes), descricao=f"fechamento com {ativos_com_preco} ativos")
         else:
-            logger.error(f"[INFO] Nenhum preço válido encontrado para o usuário {chat_id}.")
+            sem_preco += 1
+
+    if sem_preco:
+        logger.warning(f"Fechamento não enviado a {sem_preco} usuários: nenhum dos seus tickers teve preço válido.")
 
 #reseta alerta recorrentes diariamente
-def resetar_alertas_recorrentes(context: ContextTypes.DEFAULT_TYPE):
-    session = Session()
-    try:
-        #busca todos alertas setados como recorrentes
-        alertas_resetados = session.query(Alerta).filter(
-            Alerta.recorrencia == True,
-            Alerta.disparado == 'S'
-        ).update({Alerta.disparado:'N'}, synchronize_session=False)
+async def resetar_alertas_recorrentes(context: ContextTypes.DEFAULT_TYPE):
+    if not dia_de_pregao(datetime.datetime.now(fuso_b3).date()):
+        logger.info("Hoje não tem pregão na B3, pulando reset de alertas recorrentes.")
+        return
 
-        session.commit()
+    try:
+        alertas_resetados = await em_executor(executor_bd, rearmar_recorrentes_bd)
 
         #log de sucesso
         logger.info(f"Rotina de reset concluída. {alertas_resetados} alertas recorrentes rearmados (disparado='N').")
@@ -510,10 +2622,6 @@ def resetar_alertas_recorrentes(context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         # Log de erro
         logger.error(f"Erro CRÍTICO ao tentar resetar alertas recorrentes: {e}")
-        session.rollback() # Garante que nada fique pendente
-
-    finally:
-        session.close()
 
 #ações de amidnistrador
 async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -526,13 +2634,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         novo_id_str, nome = context.args
         novo_id = int(novo_id_str)
 
-        session = Session()
-
-        novo_usuario = UsuarioPermitido(chat_id=novo_id, nome=nome, timestamp=datetime.datetime.now())
-        session.add(novo_usuario)
-
-        session.commit()
-        session.close()
+        await em_executor(executor_bd, adicionar_usuario_bd, novo_id, nome)
 
         await update.message.reply_text(f"Usuário {nome} com chat ID {novo_id} adicionado com sucesso.")
     
@@ -564,18 +2666,11 @@ async def toggle_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             await update.message.reply_text("Status inválido. Use 'ativar' ou 'inativar'.")
             return
         
-        session = Session()
-
-        user_to_update = session.query(UsuarioPermitido).filter_by(chat_id=target_id_str).first()
-
-        if user_to_update:
-            user_to_update.ativo = novo_status
-            session.commit()
+        if await em_executor(executor_bd, alterar_status_usuario_bd, target_id_str, novo_status):
             mensagem = f"Usuário com chat ID {target_id_str} foi {acao} com sucesso."
         else:   
             mensagem = f"Usuário com chat ID {target_id_str} não encontrado."
 
-        session.close()
         await update.message.reply_text(mensagem, parse_mode='Markdown')
     
     except ValueError:
@@ -590,9 +2685,7 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_text("Somente o administrador pode listar os usuários.")
         return
     
-    session = Session()
-    usuarios = session.query(UsuarioPermitido).all()
-    session.close()
+    usuarios = await em_executor(executor_bd, listar_usuarios_bd)
 
     if not usuarios:
         await update.message.reply_text("Nenhum usuário cadastrado.")
@@ -607,6 +2700,55 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
     await update.message.reply_text(mensagem, parse_mode='Markdown')
 
+def formatar_segundos(segundos: float) -> str:
+    if segundos == math.inf:
+        return f">{limites_histograma[-1]}s"
+    return f"{segundos * 1000:.0f}ms" if segundos < 1 else f"{segundos:.1f}s"
+
+def resumo_histograma(nome: str, **rotulos) -> str:
+    h = metricas.histograma(nome, **rotulos)
+    if not h.total:
+        return "sem dados"
+    return f"{h.total}x, média {formatar_segundos(h.media())}, p50 ≤ {formatar_segundos(h.quantil(0.5))}, p99 ≤ {formatar_segundos(h.quantil(0.99))}"
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    #Resumo das métricas do processo (somente admin)
+    user_id_admin = update.effective_user.id
+    if user_id_admin != chat_id_admin:
+        await update.message.reply_text("Somente o administrador pode acessar este comando.")
+        return
+
+    uptime = int(time.monotonic() - metricas.inicio)
+    cache = cache_cotacoes.estatisticas()["preco"]
+    suspensos = saude_yahoo.suspensos()
+    consultas_cache = cache["acertos"] + cache["perdas"]
+    cotacoes_ok = metricas.contador("cotacoes_total", resultado="ok")
+    cotacoes_erro = metricas.contador("cotacoes_total", resultado="erro")
+    envios_erro = metricas.contador("telegram_envios_total") - metricas.contador("telegram_envios_total", resultado="ok")
+
+    mensagem = (
+        "📊 Estatísticas do bot\n\n"
+        f"Em execução há {uptime // 3600}h{uptime % 3600 // 60:02d}m\n"
+        f"Alertas no registro: {registro_alertas.quantidade()}\n"
+        f"Fila de envios: {fila_envios.pendentes} pendentes\n\n"
+        f"🔄 Ciclos do monitor: {resumo_histograma('monitor_ciclo_segundos')}\n"
+        f"📈 Cotações: {cotacoes_ok:.0f} ok, {cotacoes_erro:.0f} erros\n"
+        f"  Requisições: {resumo_histograma('cotacoes_busca_segundos')}\n"
+        f"  Cache de preços: {cache['acertos'] / consultas_cache if consultas_cache else 0:.0%} de acertos\n"
+        f"  Evitadas: {metricas.contador('cotacoes_evitadas_total'):.0f} "
+        f"(disjuntor {'aberto por ' + formatar_duracao(disjuntor_yahoo.restante()) if disjuntor_yahoo.aberto else 'fechado'})\n"
+        f"  Tickers suspensos: {', '.join(t.replace('.SA', '') for t in sorted(suspensos)) or 'nenhum'}\n"
+        f"🔔 Alertas: {metricas.contador('alertas_avaliados_total'):.0f} avaliados, "
+        f"{metricas.contador('alertas_disparados_total'):.0f} disparados, {metricas.contador('alertas_rearmados_total'):.0f} rearmados\n"
+        f"✉️ Telegram: {metricas.contador('telegram_envios_total', resultado='ok'):.0f} enviadas, {envios_erro:.0f} erros\n"
+        f"  Envios: {resumo_histograma('telegram_envio_segundos')}\n"
+        f"🗄 BD: {resumo_histograma('bd_operacao_segundos')}"
+    )
+    if servidor_metricas is not None:
+        mensagem += f"\n\nMétricas completas: http://{host_metricas}:{porta_metricas}/metrics"
+
+    await update.message.reply_text(mensagem)
+
 async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id_admin = update.effective_user.id
 
@@ -624,6 +2766,8 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         "⚙️ /toggle_user <ID> <ativar/inativar>\n"
         "  - Altera o status de acesso de um usuário existente.\n"
         "  - *Exemplo:* `/toggle_user 123456789 inativar`\n\n"
+        "📊 /stats\n"
+        "  - Resumo das métricas: ciclos do monitor, cotações, alertas, envios e BD.\n\n"
         "❓ /admin_help\n"
         "  - Mostra esta lista de comandos administrativos."
     )
@@ -632,123 +2776,767 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
 #Verificar cotações
 
-def monitorar_cotacoes(app: Application, loop):
-    #Loop que rodará em thread separada para monitorar as cotações
-    logger.info("Thread de monitoramento de cotações 24/7 iniciada.")
-
-    while True:
-        try:
-            session = Session()
-            alertas = session.query(Alerta).all()
+def intervalo_por_distancia(distancia: float) -> int:
+    for limite, intervalo in faixas_monitoramento:
+        if distancia <= limite:
+            return intervalo
+    return intevalo_monitoramento
+
+#Agenda de cada ticker: quanto mais perto de um alvo, mais cedo é a próxima busca
+class AgendaMonitoramento:
+    def __init__(self):
+        self._proxima = {} #ticker -> time.monotonic() da próxima busca
+
+    def vencidos(self, tickers: list, agora: float) -> list:
+        #Tickers novos (sem agenda) entram na hora
+        return [t for t in tickers if self._proxima.get(t, 0) <= agora]
+
+    def agendar(self, ticker: str, agora: float, intervalo: float):
+        self._proxima[ticker] = agora + intervalo
+
+    def espera(self, tickers: list, agora: float) -> float:
+        proximas = [self._proxima.get(t, 0) for t in tickers]
+        espera = min(proximas) - agora if proximas else intervalo_minimo_monitoramento
+        return min(max(espera, 1), intervalo_minimo_monitoramento)
+
+    def podar(self, tickers: list):
+        ativos = set(tickers)
+        self._proxima = {t: p for t, p in self._proxima.items() if t in ativos}
+
+#Grava as transições do ciclo: um UPDATE em lote (executemany) e o append no log, na mesma transação.
+#O custo é proporcional ao número de mudanças, não ao de alertas.
+atualizar_estado_alerta = (
+    Alerta.__table__.update()
+    .where(Alerta.__table__.c.id == bindparam('alerta_id'))
+    .values(disparado=bindparam('estado_novo'))
+)
 
-            if not alertas:
-                session.close()
-                time.sleep(intevalo_monitoramento)
-                continue
+@medir_bd
+def gravar_transicoes(transicoes: list):
+    if not transicoes:
+        return
 
-            #Dicionário para agrupar tickets e não efetuar várias buscas
-            tickets_para_buscar = {a.ticker for a in alertas}
-            precos_atuais = {} #Salvará o ticket e o preço atual
+    session = Session()
+    try:
+        session.execute(atualizar_estado_alerta, [{"alerta_id": t["alerta_id"], "estado_novo": t["estado_novo"]} for t in transicoes])
+        session.execute(TransicaoAlerta.__table__.insert(), transicoes)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
 
+#Avalia os preços recebidos, grava as transições e enfileira os avisos; retorna quantos dispararam
+lembrete_alerta_disparado = "Lembre-se: O alerta depois de disparado não funciona mais, caso queira reativá-lo, basta usar o /set com o mesmo ticket e tipo (compra ou venda) que ele será rearmado."
+
+def tamanho_telegram(texto: str) -> int:
+    return len(texto.encode('utf-16-le')) // 2
+
+def dividir_mensagem(cabecalho: str, blocos: list, rodape: str = "", limite: int = limite_mensagem_telegram) -> list:
+    #Junta os blocos no menor número de mensagens; só quebra entre blocos, cada parte repete o cabeçalho
+    mensagens = []
+    atual, tamanho = [], tamanho_telegram(cabecalho)
+    for bloco in blocos:
+        tamanho_bloco = tamanho_telegram(bloco)
+        if atual and tamanho + tamanho_bloco + tamanho_telegram(rodape) > limite:
+            mensagens.append(cabecalho + "".join(atual))
+            atual, tamanho = [], tamanho_telegram(cabecalho)
+        atual.append(bloco)
+        tamanho += tamanho_bloco
+    mensagens.append(cabecalho + "".join(atual) + rodape)
+    return mensagens
+
+def montar_notificacoes(disparos: list) -> list:
+    #disparos: [(assunto, mensagem completa, bloco resumido)] de um chat num ciclo -> [(texto, descrição)]
+    if len(disparos) == 1:
+        assunto, mensagem, _ = disparos[0]
+        return [(f"{assunto}\n\n{mensagem}", assunto)]
+
+    cabecalho = f"🔔 **{len(disparos)} alertas disparados**\n\n"
+    partes = dividir_mensagem(cabecalho, [bloco for _, _, bloco in disparos], f"\n{lembrete_alerta_disparado}")
+    return [(texto, f"{len(disparos)} alertas disparados ({i}/{len(partes)})") for i, texto in enumerate(partes, 1)]
+
+def processar_precos(precos_atuais: dict) -> int:
+    inicio = time.perf_counter()
+
+    #Só lê o BD na inicialização ou depois de um erro; no resto o registro é mantido pelos handlers
+    if registro_alertas.invalido:
+        registro_alertas.recarregar()
+
+    #Verifica alertas: o índice devolve só os que cruzaram o alvo ou rearmaram
+    disparos_por_chat = {} #chat_id -> [(ticker, assunto, mensagem, bloco)]; vira uma mensagem por chat no fim
+    total_disparados = 0
+    transicoes = []
+    agora = datetime.datetime.now()
+    avaliados = rearmados_total = 0
+    tickers_rearmados = []
+
+    for ticker, cotacao in precos_atuais.items():
+        avaliados += registro_alertas.quantidade(ticker)
+        #Barras de 1 minuto: compra contra as mínimas, venda contra as máximas; senão só o preço atual
+        if isinstance(cotacao, Barras):
+            preco_atual = cotacao.fechamento
+            disparados, rearmados = registro_alertas.avaliar_barras(ticker, cotacao)
+        else:
+            preco_atual = cotacao
+            disparados, rearmados = registro_alertas.avaliar(ticker, preco_atual)
+            disparados = [(alerta, None) for alerta in disparados]
+        #Alerta editado ou removido por um handler durante a avaliação: nem aviso nem transição
+        disparados = [(alerta, indice) for alerta, indice in disparados if registro_alertas.get(alerta.id) is alerta]
+        rearmados = [alerta for alerta in rearmados if registro_alertas.get(alerta.id) is alerta]
+        rearmados_total += len(rearmados)
+        if rearmados:
+            tickers_rearmados.append(ticker)
+
+        precos_cruzamento = {}
+        for alerta, indice in disparados:
+            tipo, valor, chat_id = alerta.tipo, alerta.valor, alerta.chat_id
+            cruzamento = ""
+            if indice is not None:
+                horario = cotacao.horarios[indice]
+                horario = (horario.tz_convert(fuso_b3) if horario.tzinfo else horario).strftime('%H:%M')
+                if tipo == 'compra':
+                    preco_cruzamento = float(cotacao.minimas[indice])
+                    cruzamento = f"\nMínima às {horario}: R$ {preco_cruzamento:.2f}"
+                else:
+                    preco_cruzamento = float(cotacao.maximas[indice])
+                    cruzamento = f"\nMáxima às {horario}: R$ {preco_cruzamento:.2f}"
+                precos_cruzamento[alerta.id] = preco_cruzamento
+            if tipo == 'compra':
+                assunto = f"**COMPRA** - {ticker} @ R$ {preco_atual:.2f}"
+                mensagem = f"Bora compraaaaaar, preço alvo para foi atingido! \n\nAlvo: R$ {valor:.2f}{cruzamento} \nPreço atual: R$ {preco_atual:.2f}\n\n\n{lembrete_alerta_disparado}"
+            else:
+                assunto = f"**VENDA** - {ticker} @ R$ {preco_atual:.2f}"
+                mensagem = f"Vamosssss seu(ua) ganancioso(a), venda! venda! venda! $$$$$ \n\n Preço alvo para foi atingido! \n\nAlvo: R$ {valor:.2f}{cruzamento} \nPreço atual: R$ {preco_atual:.2f}\n\n\n{lembrete_alerta_disparado}"
+
+            bloco = f"{assunto}\nAlvo: R$ {valor:.2f}{cruzamento}\n\n"
+            disparos_por_chat.setdefault(chat_id, []).append((ticker, assunto, mensagem, bloco))
+            total_disparados += 1
+
+        disparados = [alerta for alerta, _ in disparados]
+        for alertas, anterior, novo in ((disparados, 'N', 'S'), (rearmados, 'S', 'N')):
+            for a in alertas:
+                transicoes.append({
+                    "alerta_id": a.id, "chat_id": a.chat_id, "ticker": a.ticker, "tipo": a.tipo, "valor": a.valor,
+                    "preco": precos_cruzamento.get(a.id, preco_atual), "estado_anterior": anterior, "estado_novo": novo,
+                    "origem": "monitor", "ocorrido_em": agora,
+                })
+
+    #Modo shards: um shard perdido durante a rodada já é avaliado pelo novo dono com o estado dele;
+    #gravar ou avisar daqui duplicaria a notificação. O registro é recarregado na próxima sincronização.
+    if coordenador_shards is not None:
+        perdidos = {ticker for ticker in precos_atuais if not coordenador_shards.possui(ticker)}
+        if perdidos:
+            logger.warning(f"{len(perdidos)} tickers mudaram de dono durante a rodada; transições e avisos deles descartados.")
+            registro_alertas.invalidar()
+            transicoes = [t for t in transicoes if t["ticker"] not in perdidos]
+            for chat_id, disparos in list(disparos_por_chat.items()):
+                disparos = [d for d in disparos if d[0] not in perdidos]
+                if disparos:
+                    disparos_por_chat[chat_id] = disparos
+                else:
+                    del disparos_por_chat[chat_id]
+            total_disparados = sum(len(disparos) for disparos in disparos_por_chat.values())
+
+    gravar_transicoes(transicoes)
+
+    #Entrega fica com a fila de envios (concorrente e respeitando os limites do Telegram).
+    #Um resumo por chat: os envios do ciclo crescem com os usuários afetados, não com os alertas disparados
+    notificacoes = 0
+    for chat_id, disparos in disparos_por_chat.items():
+        for texto, descricao in montar_notificacoes([disparo[1:] for disparo in disparos]):
+            fila_envios.enfileirar(chat_id, texto, descricao=descricao)
+            notificacoes += 1
+
+    if rearmados_total:
+        logger.info(f"{rearmados_total} alertas rearmados em {len(tickers_rearmados)} tickers: {', '.join(tickers_rearmados[:10])}{' ...' if len(tickers_rearmados) > 10 else ''}")
+
+    metricas.incrementar("alertas_avaliados_total", avaliados)
+    metricas.incrementar("alertas_disparados_total", total_disparados)
+    metricas.incrementar("alertas_rearmados_total", rearmados_total)
+    metricas.incrementar("notificacoes_alerta_total", notificacoes)
+    metricas.observar("processamento_precos_segundos", time.perf_counter() - inicio)
+    return total_disparados
+
+#Fontes de cotações
+#Uma fonte entrega lotes {ticker: preço} para o motor de alertas (processar_precos) assim que os tem.
+#executar() bloqueia a thread do monitor até parar() ou até a fonte se esgotar (processo worker);
+#executar_async() roda no loop do bot e termina quando a task é cancelada.
+class FonteCotacoes:
+    nome = "base"
+
+    def __init__(self):
+        self._parar = threading.Event()
+
+    def executar(self, entregar):
+        raise NotImplementedError
+
+    async def executar_async(self, entregar, executor: ThreadPoolExecutor):
+        #Fontes bloqueantes por natureza (replay, servidor TCP) rodam inteiras no executor
+        try:
+            await em_executor(executor, self.executar, entregar)
+        except asyncio.CancelledError:
+            self.parar() #libera a thread do executor
+            raise
+
+    def parar(self):
+        self._parar.set()
+
+    def esperar(self, segundos: float) -> bool:
+        #Retorna True se a fonte foi parada durante a espera
+        return self._parar.wait(segundos)
+
+#Polling no Yahoo, respeitando o pregão e a agenda adaptativa por ticker
+class FontePollingYahoo(FonteCotacoes):
+    nome = "yahoo"
+
+    def __init__(self, provedor: ProvedorCotacoes | None = None, coordenador: CoordenadorShards | None = None):
+        super().__init__()
+        self.provedor = provedor or provedor_cotacoes
+        self.coordenador = coordenador #modo shards: só monitora os tickers dos shards deste processo
+        self.agenda = AgendaMonitoramento()
+        self._ultima_barra = {} #ticker -> horário da última barra já avaliada
+
+    def tickers(self) -> list:
+        if self.coordenador is None:
+            return registro_alertas.tickers()
+        self.coordenador.sincronizar_registro()
+        return [t for t in registro_alertas.tickers() if self.coordenador.possui(t)]
+
+    def buscar(self, tickers: list) -> tuple[dict, dict]:
+        #Barras novas de 1 minuto (pegam toques no alvo entre uma busca e outra); o que vier
+        #sem barras cai no preço atual via cache compartilhado
+        try:
+            with metricas.cronometro("cotacoes_busca_segundos", fonte=self.provedor.nome, metodo="barras"):
+                todas_barras = self.provedor.obter_barras(tickers)
+        except Exception as e:
+            logger.warning(f"Falha na busca de barras, usando só o preço atual: {e}")
+            todas_barras = {}
+        metricas.incrementar("cotacoes_total", len(todas_barras), fonte=self.provedor.nome, metodo="barras", resultado="ok")
+
+        cotacoes = {}
+        for ticker, barras in todas_barras.items():
+            if ticker in self._ultima_barra and self._ultima_barra[ticker].date() != barras.horarios[-1].date():
+                del self._ultima_barra[ticker] #virou o dia
+            #Ticker visto pela primeira vez (início, dia novo ou shard assumido de outro processo): só a
+            #última barra, para não notificar de novo cruzamentos antigos de alertas já rearmados
+            novas = barras.desde(self._ultima_barra.get(ticker, barras.horarios[-2] if len(barras) > 1 else None))
+            self._ultima_barra[ticker] = barras.horarios[-1]
+            cotacoes[ticker] = novas if len(novas) else barras.fechamento
+        cache_cotacoes.guardar("preco", {ticker: barras.fechamento for ticker, barras in todas_barras.items()})
+
+        faltantes = [t for t in tickers if t not in cotacoes]
+        precos, falhas = cache_cotacoes.obter("preco", faltantes, self.provedor.buscar_precos)
+        cotacoes.update(precos)
+        return cotacoes, falhas
+
+    def ciclo(self, entregar) -> float:
+        #Uma rodada de busca e avaliação (bloqueante); retorna quantos segundos esperar até a próxima
+        #Fora do pregão os preços não mudam: dorme até a próxima abertura
+        espera_abertura = segundos_ate_abertura()
+        if espera_abertura > 0:
+            logger.info(f"Pregão fechado, monitoramento pausado por {espera_abertura / 3600:.1f}h.")
+            return espera_abertura
+
+        tickers = self.tickers()
+        agora = time.monotonic()
+
+        #Fonte fora do ar ou limitando: nenhuma requisição até o disjuntor liberar o teste
+        fechado_por = self.provedor.disjuntor.restante()
+        if fechado_por > 0:
+            logger.warning(f"Cotações de {self.provedor.nome} indisponíveis, monitor pausado por {fechado_por:.0f}s.")
+            return min(fechado_por, self.coordenador.ttl / 3) if self.coordenador is not None else fechado_por
+
+        #Tickers suspensos por falhas seguidas voltam à agenda só no fim da suspensão
+        tickets_para_buscar, suspensos = self.provedor.saude.separar(self.agenda.vencidos(tickers, agora))
+        for ticker, restante in suspensos.items():
+            self.agenda.agendar(ticker, agora, restante)
+
+        if tickets_para_buscar:
+            inicio_ciclo = agora
+
+            #Busca as cotações vencidas de uma vez (barras em lote, depois preço para o que faltar)
+            with metricas.cronometro("monitor_ciclo_segundos"):
+                cotacoes, falhas = self.buscar(tickets_para_buscar)
+
+                if falhas:
+                    logger.error(f"Erro ao buscar cotação de {len(falhas)} tickers: {resumir_falhas(falhas)}", extra={"dados": {"evento": "ciclo_falhas", "falhas": agrupar_falhas(falhas)}})
+
+                total_disparados = entregar(cotacoes)
+
+            avisar_tickers_suspensos(self.provedor.saude.retirar_novos_suspensos())
+            agora = time.monotonic()
             for ticker in tickets_para_buscar:
-                try:
-                    #busca a cotação mais recente
-                    info = yf.Ticker(ticker).info
-                    preco_atual = info.get("regularMarketPrice") #lastPrice ou close \\ são opções
-
-                    if preco_atual is not None and preco_atual > 0:
-                        precos_atuais[ticker] = preco_atual
-                    
-                except Exception as e:
-                    logger.error(f"Erro ao buscar cotação de {ticker}: {e}")
-
-
-            #Verifica alertas
-            alertas_disparados = []
-
-            for alerta in alertas:
-                preco_atual = precos_atuais.get(alerta.ticker)
+                preco = cotacoes.get(ticker)
+                preco = preco.fechamento if isinstance(preco, Barras) else preco
+                distancia = registro_alertas.distancia_alvo(ticker, preco) if preco else math.inf
+                self.agenda.agendar(ticker, agora, intervalo_por_distancia(distancia))
+            self.agenda.podar(tickers)
+
+            logger.info(
+                f"Ciclo de monitoramento: {len(tickets_para_buscar)} de {len(tickers)} tickers ({len(falhas)} falhas, {total_disparados} disparos) em {agora - inicio_ciclo:.1f}s.",
+                extra={"dados": {
+                    "evento": "ciclo_monitor", "buscados": len(tickets_para_buscar), "tickers": len(tickers), "cotacoes": len(cotacoes),
+                    "falhas": len(falhas), "suspensos": len(suspensos), "disparos": total_disparados, "duracao_s": round(agora - inicio_ciclo, 3),
+                }},
+            )
 
-                if preco_atual is None:
+        #Acorda na próxima busca agendada (ou no intervalo mínimo, para pegar alertas novos);
+        #no modo shards também a cada renovação dos leases, para começar logo os shards assumidos
+        espera = self.agenda.espera(tickers, time.monotonic())
+        if self.coordenador is not None:
+            espera = min(espera, self.coordenador.ttl / 3)
+        return espera
+
+    def executar(self, entregar):
+        while not self._parar.is_set():
+            self._parar.wait(self.ciclo(entregar))
+
+    async def executar_async(self, entregar, executor: ThreadPoolExecutor):
+        #Só a rodada vai para o executor; a espera é um sleep do loop, cancelado na hora no desligamento
+        while not self._parar.is_set():
+            espera = await em_executor(executor, self.ciclo, entregar)
+            await asyncio.sleep(espera)
+
+def avisar_tickers_suspensos(suspensos: list):
+    #Avisa o admin dos tickers que deixaram de ser buscados e de quantos alertas ficam sem monitoramento
+    if not suspensos:
+        return
+    linhas = []
+    for ticker, falhas, segundos, motivo in suspensos:
+        alertas = registro_alertas.quantidade(ticker)
+        logger.warning(f"Ticker {ticker} suspenso por {formatar_duracao(segundos)} após {falhas} falhas seguidas ({motivo}); {alertas} alertas afetados.")
+        linhas.append(f"• {ticker.replace('.SA', '')}: {alertas} alertas, {falhas} falhas seguidas ({motivo}), nova tentativa em {formatar_duracao(segundos)}\n")
+
+    if chat_id_admin:
+        for texto in dividir_mensagem("⏸ Tickers suspensos por falhas seguidas na busca de cotações:\n\n", linhas):
+            fila_envios.enfileirar(chat_id_admin, texto, parse_mode=None, descricao="tickers suspensos")
+
+#Linha de tick do replay: "PETR4,31.25" ou "PETR4 31.25" (linhas vazias e com # são ignoradas)
+def ler_tick(linha: str) -> tuple[str, float] | None:
+    linha = linha.strip()
+    if not linha or linha.startswith('#'):
+        return None
+    ticker, preco = re.split(r"[,;\s]+", linha)[:2]
+    return sanitizar_ticker(ticker), float(preco)
+
+#Replay de um arquivo de ticks, útil para testar o motor sem rede
+class FonteArquivo(FonteCotacoes):
+    nome = "arquivo"
+
+    def __init__(self, caminho: str, intervalo: float = 0):
+        super().__init__()
+        self.caminho = caminho
+        self.intervalo = intervalo #pausa entre ticks, para simular o ritmo do mercado
+
+    def executar(self, entregar):
+        with open(self.caminho, encoding='utf-8') as arquivo:
+            for numero, linha in enumerate(arquivo, 1):
+                if self._parar.is_set():
+                    return
+                try:
+                    tick = ler_tick(linha)
+                except ValueError:
+                    logger.warning(f"Linha {numero} inválida em {self.caminho}: {linha.strip()}")
+                    metricas.incrementar("cotacoes_total", fonte=self.nome, metodo="tick", resultado="erro")
                     continue
-                    
-                #rearme   
-                if alerta.disparado == 'S':
-                    if alerta.tipo == 'compra' and preco_atual > alerta.valor:
-                        alerta.disparado = 'N'
-                        logger.info(f"Rearmando alerta de compra para {alerta.ticker}. Está acima do alvo.")
-
-                    elif alerta.tipo == 'venda' and preco_atual < alerta.valor:
-                        alerta.disparado = 'N'
-                        logger.info(f"Rearmando alerta de venda para {alerta.ticker}. Está abaixo do alvo.")
-                #Caso esteja na zona de alerta e disparado
-                    if alerta.disparado == 'S':
+                if tick is not None:
+                    metricas.incrementar("cotacoes_total", fonte=self.nome, metodo="tick", resultado="ok")
+                    entregar({tick[0]: tick[1]})
+                    if self.intervalo:
+                        self._parar.wait(self.intervalo)
+        logger.info(f"Replay de {self.caminho} concluído.")
+
+#Servidor TCP local: cada linha recebida é um tick (ex: nc 127.0.0.1 9009 < ticks.csv)
+class FonteSocket(FonteCotacoes):
+    nome = "tcp"
+
+    def __init__(self, host: str, porta: int):
+        super().__init__()
+        self.host = host
+        self.porta = porta
+        self._servidor = None
+
+    def executar(self, entregar):
+        fonte = self.nome
+
+        class TickHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for linha in self.rfile:
+                    try:
+                        tick = ler_tick(linha.decode('utf-8'))
+                    except ValueError:
+                        logger.warning(f"Tick inválido de {self.client_address}: {linha!r}")
+                        metricas.incrementar("cotacoes_total", fonte=fonte, metodo="tick", resultado="erro")
                         continue
+                    if tick is not None:
+                        metricas.incrementar("cotacoes_total", fonte=fonte, metodo="tick", resultado="ok")
+                        entregar({tick[0]: tick[1]})
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        with socketserver.ThreadingTCPServer((self.host, self.porta), TickHandler) as servidor:
+            servidor.daemon_threads = True
+            self._servidor = servidor
+            if self._parar.is_set(): #parada antes do servidor subir
+                return
+            logger.info(f"Recebendo ticks em {self.host}:{self.porta}.")
+            servidor.serve_forever(poll_interval=0.5)
+
+    def parar(self):
+        super().parar()
+        if self._servidor is not None:
+            self._servidor.shutdown()
+
+def criar_fonte_cotacoes(config: str, coordenador: CoordenadorShards | None = None) -> FonteCotacoes:
+    if coordenador is not None and config != "yahoo":
+        raise ValueError("O modo shards só funciona com a fonte de cotações yahoo.")
+    if config.startswith("arquivo:"):
+        return FonteArquivo(config.removeprefix("arquivo:"))
+    if config.startswith("tcp://"):
+        host, _, porta = config.removeprefix("tcp://").rpartition(":")
+        return FonteSocket(host or "127.0.0.1", int(porta))
+    if config == "yahoo":
+        return FontePollingYahoo(coordenador=coordenador)
+    raise ValueError(f"Fonte de cotações desconhecida: {config}")
+
+def monitorar_cotacoes(fonte: FonteCotacoes):
+    #Loop bloqueante do processo worker, alimentando o motor de alertas com a fonte configurada
+    logger.info(f"Monitoramento de cotações iniciado (fonte: {fonte.nome}).")
 
-                if alerta.disparado == 'N':
-                    if alerta.tipo == 'compra' and preco_atual <= alerta.valor:
-                        assunto = f"**COMPRA** - {alerta.ticker} @ R$ {preco_atual:.2f}"
-                        mensagem = f"Bora compraaaaaar, preço alvo para foi atingido! \n\nAlvo: R$ {alerta.valor:.2f} \nPreço atual: R$ {preco_atual:.2f}\n\n\nLembre-se: O alerta depois de disparado não funciona mais, caso queira reativá-lo, basta usar o /set com o mesmo ticket e tipo (compra ou venda) que ele será rearmado."
-
-                        alertas_disparados.append((alerta.chat_id, assunto, mensagem))
-                        alerta.disparado = 'S' #marca como disparado
+    while True:
+        try:
+            fonte.executar(processar_precos)
+            return #fonte esgotada (fim do replay) ou parada
+        
+        except Exception as e:
+            logger.critical(f"ERRO CRÍTICO no loop de monitoramento: {e}")
+            registro_alertas.invalidar() #o estado em memória pode ter divergido do BD
+            if fonte.esperar(intevalo_monitoramento * 2): #espera mais tempo em caso de erro
+                return
 
-                    elif alerta.tipo == 'venda' and preco_atual >= alerta.valor:
-                        assunto = f"**VENDA** - {alerta.ticker} @ R$ {preco_atual:.2f}"
-                        mensagem = f"Vamosssss seu(ua) ganancioso(a), venda! venda! venda! $$$$$ \n\n Preço alvo para foi atingido! \n\nAlvo: R$ {alerta.valor:.2f} \nPreço atual: R$ {preco_atual:.2f}\n\n\nLembre-se: O alerta depois de disparado não funciona mais, caso queira reativá-lo, basta usar o /set com o mesmo ticket e tipo (compra ou venda) que ele será rearmado."
+async def supervisionar_monitor(fonte: FonteCotacoes):
+    #Task do monitor no loop do bot: reinicia a fonte após erros e termina quando cancelada
+    logger.info(f"Monitoramento de cotações iniciado (fonte: {fonte.nome}).")
 
-                        alertas_disparados.append((alerta.chat_id, assunto, mensagem))  
-                        alerta.disparado = 'S'
+    while True:
+        try:
+            await fonte.executar_async(processar_precos, executor_monitor)
+            logger.info("Fonte de cotações esgotada, monitoramento encerrado.")
+            return
 
+        except asyncio.CancelledError:
+            fonte.parar()
+            raise
+        except Exception as e:
+            logger.critical(f"ERRO CRÍTICO no loop de monitoramento: {e}")
+            registro_alertas.invalidar() #o estado em memória pode ter divergido do BD
+            await asyncio.sleep(intevalo_monitoramento * 2) #espera mais tempo em caso de erro
+
+fonte_monitor = None #fonte do monitor do processo do bot, iniciada com a aplicação
+tarefa_monitor = None
+
+#Modo shards
+#Cada processo (o bot e os `python alerta_b3.py worker`) renova um lease "worker:<id>" e pega até
+#ceil(shards / workers vivos) shards livres ou expirados; quando entra um worker novo, os outros
+#devolvem o excedente, e quando um morre seus shards expiram e são assumidos pelos demais.
+#SQLite: cada UPDATE condicional é atômico, então dois processos nunca ficam com o mesmo shard.
+class CoordenadorShards:
+    def __init__(self, num_shards: int = num_shards_monitor, ttl: float = ttl_lease, dono: str | None = None, registro_parcial: bool = False):
+        self.num_shards = num_shards
+        self.ttl = ttl
+        self.dono = dono or f"{socket.gethostname()}:{os.getpid()}"
+        self.recursos = [f"shard:{i}" for i in range(num_shards)]
+        self.shards = frozenset() #números dos shards deste processo
+        self.extras = set() #outros recursos que este processo quer manter (ex: "telegram")
+        self.registro_parcial = registro_parcial #workers: o registro só tem os alertas dos próprios shards
+        self.ao_perder_lease = None #callback(recurso) quando um recurso de extras passa para outro processo
+        self._renovado_em = -math.inf #monotonic da última renovação bem-sucedida
+        self._parar = threading.Event()
+        self._thread = None
+        self._versao_registro = None
+        self._shards_sincronizados = None
+        self._sincronizado_em = 0
+
+    def shard_de(self, ticker: str) -> int:
+        return zlib.crc32(ticker.encode('utf-8')) % self.num_shards
+
+    def possui(self, ticker: str) -> bool:
+        #Sem renovar há um TTL os leases podem já ter sido assumidos por outro processo
+        return self.shard_de(ticker) in self.shards and time.monotonic() - self._renovado_em < self.ttl
+
+    def _perder(self, recursos: set):
+        for recurso in recursos:
+            logger.critical(f"Lease {recurso} foi assumido por outro processo.")
+            self.extras.discard(recurso)
+            if self.ao_perder_lease is not None:
+                self.ao_perder_lease(recurso)
+
+    def _criar_recursos(self, recursos: list):
+        with engine.begin() as conexao:
+            conexao.exec_driver_sql("INSERT OR IGNORE INTO leases (recurso) VALUES (?)", [(r,) for r in recursos])
+
+    @medir_bd
+    def adquirir(self, recurso: str) -> bool:
+        #Pega um recurso livre, expirado ou já deste processo
+        self._criar_recursos([recurso])
+        agora = datetime.datetime.now()
+        session = Session()
+        try:
+            pego = session.query(Lease).filter(
+                Lease.recurso == recurso,
+                or_(Lease.dono.is_(None), Lease.dono == self.dono, Lease.expira_em < agora)
+            ).update({"dono": self.dono, "expira_em": agora + datetime.timedelta(seconds=self.ttl)}, synchronize_session=False)
             session.commit()
+        finally:
             session.close()
+        if pego:
+            self.extras.add(recurso)
+        return bool(pego)
+
+    @medir_bd
+    def renovar(self) -> frozenset:
+        renovado_em = time.monotonic()
+        agora = datetime.datetime.now()
+        expira = agora + datetime.timedelta(seconds=self.ttl)
+        session = Session()
+        try:
+            #Heartbeat e renovação de tudo que ainda é deste processo
+            session.merge(Lease(recurso=f"worker:{self.dono}", dono=self.dono, expira_em=expira))
+            session.query(Lease).filter(Lease.dono == self.dono).update({"expira_em": expira}, synchronize_session=False)
+            session.commit()
 
+            ativos = session.query(Lease).filter(Lease.recurso.like("worker:%"), Lease.expira_em > agora).count()
+            meus = {r for (r,) in session.query(Lease.recurso).filter(Lease.dono == self.dono)}
+            livres = [
+                r for (r,) in session.query(Lease.recurso).filter(
+                    Lease.recurso.in_(self.recursos), or_(Lease.dono.is_(None), Lease.expira_em < agora)
+                )
+            ]
+            session.commit() #fecha a leitura antes de escrever (WAL)
 
-            for chat_id, assunto, mensagem in alertas_disparados:
-                try:
-                    future = asyncio.run_coroutine_threadsafe(
-                        app.bot.send_message(
-                            chat_id=chat_id, 
-                            text=f"{assunto}\n\n{mensagem}", 
-                            parse_mode='Markdown'
-                        ),
-                        loop
-                    )
-                    future.result(timeout=5)  # Espera a conclusão do envio
-                    logger.info(f"Alerta enviado para {chat_id}: {assunto}")
-                
-                except Exception as e:
-                    logger.error(f"Falha ao enviar alerta para {chat_id}: {e}")
+            self._perder(self.extras - meus)
 
-            #Aguardo antes da próxima verificação
-            time.sleep(intevalo_monitoramento)
-        
-        except Exception as e:
-            logger.critical(f"ERRO CRÍTICO no loop de monitoramento: {e}")
+            cota = math.ceil(self.num_shards / max(ativos, 1))
+            meus_shards = sorted(r for r in meus if r in self.recursos)
+            if len(meus_shards) > cota:
+                #Worker novo entrou: devolve o excedente para ele pegar
+                excedente = meus_shards[cota:]
+                session.query(Lease).filter(Lease.recurso.in_(excedente), Lease.dono == self.dono).update(
+                    {"dono": None, "expira_em": agora}, synchronize_session=False
+                )
+                session.commit()
+                meus_shards = meus_shards[:cota]
+            else:
+                random.shuffle(livres) #evita que workers iniciados juntos disputem os mesmos shards
+                for recurso in livres[:cota - len(meus_shards)]:
+                    pego = session.query(Lease).filter(
+                        Lease.recurso == recurso, or_(Lease.dono.is_(None), Lease.expira_em < agora)
+                    ).update({"dono": self.dono, "expira_em": expira}, synchronize_session=False)
+                    session.commit()
+                    if pego:
+                        meus_shards.append(recurso)
+
+            #Registros de workers mortos há muito tempo
+            session.query(Lease).filter(
+                Lease.recurso.like("worker:%"), Lease.expira_em < agora - datetime.timedelta(seconds=10 * self.ttl)
+            ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
 
+        shards = frozenset(int(r.split(":")[1]) for r in meus_shards)
+        if shards != self.shards:
+            logger.info(f"Shards deste processo ({self.dono}): {sorted(shards)} de {self.num_shards} ({ativos} workers ativos).")
+        self.shards = shards
+        self._renovado_em = renovado_em
+        return shards
+
+    def sincronizar_registro(self):
+        #Recarrega o registro se outro processo mudou a tabela de alertas. Ao ganhar shards a recarga é
+        #imediata: o estado (disparado/armado) deles foi gravado pelo dono anterior.
+        shards = self.shards
+        shards_mudaram = shards != self._shards_sincronizados
+        if not shards_mudaram and not registro_alertas.invalido and time.monotonic() - self._sincronizado_em < intervalo_sincronizacao_registro:
+            return
+        with engine.connect() as conexao:
+            versao = conexao.exec_driver_sql("SELECT versao FROM versao_alertas WHERE id = 1").scalar()
+        if versao != self._versao_registro or registro_alertas.invalido or (self.registro_parcial and shards_mudaram):
+            registro_alertas.recarregar((lambda ticker: self.shard_de(ticker) in shards) if self.registro_parcial else None)
+        self._versao_registro = versao
+        self._shards_sincronizados = shards
+        self._sincronizado_em = time.monotonic()
+
+    def _heartbeat(self):
+        while not self._parar.wait(self.ttl / 3):
             try:
-                if 'session' in locals() and session.is_active:
-                    session.rollback()
-                    session.close()
-            except:
-                pass
-            time.sleep(intevalo_monitoramento * 2) #espera mais tempo em caso de erro
+                self.renovar()
+            except Exception as e:
+                logger.error(f"Falha ao renovar os leases: {e}")
+                if time.monotonic() - self._renovado_em >= self.ttl:
+                    self._perder(set(self.extras))
+
+    def iniciar(self):
+        self._criar_recursos(self.recursos)
+        self.renovar()
+        self._thread = threading.Thread(target=self._heartbeat, name="leases", daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        #Devolve tudo na saída limpa, para os outros assumirem sem esperar o TTL
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join()
+        session = Session()
+        try:
+            session.query(Lease).filter(Lease.dono == self.dono).update({"dono": None, "expira_em": None}, synchronize_session=False)
+            session.query(Lease).filter(Lease.recurso == f"worker:{self.dono}").delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+        self.shards = frozenset()
+
+#Nos workers sem Telegram a fila de envios é trocada por esta: as mensagens vão em lote para a tabela
+#caixa_saida e o processo do bot as retira e envia pela fila de envios dele (limites de envio únicos)
+class CaixaSaida:
+    def __init__(self, intervalo: float = 0.5):
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._parar = threading.Event()
+        self._thread = None
+
+    @property
+    def pendentes(self) -> int:
+        return len(self._buffer)
+
+    def enfileirar(self, chat_id: int, texto: str, parse_mode: str | None = 'Markdown', descricao: str = ""):
+        with self._lock:
+            self._buffer.append({
+                "chat_id": chat_id, "texto": texto, "parse_mode": parse_mode, "descricao": descricao,
+                "criado_em": datetime.datetime.now(),
+            })
+
+    @medir_bd
+    def descarregar(self):
+        with self._lock:
+            mensagens, self._buffer = self._buffer, []
+        if not mensagens:
+            return
+        session = Session()
+        try:
+            session.bulk_insert_mappings(MensagemSaida, mensagens)
+            session.commit()
+        except Exception:
+            with self._lock:
+                self._buffer[:0] = mensagens #tenta de novo no próximo descarregamento
+            raise
+        finally:
+            session.close()
 
-def main() -> None:
-    #configurar e inciar o bot e a thread de monitoramento
-    logger.info("Iniciando bot do Telegram...")
+    def _loop(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.descarregar()
+            except Exception as e:
+                logger.error(f"Falha ao gravar mensagens na caixa de saída: {e}")
+
+    def iniciar(self):
+        self._thread = threading.Thread(target=self._loop, name="caixa_saida", daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.descarregar()
+
+@medir_bd
+def retirar_caixa_saida(limite: int = 500) -> list:
+    session = Session()
+    try:
+        mensagens = [
+            (m.id, m.chat_id, m.texto, m.parse_mode, m.descricao)
+            for m in session.query(MensagemSaida).order_by(MensagemSaida.id).limit(limite)
+        ]
+        session.commit() #fecha a leitura antes de escrever (WAL)
+        if mensagens:
+            session.query(MensagemSaida).filter(MensagemSaida.id.in_([m[0] for m in mensagens])).delete(synchronize_session=False)
+            session.commit()
+        return [m[1:] for m in mensagens]
+    finally:
+        session.close()
 
-    application = Application.builder().token(telegram_token).build()
+async def drenar_caixa_saida(context: ContextTypes.DEFAULT_TYPE):
+    #Job do processo do bot no modo shards: envia o que os workers geraram
+    while mensagens := await em_executor(executor_bd, retirar_caixa_saida):
+        for chat_id, texto, parse_mode, descricao in mensagens:
+            fila_envios.enfileirar(chat_id, texto, parse_mode, descricao)
+
+coordenador_shards = None
+
+#Serviços que vivem no loop do bot
+async def iniciar_servicos(application: Application) -> None:
+    global tarefa_monitor
+    await fila_envios.iniciar(application.bot)
+    iniciar_servidor_metricas()
+    if coordenador_shards is not None:
+        #Outro processo assumiu o Telegram (ex: este ficou sem renovar o lease): encerra o polling/webhook
+        #de forma ordenada em vez de dois processos responderem aos mesmos comandos
+        loop = asyncio.get_running_loop()
+
+        def lease_perdido(recurso: str):
+            if recurso == "telegram":
+                loop.call_soon_threadsafe(application.stop_running)
+        coordenador_shards.ao_perder_lease = lease_perdido
+    if fonte_monitor is not None:
+        tarefa_monitor = asyncio.create_task(supervisionar_monitor(fonte_monitor), name="monitor")
+
+async def parar_monitor():
+    #Cancela a espera do monitor; uma rodada já em andamento termina no executor antes de seguir
+    if tarefa_monitor is not None:
+        tarefa_monitor.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await tarefa_monitor
+    await asyncio.get_running_loop().run_in_executor(None, executor_monitor.shutdown)
+
+async def parar_servicos(application: Application) -> None:
+    await parar_monitor() #antes da fila, para as mensagens da última rodada ainda saírem
+    await fila_envios.parar()
+    parar_servidor_metricas()
+    if coordenador_shards is not None:
+        await em_executor(executor_bd, coordenador_shards.parar)
+
+def criar_aplicacao(requisicao=None) -> Application:
+    #Handlers e jobs do bot, iguais no polling e no webhook; `requisicao` troca o cliente HTTP do Telegram (testes locais)
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+
+    #Atualizações concorrentes: um /set esperando o Yahoo não segura os comandos dos outros usuários
+    builder = (
+        Application.builder()
+        .token(telegram_token)
+        .concurrent_updates(True)
+        .post_init(iniciar_servicos)
+        .post_shutdown(parar_servicos)
+    )
+    if requisicao is not None:
+        builder = builder.request(requisicao).get_updates_request(requisicao)
+    application = builder.build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("set", set_alerta))
     application.add_handler(CommandHandler("list", listar_alertas))
     application.add_handler(CommandHandler("rm", remover_alerta))
+    application.add_handler(CommandHandler("import", importar_alertas))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), importar_alertas))
+    application.add_handler(CommandHandler("export", exportar_alertas))
     application.add_handler(CallbackQueryHandler(confirmar_remocao_todos,pattern=r"^RM_."))
+    application.add_handler(CallbackQueryHandler(navegar_lista, pattern=r"^LS:"))
     application.add_handler(CommandHandler("help", help))
     application.add_handler(CommandHandler("add_user", add_user))
     application.add_handler(CommandHandler("toggle_user", toggle_user))
     application.add_handler(CommandHandler("list_users", list_users))
+    application.add_handler(CommandHandler("stats", stats))
     application.add_handler(CommandHandler("admin_help", admin_help))
     
     #Restringir mensagens que não são comandos
@@ -763,32 +3551,108 @@ def main() -> None:
             #Agendamento 1: Mensagem de fechamento
             application.job_queue.run_daily(
                 callback=enviar_cotacoes_fechamento,
-                time=datetime.time(hour=17, minute=30, second=0, tzinfo=ZoneInfo("America/Sao_Paulo")),
+                time=datetime.time(hour=17, minute=30, second=0, tzinfo=fuso_b3),
                 name='fechamento_b3'
             )   
-            logger.info("Rotina de Fechamento B3 agendada para 17:30h (Seg-Sex).")
+            logger.info("Rotina de Fechamento B3 agendada para 17:30h (dias de pregão).")
 
             application.job_queue.run_daily(
                 callback=resetar_alertas_recorrentes,
-                time=datetime.time(hour=9,minute=30, second=0,tzinfo=ZoneInfo("America/Sao_Paulo"))
+                time=datetime.time(hour=9,minute=30, second=0,tzinfo=fuso_b3)
             )
-            logger.info("Rotina de Reset de Alertas Recorrentes agendada para 9:30h (Seg-Sex).")
+            logger.info("Rotina de Reset de Alertas Recorrentes agendada para 9:30h (dias de pregão).")
 
         else:
             logger.warning("Job queue não disponível. Rotina de fechamento não agendada.")
     except Exception as e:
         logger.error(f"Erro ao agendar job diário: {e}")
-    
-    loop = asyncio.get_event_loop()
 
-    #Iniciar thread de monitoramento
-    monitor_thread = threading.Thread(target=monitorar_cotacoes, args=(application, loop))
-    monitor_thread.start()
-    
+    return application
+
+def iniciar_recebimento(application: Application) -> None:
+    #Bloqueia até o bot ser encerrado (Ctrl+C/SIGTERM)
+    if not webhook_url:
+        application.run_polling(poll_interval=1)
+        return
+
+    url = f"{webhook_url.rstrip('/')}/{webhook_caminho}"
+    logger.info(f"Modo webhook: escutando em {webhook_host}:{webhook_porta}/{webhook_caminho}, registrado como {url}")
+    application.run_webhook(
+        listen=webhook_host,
+        port=webhook_porta,
+        url_path=webhook_caminho,
+        webhook_url=url,
+        secret_token=webhook_segredo or secrets.token_urlsafe(32), #sem segredo qualquer um que ache a URL injeta comandos
+    )
+
+def main() -> None:
+    #configurar e inciar o bot e a thread de monitoramento
+    carregar_configuracao()
+    configurar_logs()
+    logger.info("Iniciando bot do Telegram...")
+    iniciar_bd()
+    application = criar_aplicacao()
+
+    #Carrega os alertas e usuários do BD uma única vez; daqui em diante são atualizados pelos handlers
+    registro_alertas.recarregar()
+    recarregar_usuarios_autorizados()
+
+    #Modo shards: só um processo faz o polling do Telegram e envia o que os workers geram
+    global coordenador_shards
+    if modo_monitor == "shards":
+        coordenador_shards = CoordenadorShards()
+        aguardar_lease(coordenador_shards, "telegram")
+        coordenador_shards.iniciar()
+        application.job_queue.run_repeating(drenar_caixa_saida, interval=1, first=1, name='caixa_saida')
+        logger.info(f"Modo shards: {coordenador_shards.num_shards} shards divididos com os workers (python alerta_b3.py worker).")
+
+    #O monitor roda como task no loop do bot (iniciada no post_init, cancelada no desligamento)
+    global fonte_monitor
+    fonte_monitor = criar_fonte_cotacoes(fonte_cotacoes_config, coordenador_shards)
 
     #Iniciar o bot
     logger.info("Bot iniciado. Aguardando comandos...")
-    application.run_polling(poll_interval=1)
+    iniciar_recebimento(application)
       
+def aguardar_lease(coordenador: CoordenadorShards, recurso: str):
+    #Um processo que morreu sem devolver o lease o perde depois do TTL
+    limite = time.monotonic() + 2 * coordenador.ttl
+    while not coordenador.adquirir(recurso):
+        if time.monotonic() > limite:
+            raise SystemExit(f"Outro processo está com o lease '{recurso}'; só um processo pode rodar o bot.")
+        logger.warning(f"Lease '{recurso}' ocupado por outro processo, aguardando expirar...")
+        time.sleep(coordenador.ttl / 3)
+
+def main_worker() -> None:
+    #Processo só de monitoramento do modo shards: sem Telegram, as mensagens vão para a caixa de saída
+    global fila_envios, coordenador_shards
+    carregar_configuracao(exigir_telegram=False)
+    configurar_logs()
+    iniciar_bd()
+    logger.info("Iniciando worker de monitoramento (modo shards)...")
+
+    coordenador = coordenador_shards = CoordenadorShards(registro_parcial=True)
+    coordenador.iniciar()
+    fila_envios = CaixaSaida()
+    fila_envios.iniciar()
+
+    fonte = criar_fonte_cotacoes(fonte_cotacoes_config, coordenador)
+    signal.signal(signal.SIGTERM, lambda *_: fonte.parar())
+    signal.signal(signal.SIGINT, lambda *_: fonte.parar())
+    try:
+        monitorar_cotacoes(fonte)
+    finally:
+        fila_envios.parar()
+        coordenador.parar()
+        logger.info("Worker encerrado, shards devolvidos.")
+
 if __name__ == "__main__":
-    main()      
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Bot de alertas da B3")
+    parser.add_argument(
+        "papel", nargs="?", choices=["bot", "worker"], default="bot",
+        help="bot: Telegram e monitor (padrão); worker: só monitor, para o modo_monitor=shards"
+    )
+    if parser.parse_args().papel == "worker":
+        main_worker()
+    else:
+        main()      
\ No newline at end of file
@@ -0,0 +1,817 @@
+#Benchmark local do bot de alertas, sem acesso à rede
+#Uso: python scripts/benchmark_alerta_b3.py cotacoes --tickers 10 50 100 300 --latencia 0.05
+#     python scripts/benchmark_alerta_b3.py carga --usuarios 10000 --alertas 100000 --saida carga.json
+#     python scripts/benchmark_alerta_b3.py webhook --updates 500
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+#O alertas.db dos cenários fica em um diretório temporário
+raiz_repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, raiz_repo)
+os.chdir(tempfile.mkdtemp(prefix="alerta_b3_bench_"))
+
+import alerta_b3
+import numpy as np
+import pandas as pd
+from telegram.error import NetworkError
+from telegram.request import BaseRequest
+
+alerta_b3.logger.setLevel("WARNING")
+alerta_b3.iniciar_bd()
+
+#Provedor falso: cada requisição (lote ou individual) custa `latencia` segundos
+class ProvedorFake(alerta_b3.ProvedorCotacoes):
+    nome = "fake"
+
+    def __init__(self, latencia: float, taxa_erro: float = 0.0, lote: bool = True, max_threads: int = alerta_b3.max_threads_cotacoes):
+        super().__init__(max_threads)
+        self.latencia = latencia
+        self.taxa_erro = taxa_erro
+        self.lote = lote
+
+    def _preco(self, ticker: str) -> float:
+        if random.random() < self.taxa_erro:
+            raise RuntimeError("erro simulado")
+        return 10 + (hash(ticker) % 9000) / 100
+
+    def buscar_lote(self, tickers: list) -> dict:
+        if not self.lote:
+            return {}
+        time.sleep(self.latencia)
+        precos = {}
+        for ticker in tickers:
+            try:
+                precos[ticker] = self._preco(ticker)
+            except RuntimeError:
+                pass
+        return precos
+
+    def buscar_unitario(self, ticker: str) -> float | None:
+        time.sleep(self.latencia)
+        return self._preco(ticker)
+
+def tickers_ficticios(n: int) -> list:
+    return [f"TST{i:04d}.SA" for i in range(n)]
+
+#Tickers no formato da B3 (passam na validação do /set)
+def tickers_b3_ficticios(n: int) -> list:
+    return [f"Z{i:03d}{i // 1000 + 3}.SA" for i in range(n)]
+
+def bench_cotacoes(args) -> None:
+    print(f"{'tickers':>8} {'serial (s)':>11} {'pool (s)':>9} {'lote (s)':>9} {'falhas':>7}")
+    for n in args.tickers:
+        tickers = tickers_ficticios(n)
+
+        #Referência: o laço serial antigo, um .info por ticker
+        provedor = ProvedorFake(args.latencia, args.taxa_erro, lote=False)
+        inicio = time.perf_counter()
+        for ticker in tickers:
+            try:
+                provedor.buscar_unitario(ticker)
+            except RuntimeError:
+                pass
+        serial = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        provedor.buscar_precos(tickers)
+        pool = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        _, falhas = ProvedorFake(args.latencia, args.taxa_erro, lote=True).buscar_precos(tickers)
+        lote = time.perf_counter() - inicio
+
+        print(f"{n:>8} {serial:>11.2f} {pool:>9.2f} {lote:>9.2f} {len(falhas):>7}")
+
+def bench_avaliacao(args) -> None:
+    #Muitos alertas em poucos tickers populares, preço oscilando perto dos alvos
+    tickers = tickers_ficticios(args.num_tickers)
+    linhas = [
+        (i, random.choice(tickers), random.choice(alerta_b3.tipos_alerta), round(random.uniform(20, 40), 2), i % 1000, 'N')
+        for i in range(args.alertas)
+    ]
+    precos = [{t: round(random.uniform(29.5, 30.5), 2) for t in tickers} for _ in range(args.ticks)]
+
+    #Referência: varredura de todos os alertas a cada tick, como no laço original
+    estado = {linha[0]: linha[5] for linha in linhas}
+    inicio = time.perf_counter()
+    for tick in precos:
+        for alerta_id, ticker, tipo, valor, _, _ in linhas:
+            preco = tick[ticker]
+            if estado[alerta_id] == 'S':
+                if (tipo == 'compra' and preco > valor) or (tipo == 'venda' and preco < valor):
+                    estado[alerta_id] = 'N'
+                continue
+            if (tipo == 'compra' and preco <= valor) or (tipo == 'venda' and preco >= valor):
+                estado[alerta_id] = 'S'
+    varredura = (time.perf_counter() - inicio) / args.ticks
+
+    indice = alerta_b3.RegistroAlertas()
+    indice.carregar(alerta_b3.RegistroAlerta(*linha) for linha in linhas)
+    acertos = 0
+    inicio = time.perf_counter()
+    for tick in precos:
+        for ticker, preco in tick.items():
+            disparados, rearmados = indice.avaliar(ticker, preco)
+            acertos += len(disparados) + len(rearmados)
+    por_indice = (time.perf_counter() - inicio) / args.ticks
+
+    print(f"{args.alertas} alertas em {args.num_tickers} tickers, {args.ticks} ticks")
+    print(f"varredura: {varredura * 1000:.2f} ms/tick")
+    print(f"índice:    {por_indice * 1000:.2f} ms/tick ({acertos / args.ticks:.0f} transições/tick)")
+
+#Popula o alertas.db do diretório temporário com alertas fictícios
+def popular_bd(alertas: int, num_tickers: int, usuarios: int, tickers: list | None = None) -> None:
+    tickers = tickers or tickers_ficticios(num_tickers)
+    if alertas > usuarios * num_tickers * len(alerta_b3.tipos_alerta):
+        raise SystemExit("alertas demais: cada usuário tem no máximo um alerta por ticker e tipo")
+    agora = alerta_b3.datetime.datetime.now()
+    session = alerta_b3.Session()
+    session.query(alerta_b3.Alerta).delete()
+    #Combinações (chat_id, ticker, tipo) únicas, como exige o índice único: cada usuário percorre
+    #os pares ticker/tipo a partir de um deslocamento aleatório
+    pares = [(ticker, tipo) for ticker in tickers for tipo in alerta_b3.tipos_alerta]
+    deslocamentos = [random.randrange(len(pares)) for _ in range(usuarios)]
+    session.bulk_insert_mappings(alerta_b3.Alerta, [
+        {
+            "ticker": pares[(deslocamentos[i % usuarios] + i // usuarios) % len(pares)][0],
+            "tipo": pares[(deslocamentos[i % usuarios] + i // usuarios) % len(pares)][1],
+            "valor": round(random.uniform(20, 40), 2),
+            "chat_id": i % usuarios,
+            "timestamp": agora,
+            "disparado": 'N',
+            "recorrencia": i % 3 == 0,
+        }
+        for i in range(alertas)
+    ])
+    session.commit()
+    session.close()
+
+def medir(funcao):
+    #Retorna (segundos, pico de memória alocada em MB)
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = funcao()
+    duracao = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return resultado, duracao, pico / 1024 / 1024
+
+def bench_registro(args) -> None:
+    popular_bd(args.alertas, args.num_tickers, args.usuarios)
+
+    #Antes: cada ciclo recriava todos os objetos ORM
+    def ciclo_orm():
+        session = alerta_b3.Session()
+        alertas = session.query(alerta_b3.Alerta).all()
+        tickers = {a.ticker for a in alertas}
+        session.close()
+        return tickers
+
+    #Depois: o registro é carregado uma vez e cada ciclo só lê os tickers dele
+    registro = alerta_b3.RegistroAlertas()
+    _, carga, mem_registro = medir(registro.recarregar)
+
+    _, t_orm, mem_orm = medir(ciclo_orm)
+    _, t_registro, mem_ciclo = medir(registro.tickers)
+
+    print(f"{args.alertas} alertas, {args.num_tickers} tickers, {args.usuarios} usuários")
+    print(f"ciclo com query(Alerta).all(): {t_orm * 1000:9.1f} ms  pico {mem_orm:7.1f} MB")
+    print(f"ciclo com registro residente:  {t_registro * 1000:9.1f} ms  pico {mem_ciclo:7.1f} MB")
+    print(f"carga única do registro:       {carga * 1000:9.1f} ms  pico {mem_registro:7.1f} MB")
+
+#Stand-ins mínimos do Update/Context do python-telegram-bot para chamar os handlers direto
+class MensagemFake:
+    def __init__(self, latencia: float = 0.0, texto: str = ""):
+        self.respostas = []
+        self.documentos = []
+        self.latencia = latencia
+        self.text = texto
+        self.document = None
+        self.reply_to_message = None
+
+    async def reply_text(self, texto, **kwargs):
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        self.respostas.append(texto)
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        self.documentos.append((filename, document))
+
+class UsuarioFake:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.first_name = f"user{user_id}"
+
+class UpdateFake:
+    def __init__(self, user_id: int, latencia: float = 0.0, texto: str = ""):
+        self.effective_user = UsuarioFake(user_id)
+        self.message = MensagemFake(latencia, texto)
+
+class ContextFake:
+    def __init__(self, args: list):
+        self.args = args
+
+def percentil(amostras: list, p: float) -> float:
+    ordenadas = sorted(amostras)
+    return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * p))]
+
+def bench_latencia(args) -> None:
+    #/set presos em consultas lentas ao Yahoo enquanto outros usuários rodam /list
+    popular_bd(args.alertas, 50, args.usuarios)
+    alerta_b3.registro_alertas.recarregar()
+    alerta_b3.usuarios_autorizados = frozenset(range(args.usuarios + args.sets))
+
+    def consulta_lenta(ticker: str) -> bool:
+        time.sleep(args.latencia_yahoo)
+        return True
+    alerta_b3.consultar_ticker_yahoo = consulta_lenta
+
+    async def medir_list(user_id: int) -> float:
+        inicio = time.perf_counter()
+        await alerta_b3.listar_alertas(UpdateFake(user_id), ContextFake([]))
+        return time.perf_counter() - inicio
+
+    async def cenario(com_sets: bool) -> list:
+        sets = []
+        if com_sets:
+            sets = [
+                asyncio.create_task(alerta_b3.set_alerta(UpdateFake(args.usuarios + i), ContextFake([f"LENT{i % 90 + 10}", "compra", "10"])))
+                for i in range(args.sets)
+            ]
+            await asyncio.sleep(0.05) #garante que os /set já estão esperando o Yahoo
+        latencias = []
+        for i in range(args.lists):
+            latencias.append(await medir_list(i % args.usuarios))
+            await asyncio.sleep(args.intervalo)
+        await asyncio.gather(*sets)
+        return latencias
+
+    for nome, com_sets in (("sem /set pendente", False), (f"{args.sets} /set lentos", True)):
+        latencias = asyncio.run(cenario(com_sets))
+        print(f"/list {nome:>20}: p50 {percentil(latencias, 0.5) * 1000:7.2f} ms  p99 {percentil(latencias, 0.99) * 1000:7.2f} ms")
+
+#Fila de envios falsa: só guarda o que seria enviado
+class FilaFake:
+    def __init__(self):
+        self.mensagens = []
+
+    def enfileirar(self, chat_id, texto, parse_mode='Markdown', descricao=""):
+        self.mensagens.append((chat_id, texto))
+
+def bench_fechamento(args) -> None:
+    popular_bd(args.alertas, args.num_tickers, args.usuarios)
+    alerta_b3.registro_alertas.recarregar()
+    alerta_b3.dia_de_pregao = lambda data: True #roda em qualquer dia
+    alerta_b3.provedor_cotacoes = ProvedorFake(args.latencia)
+    alerta_b3.fila_envios = fila = FilaFake()
+
+    inicio = time.perf_counter()
+    asyncio.run(alerta_b3.enviar_cotacoes_fechamento(None))
+    duracao = time.perf_counter() - inicio
+
+    print(f"fechamento: {args.usuarios} usuários, {args.alertas} alertas, {args.num_tickers} tickers")
+    print(f"{duracao:.2f}s para montar {len(fila.mensagens)} mensagens")
+
+#Schema anterior às migrações (sem índices), para medir o BD de produção antigo
+ddl_alertas_legado = (
+    "CREATE TABLE alertas (id INTEGER NOT NULL PRIMARY KEY, ticker VARCHAR NOT NULL, tipo VARCHAR NOT NULL, "
+    "valor FLOAT NOT NULL, chat_id INTEGER NOT NULL, timestamp DATETIME, disparado VARCHAR, tkt_edt BOOLEAN, recorrencia BOOLEAN)"
+)
+
+def bench_schema(args) -> None:
+    caminho = os.path.abspath("legado.db")
+    conexao = sqlite3.connect(caminho)
+    conexao.execute(ddl_alertas_legado)
+    tickers = tickers_ficticios(args.num_tickers)
+    #Combinações únicas de (chat_id, ticker, tipo), como garante o índice único
+    linhas = (
+        (tickers[(i // 2) % args.num_tickers], alerta_b3.tipos_alerta[i % 2], 30.0, i // (2 * args.num_tickers), 'N', 0, 0)
+        for i in range(args.linhas)
+    )
+    conexao.executemany("INSERT INTO alertas (ticker, tipo, valor, chat_id, disparado, tkt_edt, recorrencia) VALUES (?, ?, ?, ?, ?, ?, ?)", linhas)
+    conexao.commit()
+    conexao.close()
+    usuarios = args.linhas // (2 * args.num_tickers)
+
+    engine = alerta_b3.create_engine(f"sqlite:///{caminho}")
+    alerta_b3.event.listen(engine, "connect", alerta_b3.configurar_conexao_sqlite)
+
+    consultas = {
+        "/list": "SELECT * FROM alertas WHERE chat_id = ?",
+        "/set e /rm": "SELECT * FROM alertas WHERE chat_id = ? AND ticker = ? AND tipo = ?",
+    }
+
+    def medir_consultas(rotulo: str):
+        with engine.connect() as c:
+            for nome, sql in consultas.items():
+                latencias = []
+                for _ in range(args.repeticoes):
+                    parametros = (random.randrange(usuarios), random.choice(tickers), random.choice(alerta_b3.tipos_alerta))
+                    inicio = time.perf_counter()
+                    c.exec_driver_sql(sql, parametros[:sql.count("?")]).fetchall()
+                    latencias.append(time.perf_counter() - inicio)
+                print(f"{rotulo:<7} {nome:<11} p50 {percentil(latencias, 0.5) * 1000:8.3f} ms  p99 {percentil(latencias, 0.99) * 1000:8.3f} ms")
+
+    print(f"{args.linhas} alertas, {usuarios} usuários, {args.num_tickers} tickers")
+    medir_consultas("antes")
+    inicio = time.perf_counter()
+    alerta_b3.migrar_bd(engine)
+    print(f"migração: {time.perf_counter() - inicio:.1f}s")
+    medir_consultas("depois")
+
+#yfinance falso: download() e Ticker().info com latência e taxa de erro configuráveis.
+#Cada ticker segue um passeio aleatório perto de R$ 30 (onde ficam os alvos de popular_bd) e
+#avancar() move o "relógio" do pregão, liberando novas barras de 1 minuto.
+class YahooFake:
+    def __init__(self, tickers: list, latencia: float, taxa_erro: float, semente: int = 0):
+        gerador = np.random.default_rng(semente)
+        self.latencia = latencia
+        self.taxa_erro = taxa_erro
+        self.abertura = pd.Timestamp.now(tz=alerta_b3.fuso_b3).normalize() + pd.Timedelta(hours=10)
+        self.minuto = 1
+        self._caminhos = {t: 30 + np.cumsum(gerador.normal(0, 0.05, 480)) for t in tickers}
+        self.requisicoes = 0
+
+    def avancar(self, minutos: int) -> None:
+        self.minuto = min(self.minuto + minutos, 480)
+
+    def _esperar(self) -> None:
+        self.requisicoes += 1
+        time.sleep(self.latencia)
+
+    def download(self, tickers, period="5d", interval="1d", **kwargs):
+        self._esperar()
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        if interval == "1m":
+            indice = pd.date_range(self.abertura, periods=self.minuto, freq="min")
+        else:
+            indice = pd.date_range(self.abertura.normalize() - pd.Timedelta(days=4), periods=5, freq="D")
+
+        colunas = {}
+        for ticker in tickers:
+            caminho = self._caminhos.get(ticker)
+            if caminho is None or random.random() < self.taxa_erro:
+                continue #ticker some da resposta, como no Yahoo
+            if interval == "1m":
+                fechamento = caminho[:self.minuto]
+            else:
+                fechamento = np.r_[caminho[0] + np.arange(-4, 0) * 0.1, caminho[self.minuto - 1]]
+            colunas[(ticker, 'Open')] = fechamento
+            colunas[(ticker, 'High')] = fechamento + 0.03
+            colunas[(ticker, 'Low')] = fechamento - 0.03
+            colunas[(ticker, 'Close')] = fechamento
+            colunas[(ticker, 'Volume')] = np.full(len(fechamento), 1000.0)
+        return pd.DataFrame(colunas, index=indice)
+
+    def Ticker(self, ticker: str):
+        yahoo = self
+
+        class TickerFake:
+            @property
+            def info(self):
+                yahoo._esperar()
+                if random.random() < yahoo.taxa_erro:
+                    raise RuntimeError("erro simulado")
+                caminho = yahoo._caminhos.get(ticker)
+                if caminho is None:
+                    return {"trailingPegRatio": None}
+                return {
+                    "shortName": ticker, "longName": ticker, "currency": "BRL", "exchange": "SAO", "quoteType": "EQUITY",
+                    "regularMarketPrice": float(caminho[yahoo.minuto - 1]), "previousClose": float(caminho[0]),
+                }
+
+        return TickerFake()
+
+#Bot do Telegram falso para a fila de envios
+class BotFake:
+    def __init__(self, latencia: float, taxa_erro: float):
+        self.latencia = latencia
+        self.taxa_erro = taxa_erro
+        self.enviadas = 0
+        self.erros = 0
+
+    async def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        await asyncio.sleep(self.latencia)
+        if random.random() < self.taxa_erro:
+            self.erros += 1
+            raise NetworkError("erro simulado")
+        self.enviadas += 1
+
+def resumo_latencias(amostras: list) -> dict:
+    if not amostras:
+        return {"n": 0}
+    return {
+        "n": len(amostras),
+        "p50_ms": percentil(amostras, 0.5) * 1000,
+        "p95_ms": percentil(amostras, 0.95) * 1000,
+        "p99_ms": percentil(amostras, 0.99) * 1000,
+        "max_ms": max(amostras) * 1000,
+    }
+
+def bench_carga(args) -> None:
+    random.seed(args.semente)
+    tickers = tickers_b3_ficticios(args.num_tickers)
+    #Tickers que existem no Yahoo falso mas ainda não têm alerta (o /set vai à rede para validá-los)
+    tickers_novos = tickers_b3_ficticios(args.num_tickers + args.tickers_novos)[args.num_tickers:]
+    #Tickers com alertas que o Yahoo falso não conhece (deslistados): devem ser suspensos, não rebuscados todo ciclo
+    quebrados = tickers_b3_ficticios(args.num_tickers + args.tickers_novos + args.tickers_quebrados)[args.num_tickers + args.tickers_novos:]
+
+    popular_bd(args.alertas, args.num_tickers + args.tickers_quebrados, args.usuarios, tickers + quebrados)
+    session = alerta_b3.Session()
+    session.query(alerta_b3.UsuarioPermitido).delete()
+    agora = alerta_b3.datetime.datetime.now()
+    session.bulk_insert_mappings(alerta_b3.UsuarioPermitido, [
+        {"chat_id": i, "nome": f"user{i}", "timestamp": agora, "ativo": True} for i in range(args.usuarios)
+    ])
+    session.commit()
+    session.close()
+    alerta_b3.recarregar_usuarios_autorizados()
+    alerta_b3.registro_alertas.recarregar()
+
+    #Troca yfinance e o Bot pelos falsos; o resto (cache, provedor, registro, fila, BD) é o código real
+    yahoo = YahooFake(tickers + tickers_novos, args.latencia_yahoo, args.erro_yahoo, args.semente)
+    bot = BotFake(args.latencia_telegram, args.erro_telegram)
+    alerta_b3.yf = yahoo
+    alerta_b3.dia_de_pregao = lambda data: True
+    alerta_b3.envios_por_segundo = args.envios_por_segundo
+    alerta_b3.workers_envio = args.workers_envio
+    alerta_b3.max_tentativas_envio = 2
+    alerta_b3.cache_cotacoes = alerta_b3.CacheCotacoes(alerta_b3.ttl_cotacoes)
+    alerta_b3.fila_envios = fila = alerta_b3.FilaEnvios()
+    fonte = alerta_b3.FontePollingYahoo(alerta_b3.ProvedorYahoo())
+
+    def ciclo_monitor() -> tuple[float, int, int]:
+        yahoo.avancar(args.minutos_por_ciclo)
+        inicio = time.perf_counter()
+        cotacoes, falhas = fonte.buscar(tickers + quebrados)
+        disparados = alerta_b3.processar_precos(cotacoes)
+        return time.perf_counter() - inicio, disparados, len(falhas)
+
+    async def usuario(user_id: int, latencias: dict) -> None:
+        for _ in range(args.comandos):
+            sorteio = random.random()
+            if sorteio < 0.6:
+                nome, handler, argumentos = "/list", alerta_b3.listar_alertas, []
+            elif sorteio < 0.9:
+                ticker = random.choice(tickers_novos if random.random() < 0.1 and tickers_novos else tickers)
+                argumentos = [ticker.replace(".SA", ""), random.choice(alerta_b3.tipos_alerta), f"{random.uniform(20, 40):.2f}"]
+                nome, handler = "/set", alerta_b3.set_alerta
+            else:
+                argumentos = [random.choice(tickers).replace(".SA", ""), random.choice(alerta_b3.tipos_alerta)]
+                nome, handler = "/rm", alerta_b3.remover_alerta
+            inicio = time.perf_counter()
+            await handler(UpdateFake(user_id, args.latencia_telegram), ContextFake(argumentos))
+            latencias[nome].append(time.perf_counter() - inicio)
+
+    async def cenario() -> dict:
+        await fila.iniciar(bot)
+        resultado = {}
+
+        ciclos = []
+        disparados = falhas = 0
+        for _ in range(args.ciclos):
+            duracao, n, f = await asyncio.to_thread(ciclo_monitor)
+            ciclos.append(duracao)
+            disparados += n
+            falhas += f
+        resultado["monitor"] = {
+            **resumo_latencias(ciclos), "disparados": disparados, "falhas_cotacao": falhas,
+            "mensagens": int(alerta_b3.metricas.contador("notificacoes_alerta_total")), #resumos por chat enfileirados
+        }
+
+        latencias = {"/list": [], "/set": [], "/rm": []}
+        inicio = time.perf_counter()
+        await asyncio.gather(*(
+            usuario(user_id, latencias) for user_id in random.sample(range(args.usuarios), min(args.simultaneos, args.usuarios))
+        ))
+        resultado["comandos"] = {nome: resumo_latencias(amostras) for nome, amostras in latencias.items()}
+        resultado["comandos"]["duracao_s"] = time.perf_counter() - inicio
+
+        #Esvazia o que o monitor enfileirou antes de medir o fechamento
+        inicio = time.perf_counter()
+        while fila.pendentes and time.perf_counter() - inicio < args.timeout_envio:
+            await asyncio.sleep(0.05)
+        resultado["monitor"]["entrega_s"] = time.perf_counter() - inicio
+        enviadas_antes = bot.enviadas
+
+        inicio = time.perf_counter()
+        await alerta_b3.enviar_cotacoes_fechamento(None)
+        montagem = time.perf_counter() - inicio
+        await asyncio.sleep(0) #enfileirar() agenda a entrada na fila pelo loop
+        while fila.pendentes and time.perf_counter() - inicio < args.timeout_envio:
+            await asyncio.sleep(0.05)
+        resultado["fechamento"] = {
+            "montagem_s": montagem,
+            "total_s": time.perf_counter() - inicio,
+            "mensagens": bot.enviadas - enviadas_antes,
+            "pendentes": fila.pendentes,
+        }
+
+        await fila.parar(timeout=0)
+        resultado["telegram"] = {"enviadas": bot.enviadas, "erros": bot.erros}
+        resultado["yahoo"] = {
+            "requisicoes": yahoo.requisicoes,
+            "evitadas": int(alerta_b3.metricas.contador("cotacoes_evitadas_total")),
+            "suspensos": len(alerta_b3.saude_yahoo.suspensos()),
+        }
+        return resultado
+
+    resultado = {
+        "parametros": {chave: valor for chave, valor in vars(args).items() if chave not in ("func", "saida", "comparar")},
+        **asyncio.run(cenario()),
+        "cache": alerta_b3.cache_cotacoes.estatisticas(),
+        #ru_maxrss vem em KB no Linux
+        "pico_memoria_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False, default=str)
+    print(texto)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as arquivo:
+            arquivo.write(texto)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as arquivo:
+            base = json.load(arquivo)
+        regressoes = comparar_resultados(base, resultado, args.tolerancia)
+        for metrica, antes, depois in regressoes:
+            print(f"REGRESSÃO {metrica}: {antes:.3f} -> {depois:.3f}", file=sys.stderr)
+        if regressoes:
+            sys.exit(1)
+
+def bench_importacao(args) -> None:
+    #Cada medida em um processo novo, sem .env e fora do repositório
+    codigo = "import time; inicio = time.perf_counter(); import alerta_b3; print(time.perf_counter() - inicio)"
+    ambiente = {k: v for k, v in os.environ.items() if k not in ("telegram_token", "admin_chat_id")}
+    ambiente["PYTHONPATH"] = os.pathsep.join(filter(None, [raiz_repo, ambiente.get("PYTHONPATH")]))
+    diretorio = tempfile.mkdtemp(prefix="alerta_b3_import_")
+    tempos = []
+    for _ in range(args.repeticoes):
+        saida = subprocess.run([sys.executable, "-c", codigo], env=ambiente, cwd=diretorio, capture_output=True, text=True, check=True)
+        tempos.append(float(saida.stdout.strip().splitlines()[-1]))
+    print(f"import alerta_b3: mediana {statistics.median(tempos) * 1000:.0f} ms, mínimo {min(tempos) * 1000:.0f} ms ({args.repeticoes} processos)")
+    print(f"arquivos criados pelo import: {os.listdir(diretorio) or 'nenhum'}")
+
+#Cliente HTTP falso da API do Telegram: responde getMe/setWebhook/... e registra as mensagens enviadas
+class RequisicaoTelegramFake(BaseRequest):
+    def __init__(self):
+        self.enviadas = {} #chat_id -> momento do sendMessage
+        self.chamadas = []
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        metodo = url.rsplit("/", 1)[-1]
+        parametros = request_data.parameters if request_data else {}
+        self.chamadas.append(metodo)
+        if metodo == "getMe":
+            resultado = {"id": 1, "is_bot": True, "first_name": "alerta_b3", "username": "alerta_b3_bot"}
+        elif metodo in ("sendMessage", "editMessageText"):
+            self.enviadas[int(parametros["chat_id"])] = time.perf_counter()
+            resultado = {
+                "message_id": 1, "date": int(time.time()), "text": parametros.get("text", ""),
+                "chat": {"id": int(parametros["chat_id"]), "type": "private"},
+            }
+        else:
+            resultado = True
+        return 200, json.dumps({"ok": True, "result": resultado}).encode()
+
+def update_comando(update_id: int, user_id: int, texto: str) -> dict:
+    usuario = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": texto, "from": usuario,
+            "chat": {"id": user_id, "type": "private"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}],
+        },
+    }
+
+def bench_webhook(args) -> None:
+    #Posta atualizações no listener do webhook como o Telegram faria e mede até a resposta sair pelo bot
+    import httpx
+
+    popular_bd(args.alertas, 50, args.usuarios)
+    alerta_b3.registro_alertas.recarregar()
+    alerta_b3.usuarios_autorizados = frozenset(range(args.usuarios))
+    alerta_b3.telegram_token = "123456:webhook-local"
+    alerta_b3.porta_metricas = 0
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        porta = s.getsockname()[1]
+    segredo = "segredo-local"
+    requisicao = RequisicaoTelegramFake()
+    application = alerta_b3.criar_aplicacao(requisicao)
+
+    async def cenario() -> None:
+        async with application:
+            await application.updater.start_webhook(
+                listen="127.0.0.1", port=porta, url_path=alerta_b3.webhook_caminho,
+                webhook_url=f"https://exemplo.invalid/{alerta_b3.webhook_caminho}", secret_token=segredo,
+            )
+            await application.start()
+            url = f"http://127.0.0.1:{porta}/{alerta_b3.webhook_caminho}"
+            try:
+                async with httpx.AsyncClient() as cliente:
+                    negado = await cliente.post(url, json=update_comando(0, 0, "/list"), headers={"X-Telegram-Bot-Api-Secret-Token": "errado"})
+
+                    postados = {}
+                    async def postar(i: int) -> int:
+                        user_id = i % args.usuarios
+                        postados[user_id] = time.perf_counter()
+                        resposta = await cliente.post(url, json=update_comando(i + 1, user_id, "/list"), headers={"X-Telegram-Bot-Api-Secret-Token": segredo})
+                        return resposta.status_code
+
+                    inicio = time.perf_counter()
+                    status = await asyncio.gather(*(postar(i) for i in range(args.updates)))
+                    limite = time.monotonic() + args.timeout
+                    while len(requisicao.enviadas) < min(args.updates, args.usuarios) and time.monotonic() < limite:
+                        await asyncio.sleep(0.01)
+                    total = time.perf_counter() - inicio
+            finally:
+                await application.updater.stop()
+                await application.stop()
+
+        latencias = [requisicao.enviadas[u] - postados[u] for u in requisicao.enviadas if u in postados]
+        respondidos = len(requisicao.enviadas)
+        print(f"secret token errado: HTTP {negado.status_code} (esperado 403)")
+        print(f"setWebhook chamado: {'setWebhook' in requisicao.chamadas}")
+        print(f"{args.updates} updates postados: HTTP {sorted(set(status))}, {respondidos} chats respondidos em {total:.2f} s")
+        if latencias:
+            r = resumo_latencias(latencias)
+            print(f"post -> sendMessage: p50 {r['p50_ms']:.1f} ms  p99 {r['p99_ms']:.1f} ms  max {r['max_ms']:.1f} ms")
+        if negado.status_code != 403 or respondidos < min(args.updates, args.usuarios):
+            sys.exit(1)
+
+    asyncio.run(cenario())
+
+def bench_lote(args) -> None:
+    #/import de N alertas (validação em lote + uma transação) vs. N /set seguidos, com o Yahoo falso
+    tickers = tickers_b3_ficticios(args.num_tickers)
+    inexistentes = [f"ZZZZ{i}" for i in range(args.inexistentes)]
+    yahoo = YahooFake(tickers, args.latencia_yahoo, 0.0)
+    alerta_b3.yf = yahoo
+    alerta_b3.usuarios_autorizados = frozenset([1, 2, 3])
+    pares = [(ticker, tipo) for ticker in tickers for tipo in alerta_b3.tipos_alerta][:args.alertas]
+    linhas = [f"{ticker.replace('.SA', '')} {tipo} {random.uniform(20, 40):.2f}" for ticker, tipo in pares]
+    linhas += [f"{ticker} compra 10" for ticker in inexistentes]
+
+    def novo_catalogo() -> None:
+        #Catálogo vazio: todos os tickers precisam ir ao Yahoo
+        session = alerta_b3.Session()
+        session.query(alerta_b3.TickerCatalogo).delete()
+        session.commit()
+        session.close()
+        alerta_b3.catalogo_tickers = alerta_b3.CatalogoTickers()
+        alerta_b3.cache_cotacoes = alerta_b3.CacheCotacoes(alerta_b3.ttl_cotacoes)
+        yahoo.requisicoes = 0
+
+    async def com_set() -> None:
+        for linha in linhas:
+            await alerta_b3.set_alerta(UpdateFake(1), ContextFake(linha.split()))
+
+    async def com_import() -> MensagemFake:
+        update = UpdateFake(2, texto="/import\n" + "\n".join(linhas))
+        await alerta_b3.importar_alertas(update, ContextFake([]))
+        return update.message
+
+    for nome, cenario in ((f"{len(linhas)} x /set", com_set), ("/import", com_import)):
+        novo_catalogo()
+        inicio = time.perf_counter()
+        resultado = asyncio.run(cenario())
+        print(f"{nome:>12}: {time.perf_counter() - inicio:6.2f} s, {yahoo.requisicoes} requisições ao Yahoo")
+    print(resultado.respostas[-1].splitlines()[0])
+    print(f"alertas gravados: /set {len(alerta_b3.registro_alertas.alertas_do_chat(1))}, /import {len(alerta_b3.registro_alertas.alertas_do_chat(2))}")
+
+#Métricas de tempo/memória (menor é melhor) comparadas contra uma execução anterior
+metricas_comparadas = (
+    ("monitor", "p50_ms"), ("monitor", "p99_ms"), ("monitor", "entrega_s"),
+    ("comandos", "/list", "p99_ms"), ("comandos", "/set", "p99_ms"), ("comandos", "/rm", "p99_ms"),
+    ("fechamento", "montagem_s"), ("fechamento", "total_s"),
+    ("pico_memoria_mb",),
+)
+
+def comparar_resultados(base: dict, atual: dict, tolerancia: float) -> list:
+    regressoes = []
+    for caminho in metricas_comparadas:
+        antes, depois = base, atual
+        for chave in caminho:
+            antes = antes.get(chave, {}) if isinstance(antes, dict) else None
+            depois = depois.get(chave, {}) if isinstance(depois, dict) else None
+        if isinstance(antes, (int, float)) and isinstance(depois, (int, float)) and depois > antes * (1 + tolerancia):
+            regressoes.append(("/".join(caminho), antes, depois))
+    return regressoes
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks locais do alerta_b3")
+    sub = parser.add_subparsers(dest="cenario", required=True)
+
+    p = sub.add_parser("cotacoes", help="tempo de ciclo da busca de cotações vs. número de tickers")
+    p.add_argument("--tickers", type=int, nargs="+", default=[10, 50, 100, 300])
+    p.add_argument("--latencia", type=float, default=0.05, help="latência simulada por requisição (s)")
+    p.add_argument("--taxa-erro", type=float, default=0.0)
+    p.set_defaults(func=bench_cotacoes)
+
+    p = sub.add_parser("avaliacao", help="custo por tick da avaliação de alertas: varredura vs. índice ordenado")
+    p.add_argument("--alertas", type=int, default=50000)
+    p.add_argument("--num-tickers", type=int, default=3)
+    p.add_argument("--ticks", type=int, default=50)
+    p.set_defaults(func=bench_avaliacao)
+
+    p = sub.add_parser("registro", help="leitura por ciclo: query completa do BD vs. registro residente")
+    p.add_argument("--alertas", type=int, default=100000)
+    p.add_argument("--num-tickers", type=int, default=300)
+    p.add_argument("--usuarios", type=int, default=1000)
+    p.set_defaults(func=bench_registro)
+
+    p = sub.add_parser("latencia", help="p99 do /list com vários /set presos em consultas lentas")
+    p.add_argument("--alertas", type=int, default=10000)
+    p.add_argument("--usuarios", type=int, default=500)
+    p.add_argument("--sets", type=int, default=8)
+    p.add_argument("--lists", type=int, default=200)
+    p.add_argument("--intervalo", type=float, default=0.005, help="pausa entre /list (s)")
+    p.add_argument("--latencia-yahoo", type=float, default=2.0)
+    p.set_defaults(func=bench_latencia)
+
+    p = sub.add_parser("fechamento", help="duração do relatório de fechamento (busca + montagem das mensagens)")
+    p.add_argument("--alertas", type=int, default=100000)
+    p.add_argument("--num-tickers", type=int, default=300)
+    p.add_argument("--usuarios", type=int, default=5000)
+    p.add_argument("--latencia", type=float, default=0.5, help="latência simulada da busca em lote (s)")
+    p.set_defaults(func=bench_fechamento)
+
+    p = sub.add_parser("schema", help="latência das consultas dos comandos antes e depois das migrações")
+    p.add_argument("--linhas", type=int, default=1000000)
+    p.add_argument("--num-tickers", type=int, default=300)
+    p.add_argument("--repeticoes", type=int, default=100)
+    p.set_defaults(func=bench_schema)
+
+    p = sub.add_parser("importacao", help="tempo do import do módulo em um processo novo")
+    p.add_argument("--repeticoes", type=int, default=10)
+    p.set_defaults(func=bench_importacao)
+
+    p = sub.add_parser("carga", help="carga sintética com Yahoo e Telegram falsos; resultado em JSON")
+    p.add_argument("--usuarios", type=int, default=10000)
+    p.add_argument("--alertas", type=int, default=100000)
+    p.add_argument("--num-tickers", type=int, default=300)
+    p.add_argument("--tickers-novos", type=int, default=50, help="tickers válidos ainda sem alerta (o /set consulta o Yahoo)")
+    p.add_argument("--tickers-quebrados", type=int, default=0, help="tickers com alertas que o Yahoo falso não conhece")
+    p.add_argument("--ciclos", type=int, default=10, help="ciclos do monitor")
+    p.add_argument("--minutos-por-ciclo", type=int, default=5, help="barras novas de 1 minuto por ciclo")
+    p.add_argument("--simultaneos", type=int, default=200, help="usuários mandando comandos ao mesmo tempo")
+    p.add_argument("--comandos", type=int, default=10, help="comandos por usuário simultâneo")
+    p.add_argument("--latencia-yahoo", type=float, default=0.2, help="latência por requisição ao Yahoo falso (s)")
+    p.add_argument("--erro-yahoo", type=float, default=0.01, help="taxa de erro do Yahoo falso")
+    p.add_argument("--latencia-telegram", type=float, default=0.05, help="latência por chamada ao Telegram falso (s)")
+    p.add_argument("--erro-telegram", type=float, default=0.01, help="taxa de erro do Telegram falso")
+    p.add_argument("--envios-por-segundo", type=float, default=1000, help="limite global da fila (o Telegram real é ~25)")
+    p.add_argument("--workers-envio", type=int, default=alerta_b3.workers_envio)
+    p.add_argument("--timeout-envio", type=float, default=120, help="espera máxima para esvaziar a fila de envios (s)")
+    p.add_argument("--semente", type=int, default=0)
+    p.add_argument("--saida", help="grava o JSON do resultado neste arquivo")
+    p.add_argument("--comparar", help="JSON de uma execução anterior; sai com código 1 se alguma métrica piorar")
+    p.add_argument("--tolerancia", type=float, default=0.2, help="piora relativa aceita no --comparar")
+    p.set_defaults(func=bench_carga)
+
+    p = sub.add_parser("lote", help="/import de muitos alertas vs. o mesmo número de /set")
+    p.add_argument("--alertas", type=int, default=500)
+    p.add_argument("--num-tickers", type=int, default=300)
+    p.add_argument("--inexistentes", type=int, default=5, help="linhas com tickers que o Yahoo falso não conhece")
+    p.add_argument("--latencia-yahoo", type=float, default=0.2, help="latência por requisição ao Yahoo falso (s)")
+    p.set_defaults(func=bench_lote)
+
+    p = sub.add_parser("webhook", help="updates postados no listener do webhook local, com a API do Telegram falsa")
+    p.add_argument("--updates", type=int, default=500)
+    p.add_argument("--usuarios", type=int, default=500, help="cada update é um /list de um usuário")
+    p.add_argument("--alertas", type=int, default=5000)
+    p.add_argument("--timeout", type=float, default=30, help="espera máxima pelas respostas (s)")
+    p.set_defaults(func=bench_webhook)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()